@@ -81,7 +81,7 @@ class AccountThirdEditor(LucteriosEditor):
     def edit(self, xfer):
         old_account = xfer.get_components("code")
         try:
-            chart_accouts = FiscalYear.get_current().chartsaccount_set.all().filter(code__regex=current_system_account().get_third_mask())
+            chart_accouts = FiscalYear.get_current().chartsaccount_set.all().filter(flag_third=True)
             xfer.remove_component("code")
             sel_code = XferCompSelect("code")
             sel_code.set_location(old_account.col, old_account.row, old_account.colspan + 1, old_account.rowspan)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+'''
+diacamma.accounting.management.commands package
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from diacamma.accounting.models import EntryLineDayBalance, FiscalYear
+
+
+class Command(BaseCommand):
+    help = 'Check daily balances of charts of accounts against entry lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-y', '--year', type=int, help='fiscal year id (all years if missing)')
+
+    def handle(self, year, *args, **options):
+        year_item = None if year is None else FiscalYear.objects.get(id=year)
+        errors = EntryLineDayBalance.check_balances(year_item)
+        for balance in errors:
+            self.stdout.write(self.style.WARNING('account=%s third=%s cost=%s day=%s' % (balance.account_id, balance.third_id, balance.costaccounting_id, balance.day)))
+        if len(errors) > 0:
+            raise CommandError('%d daily balances inconsistent, run accounting_rebuildbalance' % len(errors))
+        self.stdout.write(self.style.SUCCESS('%s: daily balances consistent' % (year_item if year_item is not None else '*')))
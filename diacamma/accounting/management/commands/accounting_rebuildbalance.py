@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+'''
+diacamma.accounting.management.commands package
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from diacamma.accounting.models import ChartsAccountBalance, EntryLineDayBalance, FiscalYear
+
+
+class Command(BaseCommand):
+    help = 'Recompute balances and daily balances of charts of accounts from entry lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-y', '--year', type=int, help='fiscal year id (all years if missing)')
+
+    def handle(self, year, *args, **options):
+        years = [None] if year is None else [FiscalYear.objects.get(id=year)]
+        for year_item in years:
+            with transaction.atomic():
+                nb_balance = ChartsAccountBalance.rebuild(year_item)
+                nb_daybalance = EntryLineDayBalance.rebuild(year_item)
+            self.stdout.write(self.style.SUCCESS('%s: %d balances - %d daily balances' % (year_item if year_item is not None else '*', nb_balance, nb_daybalance)))
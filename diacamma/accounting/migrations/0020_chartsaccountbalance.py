@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0019_fiscalyear_prefix'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChartsAccountBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('validated', models.BooleanField(default=False, verbose_name='validated')),
+                ('bucket', models.IntegerField(choices=[(0, 'current'), (1, 'last year'), (2, 'result')], default=0, verbose_name='journal bucket')),
+                ('amount', models.FloatField(default=0.0, verbose_name='amount')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounting.chartsaccount', verbose_name='account')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounting.fiscalyear', verbose_name='fiscal year')),
+            ],
+            options={
+                'verbose_name': 'balance of account',
+                'verbose_name_plural': 'balances of account',
+                'default_permissions': [],
+                'unique_together': {('account', 'validated', 'bucket')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0020_chartsaccountbalance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountlink',
+            name='is_multiyear',
+            field=models.BooleanField(default=False, verbose_name='multi-year'),
+        ),
+        migrations.AddField(
+            model_name='accountlink',
+            name='letter_num',
+            field=models.IntegerField(default=None, null=True, verbose_name='letter number'),
+        ),
+        migrations.AddField(
+            model_name='accountlink',
+            name='year',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='accounting.fiscalyear', verbose_name='fiscal year'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:47
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+
+
+def initial_has_link(apps, schema_editor):
+    EntryAccount = apps.get_model("accounting", "EntryAccount")
+    EntryLineAccount = apps.get_model("accounting", "EntryLineAccount")
+    EntryAccount.objects.update(has_link=Exists(EntryLineAccount.objects.filter(entry_id=OuterRef('id'), link__isnull=False)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0021_accountlink_letter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entryaccount',
+            name='has_link',
+            field=models.BooleanField(default=False, verbose_name='has link'),
+        ),
+        migrations.AddIndex(
+            model_name='entryaccount',
+            index=models.Index(fields=['year', 'date_value', 'id'], name='entryaccount_year_date_idx'),
+        ),
+        migrations.RunPython(initial_has_link, migrations.RunPython.noop),
+    ]
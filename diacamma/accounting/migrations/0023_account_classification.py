@@ -0,0 +1,129 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:11
+
+import re
+
+from django.db import migrations, models
+
+
+# classification masks of accounting systems at the time of this migration
+CLASSIFICATION_MASKS = {
+    'diacamma.accounting.system.french.FrenchSystemAcounting': {
+        'flag_cash': r'^5[0-9][0-9][0-9a-zA-Z]*$',
+        'flag_customer': r'^41[0-9][0-9a-zA-Z]*$',
+        'flag_provider': r'^40[0-9][0-9a-zA-Z]*$',
+        'flag_employed': r'^42[0-9][0-9a-zA-Z]*$',
+        'flag_societary': r'^45[0-9][0-9a-zA-Z]*$',
+        'flag_third': r'^4[0-9][0-9][0-9a-zA-Z]*$',
+        'flag_vat_collected': r'^4457[0-9a-zA-Z]*$',
+        'flag_vat_deductible': r'^4456[0-9a-zA-Z]*$',
+        'flag_annexe': r'^8[0-9][0-9][0-9a-zA-Z]*$',
+    },
+    'diacamma.accounting.system.belgium.BelgiumSystemAcounting': {
+        'flag_cash': r'^5[0-9][0-9][0-9a-zA-Z]*$',
+        'flag_customer': r'^40[0-9][0-9a-zA-Z]*$',
+        'flag_provider': r'^44[0-9][0-9a-zA-Z]*$',
+        'flag_employed': r'^455[0-9][0-9a-zA-Z]*$',
+        'flag_societary': r'^47[0-9][0-9a-zA-Z]*$|^410[0-9a-zA-Z]*$',
+        'flag_third': r'^44[0-9][0-9a-zA-Z]*$|^40[0-9][0-9a-zA-Z]*$|^455[0-9][0-9a-zA-Z]*$|^47[0-9][0-9a-zA-Z]*$|^410[0-9a-zA-Z]*$',
+        'flag_vat_collected': r'^451[0-9a-zA-Z]*$',
+        'flag_vat_deductible': r'^411[0-9a-zA-Z]*$',
+        'flag_annexe': r'X',
+    },
+}
+
+
+def initial_classification(apps, schema_editor):
+    Parameter = apps.get_model("CORE", "Parameter")
+    system_param = Parameter.objects.filter(name='accounting-system').first()
+    masks = CLASSIFICATION_MASKS.get(system_param.value if system_param is not None else '')
+    if masks is None:
+        return
+    compiled_masks = {flag_name: re.compile(mask) for flag_name, mask in masks.items()}
+    for model_name, flag_names in (("ChartsAccount", ('flag_cash', 'flag_customer', 'flag_provider', 'flag_employed', 'flag_societary', 'flag_third',
+                                                      'flag_vat_collected', 'flag_vat_deductible', 'flag_annexe')),
+                                   ("AccountThird", ('flag_customer', 'flag_provider', 'flag_employed', 'flag_societary', 'flag_third'))):
+        account_class = apps.get_model("accounting", model_name)
+        for code in account_class.objects.order_by().values_list('code', flat=True).distinct():
+            account_class.objects.filter(code=code).update(**{flag_name: compiled_masks[flag_name].search(code) is not None for flag_name in flag_names})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CORE', '0001_initial'),
+        ('accounting', '0022_entryaccount_has_link'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountthird',
+            name='flag_customer',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='customer account'),
+        ),
+        migrations.AddField(
+            model_name='accountthird',
+            name='flag_employed',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='employed account'),
+        ),
+        migrations.AddField(
+            model_name='accountthird',
+            name='flag_provider',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='provider account'),
+        ),
+        migrations.AddField(
+            model_name='accountthird',
+            name='flag_societary',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='societary account'),
+        ),
+        migrations.AddField(
+            model_name='accountthird',
+            name='flag_third',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='third account'),
+        ),
+        migrations.AddField(
+            model_name='chartsaccount',
+            name='flag_annexe',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='annexe account'),
+        ),
+        migrations.AddField(
+            model_name='chartsaccount',
+            name='flag_cash',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='cash account'),
+        ),
+        migrations.AddField(
+            model_name='chartsaccount',
+            name='flag_customer',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='customer account'),
+        ),
+        migrations.AddField(
+            model_name='chartsaccount',
+            name='flag_employed',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='employed account'),
+        ),
+        migrations.AddField(
+            model_name='chartsaccount',
+            name='flag_provider',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='provider account'),
+        ),
+        migrations.AddField(
+            model_name='chartsaccount',
+            name='flag_societary',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='societary account'),
+        ),
+        migrations.AddField(
+            model_name='chartsaccount',
+            name='flag_third',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='third account'),
+        ),
+        migrations.AddField(
+            model_name='chartsaccount',
+            name='flag_vat_collected',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='VAT collected account'),
+        ),
+        migrations.AddField(
+            model_name='chartsaccount',
+            name='flag_vat_deductible',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='VAT deductible account'),
+        ),
+        migrations.RunPython(initial_classification, migrations.RunPython.noop),
+    ]
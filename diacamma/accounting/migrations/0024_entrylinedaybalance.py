@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0023_account_classification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EntryLineDayBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='date')),
+                ('nb_lines', models.IntegerField(default=0, verbose_name='number of lines')),
+                ('debit', models.FloatField(default=0.0, verbose_name='debit')),
+                ('credit', models.FloatField(default=0.0, verbose_name='credit')),
+                ('total_debit', models.FloatField(default=0.0, verbose_name='total debit')),
+                ('total_credit', models.FloatField(default=0.0, verbose_name='total credit')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounting.chartsaccount', verbose_name='account')),
+                ('costaccounting', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounting.costaccounting', verbose_name='cost accounting')),
+                ('third', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounting.third', verbose_name='third')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounting.fiscalyear', verbose_name='fiscal year')),
+            ],
+            options={
+                'verbose_name': 'daily balance of account',
+                'verbose_name_plural': 'daily balances of account',
+                'default_permissions': [],
+                'indexes': [models.Index(fields=['account', 'day'], name='daybalance_account_day_idx')],
+                'unique_together': {('account', 'third', 'costaccounting', 'day')},
+            },
+        ),
+    ]
@@ -24,28 +24,32 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 
 from datetime import date, timedelta, datetime
+from os import remove
 from os.path import join, isfile, dirname
 from logging import getLogger
+from time import time
 from re import match
 from csv import DictReader
+from json import loads, dumps
 from _csv import QUOTE_NONE
 
-from django.db import models
-from django.db.models.functions import Concat
-from django.db.models import Q, F, Value
+from django.db import models, connection, transaction
+from django.db.models.functions import Concat, Coalesce, Lower
+from django.db.models import Q, F, Value, Case, When, OuterRef, Subquery, Exists
 from django.db.models.query import QuerySet
 from django.db.models.aggregates import Sum, Max, Count
-from django.template import engines
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
 from django.utils.translation import gettext_lazy as _
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.core.signals import request_started, request_finished
 
 from lucterios.framework.models import LucteriosModel
 from lucterios.framework.model_fields import FSMIntegerField, transition
 from lucterios.framework.model_fields import get_value_if_choices, LucteriosVirtualField, LucteriosScheduler
 from lucterios.framework.tools import get_date_formating, convert_date
 from lucterios.framework.error import LucteriosException, IMPORTANT, GRAVE
-from lucterios.framework.filetools import read_file, xml_validator, save_file, get_user_path
+from lucterios.framework.filetools import get_user_path
 from lucterios.framework.signal_and_lock import RecordLocker, Signal
 from lucterios.framework.auditlog import auditlog
 from lucterios.framework.printgenerators import ActionGenerator
@@ -55,7 +59,9 @@ from lucterios.CORE.parameters import Params
 from lucterios.contacts.models import AbstractContact, CustomField, CustomizeObject, LegalEntity, Individual
 from lucterios.documents.models import FolderContainer, DocumentContainer
 
-from diacamma.accounting.tools import get_amount_sum, current_system_account, currency_round, correct_accounting_code, get_currency_symbole, format_with_devise, get_amount_from_format_devise
+from diacamma.accounting.tools import get_amount_sum, current_system_account, currency_round, correct_accounting_code, get_currency_symbole, format_with_devise, get_amount_from_format_devise, \
+    bump_ledger_version, encode_serial_line, decode_serial, xml_file_validator, clear_params_snapshot, start_params_snapshot, stop_params_snapshot, \
+    add_scheduled_job, has_scheduled_job
 
 
 class ThirdCustomField(LucteriosModel):
@@ -137,7 +143,38 @@ class Third(LucteriosModel, CustomizeObject):
             Signal.call_signal("addon_search", cls, fieldnames)
         return fieldnames
 
+    @classmethod
+    def order_by_name(cls, items, reverse=False):
+        items = items.annotate(third_name=Lower(Coalesce('contact__legalentity__name',
+                                                         Concat('contact__individual__lastname', Value(' '), 'contact__individual__firstname'),
+                                                         output_field=models.CharField())))
+        if reverse:
+            return items.order_by('-third_name', '-id')
+        else:
+            return items.order_by('third_name', 'id')
+
+    @classmethod
+    def annotate_total(cls, items, only_unbalanced=False):
+        total_query = EntryLineAccount.objects.filter(third_id=OuterRef('pk')).order_by().values('third_id')
+        total_query = total_query.annotate(third_total=Sum(Case(When(account__type_of_account=ChartsAccount.TYPE_ASSET, then=-1 * F('amount')),
+                                                                When(account__type_of_account__gte=ChartsAccount.TYPE_LIABILITY, then=F('amount')),
+                                                                default=Value(0.0), output_field=models.FloatField())))
+        items = items.annotate(total_amount=Coalesce(Subquery(total_query.values('third_total'), output_field=models.FloatField()), Value(0.0)))
+        if only_unbalanced:
+            items = items.filter(Q(total_amount__gt=0.0001) | Q(total_amount__lt=-0.0001))
+        return items
+
     def get_total(self, current_date=None, strict=True, ignore_close=False):
+        if (current_date is None) and not ignore_close and hasattr(self, 'total_amount'):
+            return self.total_amount
+        if (current_date is not None) and not ignore_close:
+            total = 0.0
+            for balance in EntryLineDayBalance.get_balances(Q(third=self), current_date, ('account__type_of_account', ), strict=strict):
+                if balance['account__type_of_account'] == ChartsAccount.TYPE_ASSET:
+                    total -= balance['debit_sum'] + balance['credit_sum']
+                elif (balance['account__type_of_account'] is not None) and (balance['account__type_of_account'] >= ChartsAccount.TYPE_LIABILITY):
+                    total += balance['debit_sum'] + balance['credit_sum']
+            return total
         current_filter = Q(third=self)
         if current_date is not None:
             if strict:
@@ -207,6 +244,13 @@ class Third(LucteriosModel, CustomizeObject):
 class AccountThird(LucteriosModel):
     third = models.ForeignKey(Third, verbose_name=_('third'), null=False, on_delete=models.CASCADE)
     code = models.CharField(_('code'), max_length=50)
+    flag_customer = models.BooleanField(verbose_name=_('customer account'), default=False, db_index=True)
+    flag_provider = models.BooleanField(verbose_name=_('provider account'), default=False, db_index=True)
+    flag_employed = models.BooleanField(verbose_name=_('employed account'), default=False, db_index=True)
+    flag_societary = models.BooleanField(verbose_name=_('societary account'), default=False, db_index=True)
+    flag_third = models.BooleanField(verbose_name=_('third account'), default=False, db_index=True)
+
+    CLASSIFICATION_FLAGS = ('flag_customer', 'flag_provider', 'flag_employed', 'flag_societary', 'flag_third')
 
     total_txt = LucteriosVirtualField(verbose_name=_('total'), compute_from='get_total_txt', format_string=lambda: format_with_devise(2))
 
@@ -248,8 +292,17 @@ class AccountThird(LucteriosModel):
     def total(self):
         return get_amount_sum(EntryLineAccount.objects.filter(third=self.third, account__code=self.code).aggregate(Sum('amount')))
 
+    def set_classification(self):
+        for flag_name, flag_value in current_system_account().get_code_classification(self.code, self.CLASSIFICATION_FLAGS).items():
+            setattr(self, flag_name, flag_value)
+
+    @classmethod
+    def reclassify(cls):
+        return reclassify_accounts(cls)
+
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         self.code = correct_accounting_code(self.code)
+        self.set_classification()
         return LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
 
     class Meta(object):
@@ -258,6 +311,14 @@ class AccountThird(LucteriosModel):
         default_permissions = []
 
 
+def reclassify_accounts(account_class):
+    nb_account = 0
+    system_account = current_system_account()
+    for code in account_class.objects.order_by().values_list('code', flat=True).distinct():
+        nb_account += account_class.objects.filter(code=code).update(**system_account.get_code_classification(code, account_class.CLASSIFICATION_FLAGS))
+    return nb_account
+
+
 def get_total_result_text_format():
     value = {}
     value['revenue'] = '{0}'
@@ -278,6 +339,10 @@ class FiscalYear(LucteriosModel):
     STATUS_FINISHED = 2
     LIST_STATUS = ((STATUS_BUILDING, _('building year')), (STATUS_RUNNING, _('running year')), (STATUS_FINISHED, _('finished year')))
 
+    CLOSE_BACKGROUND_NBLINES = 20000
+    # years being closed by this process
+    CLOSING_IDS = set()
+
     begin = models.DateField(verbose_name=_('begin'))
     end = models.DateField(verbose_name=_('end'))
     status = models.IntegerField(verbose_name=_('status'), choices=LIST_STATUS, default=STATUS_BUILDING)
@@ -365,12 +430,12 @@ class FiscalYear(LucteriosModel):
 
     @property
     def total_cash(self):
-        return get_amount_sum(EntryLineAccount.objects.filter(account__code__regex=current_system_account().get_cash_mask(),
+        return get_amount_sum(EntryLineAccount.objects.filter(account__flag_cash=True,
                                                               account__year=self, entry__date_value__gte=self.begin, entry__date_value__lte=self.end).aggregate(Sum('amount')))
 
     @property
     def total_cash_close(self):
-        return get_amount_sum(EntryLineAccount.objects.filter(entry__close=True, account__code__regex=current_system_account().get_cash_mask(),
+        return get_amount_sum(EntryLineAccount.objects.filter(entry__close=True, account__flag_cash=True,
                                                               account__year=self, entry__date_value__gte=self.begin, entry__date_value__lte=self.end).aggregate(Sum('amount')))
 
     def get_total_result_text(self):
@@ -471,32 +536,54 @@ class FiscalYear(LucteriosModel):
         rubric_list.sort()
         return rubric_list
 
-    def get_context(self):
-        entries_by_journal = []
-        for journal in Journal.objects.all():
-            entries = self.entryaccount_set.filter(journal=journal, close=True).exclude(entrylineaccount__isnull=True)
-            if len(entries) > 0:
-                entries_by_journal.append((journal, entries))
-        if len(entries_by_journal) == 0:
-            raise LucteriosException(IMPORTANT, _('This fiscal year has no validated entrie !'))
-        return {'year': self, 'entries_by_journal': entries_by_journal}
-
     def get_xml_export(self):
         file_name = "fiscalyear_export_%s.xml" % str(self.id)
-        xmlfiles = current_system_account().get_export_xmlfiles()
-        if xmlfiles is None:
+        xsd_file = current_system_account().get_export_xsdfile()
+        if xsd_file is None:
             raise LucteriosException(IMPORTANT, _('No export for this accounting system!'))
-        xml_file, xsd_file = xmlfiles
-        template = engines['django'].from_string(read_file(xml_file).decode('utf-8'))
-        context_data = self.get_context()
-        fiscal_year_xml = str(template.render(context_data))
-        res_val = xml_validator(fiscal_year_xml, xsd_file)
+        if not EntryLineAccount.objects.filter(entry__year=self, entry__close=True).exists():
+            raise LucteriosException(IMPORTANT, _('This fiscal year has no validated entrie !'))
+        begin = time()
+        xml_file = get_user_path("accounting", file_name)
+        try:
+            current_system_account().write_export_xml(self, xml_file)
+            res_val = xml_file_validator(xml_file, xsd_file)
+        except Exception:
+            if isfile(xml_file):
+                remove(xml_file)
+            raise
         if res_val is not None:
-            getLogger("diacamma.accounting").exception("Failure to export: '%s' / '%s'" % (context_data, res_val))
+            remove(xml_file)
+            getLogger("diacamma.accounting").error("Failure to export: '%s' / '%s'" % (self, res_val))
             raise LucteriosException(IMPORTANT, _("Failure to export this fiscal year !"))
-        save_file(get_user_path("accounting", file_name), fiscal_year_xml)
+        getLogger("diacamma.accounting").info(' * export of %s in %.3fs', self, time() - begin)
+        return join("accounting", file_name)
+
+    def get_fec_export(self, separator='\t'):
+        file_name = "fiscalyear_fec_%s.txt" % str(self.id)
+        if not EntryLineAccount.objects.filter(entry__year=self, entry__close=True).exists():
+            raise LucteriosException(IMPORTANT, _('This fiscal year has no validated entrie !'))
+        begin = time()
+        fec_file = get_user_path("accounting", file_name)
+        nb_lines = 0
+        try:
+            with open(fec_file, 'w', encoding='utf-8', newline='') as fec_output:
+                for fec_line in current_system_account().iter_export_fec(self, separator):
+                    fec_output.write(fec_line)
+                    nb_lines += 1
+        except Exception:
+            if isfile(fec_file):
+                remove(fec_file)
+            raise
+        getLogger("diacamma.accounting").info(' * FEC export of %s: lines=%d in %.3fs', self, nb_lines - 1, time() - begin)
         return join("accounting", file_name)
 
+    def get_fec_filename(self):
+        siren = ''.join([char for char in LegalEntity.objects.get(id=1).legal_identification if char.isdigit()])[:9]
+        if len(siren) != 9:
+            raise LucteriosException(IMPORTANT, _('The SIREN of your structure (legal identification) is needed for FEC export!'))
+        return "%sFEC%s.txt" % (siren, self.end.strftime('%Y%m%d'))
+
     def get_identify(self):
         if self.begin.year != self.end.year:
             return "%d/%d" % (self.begin.year, self.end.year)
@@ -579,18 +666,102 @@ class FiscalYear(LucteriosModel):
         year.get_reports(FiscalYearTrialBalance, {'filtercode': ''})
         year.get_reports(FiscalYearLedger, {'filtercode': ''})
 
-    def closed(self):
-        for cost in CostAccounting.objects.filter(year=self):
-            cost.close()
-        if self.next_fiscalyear.first() is not None:
-            CostAccounting.create_costs_from_lastyear(self.next_fiscalyear.first().id)
-        self._check_annexe()
-        self.move_entry_noclose()
-        self.unlink_entry_multiyear()
-        current_system_account().finalize_year(self)
-        self.status = FiscalYear.STATUS_FINISHED
-        self.save()
+    def _get_close_job_id(self):
+        return 'accounting-close-%d' % self.id
+
+    @property
+    def close_progress(self):
+        progress = cache.get('accounting-close-progress-%d' % self.id)
+        if (progress is not None) and (self.id not in FiscalYear.CLOSING_IDS) and not has_scheduled_job(self._get_close_job_id()):
+            # closing job finished, lost or removed
+            self._set_close_progress(None)
+            progress = None
+        return progress
+
+    @property
+    def close_error(self):
+        return cache.get('accounting-close-error-%d' % self.id)
+
+    def _set_close_error(self, error):
+        if error is None:
+            cache.delete('accounting-close-error-%d' % self.id)
+        else:
+            cache.set('accounting-close-error-%d' % self.id, str(error), timeout=None)
+
+    def _set_close_progress(self, step):
+        if step is None:
+            cache.delete('accounting-close-progress-%d' % self.id)
+        else:
+            getLogger("diacamma.accounting").info(' * closing %s: %s', self, step)
+            cache.set('accounting-close-progress-%d' % self.id, str(step), timeout=3600)
+
+    def is_big_for_closing(self):
+        return EntryLineAccount.objects.filter(account__year=self).count() > self.CLOSE_BACKGROUND_NBLINES
+
+    def closed(self, xfer=None):
+        self._set_close_error(None)
+        FiscalYear.CLOSING_IDS.add(self.id)
+        try:
+            with transaction.atomic():
+                self._set_close_progress(_('cost accountings'))
+                for cost in CostAccounting.objects.filter(year=self):
+                    cost.close()
+                if self.next_fiscalyear.first() is not None:
+                    CostAccounting.create_costs_from_lastyear(self.next_fiscalyear.first().id)
+                self._check_annexe()
+                self._set_close_progress(_('entries not validated'))
+                self.move_entry_noclose()
+                self.unlink_entry_multiyear()
+                self._set_close_progress(_('closing entries'))
+                current_system_account().finalize_year(self)
+                self.status = FiscalYear.STATUS_FINISHED
+                self.save()
+        finally:
+            FiscalYear.CLOSING_IDS.discard(self.id)
+            self._set_close_progress(None)
         LucteriosScheduler.add_date(FiscalYear.save_reports, datetime=datetime.now() + timedelta(seconds=10), year=self, last_user=getattr(self, 'last_user', None))
+        if xfer is not None:
+            signal_and_lock.Signal.call_signal("finalize_year_after", xfer)
+
+    def closed_in_background(self, xfer=None):
+        last_user = getattr(self, 'last_user', None)
+        user_id = last_user.id if (last_user is not None) and last_user.is_authenticated else None
+        params = dict(xfer.params) if xfer is not None else None
+        self._set_close_error(None)
+        if not add_scheduled_job(FiscalYear.close_backend, self._get_close_job_id(), 1, year_id=self.id, user_id=user_id, params=params):
+            raise LucteriosException(IMPORTANT, _("Closing of this fiscal year in progress: %s") % _('waiting'))
+        self._set_close_progress(_('waiting'))
+
+    @classmethod
+    def close_backend(cls, year_id, user_id=None, params=None):
+        '''Close fiscal year'''
+        year = FiscalYear.objects.get(id=year_id)
+        year.last_user = LucteriosUser.objects.filter(id=user_id).first() if user_id is not None else None
+        xfer = None
+        if params is not None:
+            from diacamma.accounting.views_accounts import FiscalYearClose
+            xfer = FiscalYearClose()
+            xfer.params = params
+        try:
+            year.closed(xfer)
+        except LucteriosException as lerr:
+            getLogger("diacamma.accounting").warning("Failure to close '%s': %s", year, lerr)
+            year._set_close_error(lerr)
+        except Exception as err:
+            getLogger("diacamma.accounting").exception("Failure to close '%s'" % year)
+            year._set_close_error(err)
+
+    def _get_auto_link_job_id(self):
+        return 'accounting-autolink-%d' % self.id
+
+    def auto_link(self, account_code=''):
+        return add_scheduled_job(FiscalYear.auto_link_backend, self._get_auto_link_job_id(), 10, year_id=self.id, account_code=account_code)
+
+    @classmethod
+    def auto_link_backend(cls, year_id, account_code=''):
+        '''Automatic lettering'''
+        from diacamma.accounting.tools_matching import ThirdLineMatcher
+        return ThirdLineMatcher(FiscalYear.objects.get(id=year_id), account_code).run()
 
     def check_report(self):
         LucteriosScheduler.add_date(FiscalYear.check_report_backend, datetime=datetime.now() + timedelta(seconds=10), year=self)
@@ -760,6 +931,18 @@ class ChartsAccount(LucteriosModel):
     year = models.ForeignKey('FiscalYear', verbose_name=_('fiscal year'), null=False, on_delete=models.CASCADE, db_index=True)
     type_of_account = models.IntegerField(verbose_name=_('type of account'), choices=LIST_TYPES, null=True, db_index=True)
     rubric = models.CharField(_('rubric'), max_length=200, null=True, default="")
+    flag_cash = models.BooleanField(verbose_name=_('cash account'), default=False, db_index=True)
+    flag_customer = models.BooleanField(verbose_name=_('customer account'), default=False, db_index=True)
+    flag_provider = models.BooleanField(verbose_name=_('provider account'), default=False, db_index=True)
+    flag_employed = models.BooleanField(verbose_name=_('employed account'), default=False, db_index=True)
+    flag_societary = models.BooleanField(verbose_name=_('societary account'), default=False, db_index=True)
+    flag_third = models.BooleanField(verbose_name=_('third account'), default=False, db_index=True)
+    flag_vat_collected = models.BooleanField(verbose_name=_('VAT collected account'), default=False, db_index=True)
+    flag_vat_deductible = models.BooleanField(verbose_name=_('VAT deductible account'), default=False, db_index=True)
+    flag_annexe = models.BooleanField(verbose_name=_('annexe account'), default=False, db_index=True)
+
+    CLASSIFICATION_FLAGS = ('flag_cash', 'flag_customer', 'flag_provider', 'flag_employed', 'flag_societary', 'flag_third',
+                            'flag_vat_collected', 'flag_vat_deductible', 'flag_annexe')
 
     last_year_total = LucteriosVirtualField(verbose_name=_('total of last year'), compute_from='get_last_year_total', format_string=lambda: format_with_devise(2))
     current_total = LucteriosVirtualField(verbose_name=_('total current'), compute_from='get_current_total', format_string=lambda: format_with_devise(2))
@@ -799,31 +982,26 @@ class ChartsAccount(LucteriosModel):
     def get_name(self):
         return "[%s] %s" % (correct_accounting_code(self.code), self.name)
 
-    def get_last_year_total(self, with_correction=True):
+    def _get_balance_total(self, with_correction, **balance_filter):
+        balances = ChartsAccountBalance.objects.filter(account_id=self.id, **balance_filter)
+        if self.type_of_account in (3, 4, 5):
+            balances = balances.exclude(bucket=ChartsAccountBalance.BUCKET_RESULT)
+        total = currency_round(get_amount_sum(balances.aggregate(Sum('amount'))))
         if with_correction:
-            return self.credit_debit_way() * get_amount_sum(self.entrylineaccount_set.filter(entry__journal__id=1).aggregate(Sum('amount')))
+            return self.credit_debit_way() * total
         else:
-            return get_amount_sum(self.entrylineaccount_set.filter(entry__journal__id=1).aggregate(Sum('amount')))
+            return total
+
+    def get_last_year_total(self, with_correction=True):
+        return self._get_balance_total(with_correction, bucket=ChartsAccountBalance.BUCKET_LASTYEAR)
 
     def get_current_total(self, with_correction=True):
         if self.id is None:
             return None
-        entrylines = self.entrylineaccount_set.all()
-        if self.type_of_account in (3, 4, 5):
-            entrylines = entrylines.exclude(entry__in=self.year.get_result_entries())
-        if with_correction:
-            return self.credit_debit_way() * get_amount_sum(entrylines.aggregate(Sum('amount')))
-        else:
-            return get_amount_sum(entrylines.aggregate(Sum('amount')))
+        return self._get_balance_total(with_correction)
 
     def get_current_validated(self, with_correction=True):
-        entrylines = self.entrylineaccount_set.filter(entry__close=True)
-        if self.type_of_account in (3, 4, 5):
-            entrylines = entrylines.exclude(entry__in=self.year.get_result_entries())
-        if with_correction:
-            return self.credit_debit_way() * get_amount_sum(entrylines.aggregate(Sum('amount')))
-        else:
-            return get_amount_sum(entrylines.aggregate(Sum('amount')))
+        return self._get_balance_total(with_correction, validated=True)
 
     def credit_debit_way(self):
         if self.type_of_account in [0, 4]:
@@ -833,11 +1011,19 @@ class ChartsAccount(LucteriosModel):
 
     @property
     def is_third(self):
-        return match(current_system_account().get_third_mask(), self.code) is not None
+        return self.flag_third
 
     @property
     def is_cash(self):
-        return match(current_system_account().get_cash_mask(), self.code) is not None
+        return self.flag_cash
+
+    def set_classification(self):
+        for flag_name, flag_value in current_system_account().get_code_classification(self.code, self.CLASSIFICATION_FLAGS).items():
+            setattr(self, flag_name, flag_value)
+
+    @classmethod
+    def reclassify(cls):
+        return reclassify_accounts(cls)
 
     @property
     def has_validated(self):
@@ -860,6 +1046,7 @@ class ChartsAccount(LucteriosModel):
         except ObjectDoesNotExist:
             descript, typeaccount = current_system_account().new_charts_account(code)
             chart = ChartsAccount(year=current_year, code=code, name=descript, type_of_account=typeaccount)
+            chart.set_classification()
         return chart
 
     @classmethod
@@ -879,7 +1066,13 @@ class ChartsAccount(LucteriosModel):
                     IMPORTANT, _('Account already exists for this fiscal year!'))
         except ObjectDoesNotExist:
             pass
-        return LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        old_code = ChartsAccount.objects.filter(id=self.id).values_list('code', flat=True).first() if self.id is not None else None
+        self.set_classification()
+        res = LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        result_codes = current_system_account().result_accounting_codes
+        if (old_code is not None) and (old_code != self.code) and ((old_code in result_codes) or (self.code in result_codes)):
+            ChartsAccountBalance.rebuild(self.year)
+        return res
 
     @classmethod
     def import_initial(cls, year, account_item):
@@ -899,6 +1092,237 @@ class ChartsAccount(LucteriosModel):
         ordering = ['year', 'code']
 
 
+class ChartsAccountBalance(LucteriosModel):
+    BUCKET_CURRENT = 0
+    BUCKET_LASTYEAR = 1
+    BUCKET_RESULT = 2
+    LIST_BUCKETS = ((BUCKET_CURRENT, _('current')), (BUCKET_LASTYEAR, _('last year')), (BUCKET_RESULT, _('result')))
+
+    account = models.ForeignKey('ChartsAccount', verbose_name=_('account'), null=False, on_delete=models.CASCADE, related_name='+')
+    year = models.ForeignKey('FiscalYear', verbose_name=_('fiscal year'), null=False, on_delete=models.CASCADE, related_name='+')
+    validated = models.BooleanField(verbose_name=_('validated'), default=False)
+    bucket = models.IntegerField(verbose_name=_('journal bucket'), choices=LIST_BUCKETS, default=BUCKET_CURRENT)
+    amount = models.FloatField(_('amount'), default=0.0)
+
+    def __str__(self):
+        return "%s %s %s" % (self.account_id, self.bucket, self.amount)
+
+    @classmethod
+    def get_grouped_amounts(cls, entrylines):
+        result_entries = EntryAccount.objects.filter(journal_id=Journal.DEFAULT_OTHER, entrylineaccount__account__code__in=current_system_account().result_accounting_codes).values('id')
+        entrylines = entrylines.annotate(balance_bucket=Case(When(entry__journal_id=Journal.DEFAULT_LASTYEAR, then=Value(cls.BUCKET_LASTYEAR)),
+                                                             When(entry_id__in=result_entries, then=Value(cls.BUCKET_RESULT)),
+                                                             default=Value(cls.BUCKET_CURRENT), output_field=models.IntegerField()))
+        return entrylines.values('account_id', 'account__year_id', 'entry__close', 'balance_bucket').annotate(Sum('amount')).order_by()
+
+    @classmethod
+    def add_amount(cls, account_id, year_id, validated, bucket, amount):
+        if amount == 0:
+            return
+        if cls.objects.filter(account_id=account_id, validated=validated, bucket=bucket).update(amount=F('amount') + amount) == 0:
+            cls.objects.create(account_id=account_id, year_id=year_id, validated=validated, bucket=bucket, amount=amount)
+
+    @classmethod
+    def add_entrylines(cls, entrylines, factor):
+        for val in cls.get_grouped_amounts(entrylines):
+            cls.add_amount(val['account_id'], val['account__year_id'], val['entry__close'], val['balance_bucket'], factor * get_amount_sum(val))
+
+    @classmethod
+    def get_unbalanced_years(cls):
+        # cheap consistency check: total by account of the balances against the entry lines
+        line_totals = {(account_id, year_id): float(amount) for account_id, year_id, amount in
+                       EntryLineAccount.objects.values_list('account_id', 'account__year_id').annotate(Sum('amount')).order_by()}
+        year_ids = set()
+        for account_id, year_id, amount in cls.objects.values_list('account_id', 'year_id').annotate(Sum('amount')).order_by():
+            if abs(line_totals.pop((account_id, year_id), 0.0) - amount) > 0.0001:
+                year_ids.add(year_id)
+        year_ids.update([year_id for (_account_id, year_id), amount in line_totals.items() if abs(amount) > 0.0001])
+        return sorted(year_ids)
+
+    @classmethod
+    def before_line_change(cls, entryline, removing=False):
+        result_codes = current_system_account().result_accounting_codes
+        old_line = EntryLineAccount.objects.filter(id=entryline.id).values('entry_id', 'account__code').first() if entryline.id is not None else None
+        entry_ids = set()
+        if (old_line is not None) and (old_line['account__code'] in result_codes):
+            entry_ids.add(old_line['entry_id'])
+        if not removing and (entryline.account.code in result_codes):
+            entry_ids.add(entryline.entry_id)
+        for entry_id in entry_ids:
+            cls.add_entrylines(EntryLineAccount.objects.filter(entry_id=entry_id), -1)
+        if (old_line is not None) and (old_line['entry_id'] not in entry_ids):
+            cls.add_entrylines(EntryLineAccount.objects.filter(id=entryline.id), -1)
+        return entry_ids
+
+    @classmethod
+    def after_line_change(cls, entryline, entry_ids):
+        for entry_id in entry_ids:
+            cls.add_entrylines(EntryLineAccount.objects.filter(entry_id=entry_id), 1)
+        if (entryline.id is not None) and (entryline.entry_id not in entry_ids):
+            cls.add_entrylines(EntryLineAccount.objects.filter(id=entryline.id), 1)
+
+    @classmethod
+    def rebuild(cls, year=None):
+        balances = cls.objects.all()
+        entrylines = EntryLineAccount.objects.all()
+        if year is not None:
+            balances = balances.filter(year=year)
+            entrylines = entrylines.filter(account__year=year)
+        balances.delete()
+        new_balances = [cls(account_id=val['account_id'], year_id=val['account__year_id'], validated=val['entry__close'],
+                            bucket=val['balance_bucket'], amount=get_amount_sum(val)) for val in cls.get_grouped_amounts(entrylines)]
+        cls.objects.bulk_create(new_balances)
+        return len(new_balances)
+
+    class Meta(object):
+        verbose_name = _('balance of account')
+        verbose_name_plural = _('balances of account')
+        default_permissions = []
+        unique_together = (('account', 'validated', 'bucket'),)
+
+
+class EntryLineDayBalance(LucteriosModel):
+    account = models.ForeignKey('ChartsAccount', verbose_name=_('account'), null=False, on_delete=models.CASCADE, related_name='+')
+    year = models.ForeignKey('FiscalYear', verbose_name=_('fiscal year'), null=False, on_delete=models.CASCADE, related_name='+')
+    third = models.ForeignKey('Third', verbose_name=_('third'), null=True, on_delete=models.CASCADE, related_name='+')
+    costaccounting = models.ForeignKey('CostAccounting', verbose_name=_('cost accounting'), null=True, on_delete=models.CASCADE, related_name='+')
+    day = models.DateField(verbose_name=_('date'), null=False)
+    nb_lines = models.IntegerField(verbose_name=_('number of lines'), default=0)
+    debit = models.FloatField(_('debit'), default=0.0)
+    credit = models.FloatField(_('credit'), default=0.0)
+    total_debit = models.FloatField(_('total debit'), default=0.0)
+    total_credit = models.FloatField(_('total credit'), default=0.0)
+
+    def __str__(self):
+        return "%s %s %s %s %s" % (self.account_id, self.third_id, self.costaccounting_id, self.day, self.total_debit + self.total_credit)
+
+    @classmethod
+    def get_line_sums(cls, entrylines, fields):
+        entrylines = entrylines.values(*fields)
+        return entrylines.annotate(nb_lines=Count('id'), debit_sum=Coalesce(Sum(Case(When(amount__gt=0, then='amount'), default=0.0, output_field=models.FloatField())), 0.0),
+                                   credit_sum=Coalesce(Sum(Case(When(amount__lt=0, then='amount'), default=0.0, output_field=models.FloatField())), 0.0)).order_by()
+
+    @classmethod
+    def get_grouped_amounts(cls, entrylines):
+        return cls.get_line_sums(entrylines, ('account_id', 'account__year_id', 'third_id', 'costaccounting_id', 'entry__date_value'))
+
+    @classmethod
+    def get_key_filter(cls, account_id, third_id, costaccounting_id):
+        key_filter = Q(account_id=account_id)
+        key_filter &= Q(third__isnull=True) if third_id is None else Q(third_id=third_id)
+        key_filter &= Q(costaccounting__isnull=True) if costaccounting_id is None else Q(costaccounting_id=costaccounting_id)
+        return key_filter
+
+    @classmethod
+    def add_amount(cls, account_id, year_id, third_id, costaccounting_id, day, nb_lines, debit, credit):
+        if nb_lines == 0:
+            return
+        key_filter = cls.get_key_filter(account_id, third_id, costaccounting_id)
+        cls.objects.filter(key_filter & Q(day__gte=day)).update(total_debit=F('total_debit') + debit, total_credit=F('total_credit') + credit)
+        if cls.objects.filter(key_filter & Q(day=day)).update(nb_lines=F('nb_lines') + nb_lines, debit=F('debit') + debit, credit=F('credit') + credit) == 0:
+            previous = cls.objects.filter(key_filter & Q(day__lt=day)).order_by('-day').values('total_debit', 'total_credit').first()
+            if previous is None:
+                previous = {'total_debit': 0.0, 'total_credit': 0.0}
+            cls.objects.create(account_id=account_id, year_id=year_id, third_id=third_id, costaccounting_id=costaccounting_id, day=day, nb_lines=nb_lines,
+                               debit=debit, credit=credit, total_debit=previous['total_debit'] + debit, total_credit=previous['total_credit'] + credit)
+        else:
+            cls.objects.filter(key_filter & Q(day=day) & Q(nb_lines__lte=0)).delete()
+
+    @classmethod
+    def add_entrylines(cls, entrylines, factor):
+        for val in cls.get_grouped_amounts(entrylines):
+            cls.add_amount(val['account_id'], val['account__year_id'], val['third_id'], val['costaccounting_id'], val['entry__date_value'],
+                           factor * val['nb_lines'], factor * val['debit_sum'], factor * val['credit_sum'])
+
+    @classmethod
+    def get_expected_balances(cls, year=None):
+        entrylines = EntryLineAccount.objects.all()
+        if year is not None:
+            entrylines = entrylines.filter(account__year=year)
+        expected_balances = {}
+        totals = {}
+        for val in sorted(cls.get_grouped_amounts(entrylines), key=lambda val: val['entry__date_value']):
+            key = (val['account_id'], val['third_id'], val['costaccounting_id'])
+            total = totals.setdefault(key, [0.0, 0.0])
+            total[0] += val['debit_sum']
+            total[1] += val['credit_sum']
+            expected_balances[key + (val['entry__date_value'], )] = cls(account_id=val['account_id'], year_id=val['account__year_id'], third_id=val['third_id'],
+                                                                          costaccounting_id=val['costaccounting_id'], day=val['entry__date_value'], nb_lines=val['nb_lines'],
+                                                                          debit=val['debit_sum'], credit=val['credit_sum'], total_debit=total[0], total_credit=total[1])
+        return expected_balances
+
+    @classmethod
+    def rebuild(cls, year=None):
+        balances = cls.objects.all()
+        if year is not None:
+            balances = balances.filter(year=year)
+        balances.delete()
+        new_balances = list(cls.get_expected_balances(year).values())
+        cls.objects.bulk_create(new_balances, batch_size=500)
+        return len(new_balances)
+
+    @classmethod
+    def get_unbalanced_years(cls):
+        # cheap consistency check: totals by account, third and cost accounting of the daily balances against the entry lines
+        line_totals = {(val['account_id'], val['third_id'], val['costaccounting_id']): val
+                       for val in cls.get_line_sums(EntryLineAccount.objects.all(), ('account_id', 'account__year_id', 'third_id', 'costaccounting_id'))}
+        year_ids = set()
+        for val in cls.objects.values('account_id', 'year_id', 'third_id', 'costaccounting_id').annotate(nb_lines=Sum('nb_lines'), debit_sum=Sum('debit'), credit_sum=Sum('credit')).order_by():
+            expected = line_totals.pop((val['account_id'], val['third_id'], val['costaccounting_id']), {'nb_lines': 0, 'debit_sum': 0.0, 'credit_sum': 0.0})
+            if (expected['nb_lines'] != val['nb_lines']) or any([abs(expected[fieldname] - val[fieldname]) > 0.0001 for fieldname in ('debit_sum', 'credit_sum')]):
+                year_ids.add(val['year_id'])
+        year_ids.update([val['account__year_id'] for val in line_totals.values()])
+        return sorted(year_ids)
+
+    @classmethod
+    def check_balances(cls, year=None):
+        expected_balances = cls.get_expected_balances(year)
+        balances = cls.objects.all()
+        if year is not None:
+            balances = balances.filter(year=year)
+        errors = []
+        for balance in balances:
+            expected = expected_balances.pop((balance.account_id, balance.third_id, balance.costaccounting_id, balance.day), None)
+            if (expected is None) or (expected.nb_lines != balance.nb_lines) or \
+                    any([abs(getattr(expected, fieldname) - getattr(balance, fieldname)) > 0.0001 for fieldname in ('debit', 'credit', 'total_debit', 'total_credit')]):
+                errors.append(balance)
+        errors.extend(expected_balances.values())
+        return errors
+
+    @classmethod
+    def _annotate_key(cls, balances):
+        return balances.annotate(third_key=Coalesce('third_id', Value(0)), cost_key=Coalesce('costaccounting_id', Value(0)))
+
+    @classmethod
+    def get_balances(cls, query, current_date, fields, strict=True):
+        date_filter = Q(day__lte=current_date) if strict else Q(day__lt=current_date)
+        next_balances = cls._annotate_key(cls.objects.filter(date_filter & Q(account_id=OuterRef('account_id'), day__gt=OuterRef('day'))))
+        next_balances = next_balances.filter(third_key=OuterRef('third_key'), cost_key=OuterRef('cost_key'))
+        last_balances = cls._annotate_key(cls.objects.filter(query & date_filter)).filter(~Exists(next_balances))
+        return last_balances.values(*fields).annotate(debit_sum=Sum('total_debit'), credit_sum=Sum('total_credit')).order_by()
+
+    @classmethod
+    def get_movements(cls, query, begin_date, end_date, fields):
+        movements = {}
+        for factor, balances in ((1, cls.get_balances(query, end_date, fields)), (-1, cls.get_balances(query, begin_date, fields, strict=False))):
+            for balance in balances:
+                key = tuple([balance[fieldname] for fieldname in fields])
+                if key not in movements:
+                    movements[key] = dict(balance)
+                    movements[key]['debit_sum'] = 0.0
+                    movements[key]['credit_sum'] = 0.0
+                movements[key]['debit_sum'] += factor * balance['debit_sum']
+                movements[key]['credit_sum'] += factor * balance['credit_sum']
+        return list(movements.values())
+
+    class Meta(object):
+        verbose_name = _('daily balance of account')
+        verbose_name_plural = _('daily balances of account')
+        default_permissions = []
+        unique_together = (('account', 'third', 'costaccounting', 'day'),)
+        indexes = [models.Index(fields=['account', 'day'], name='daybalance_account_day_idx')]
+
+
 class Journal(LucteriosModel):
 
     DEFAULT_LASTYEAR = 1
@@ -951,29 +1375,82 @@ class AccountLink(LucteriosModel):
 
     letter = LucteriosVirtualField(verbose_name=_('link'), compute_from='get_letter')
     date_max = models.DateField(verbose_name=_('date max'), null=True, default=None)
+    year = models.ForeignKey('FiscalYear', verbose_name=_('fiscal year'), null=True, default=None, on_delete=models.SET_NULL, related_name='+')
+    letter_num = models.IntegerField(verbose_name=_('letter number'), null=True, default=None)
+    is_multiyear = models.BooleanField(verbose_name=_('multi-year'), default=False)
 
     def __str__(self):
         return self.letter
 
-    def get_letter(self):
-        if self.id is None:
-            return None
-        entrylines = self.entrylineaccount_set.all()
-        if len(entrylines) == 0:
-            return ''
-        year = entrylines[0].entry.year
-        nb_link = AccountLink.objects.filter(entrylineaccount__entry__year=year, id__lt=self.id).count()
+    @classmethod
+    def format_letter(cls, letter_num, is_multiyear):
         letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
         res = ''
-        while nb_link >= 26:
-            div, mod = divmod(nb_link, 26)
+        while letter_num >= 26:
+            div, mod = divmod(letter_num, 26)
             res = letters[mod] + res
-            nb_link = int(div) - 1
-        res = letters[nb_link] + res
-        if entrylines.exclude(entry__year=year).count() > 0:
+            letter_num = int(div) - 1
+        res = letters[letter_num] + res
+        if is_multiyear:
             res += "&"
         return res
 
+    def get_letter(self):
+        if self.id is None:
+            return None
+        if self.letter_num is None:
+            self.fill_letter()
+        if self.letter_num is None:
+            return ''
+        return self.format_letter(self.letter_num, self.is_multiyear)
+
+    def fill_letter(self):
+        entrylines = self.entrylineaccount_set.all()
+        first_line = entrylines.select_related('entry').first()
+        if first_line is None:
+            self.year_id = None
+            self.letter_num = None
+            self.is_multiyear = False
+        else:
+            self.year_id = first_line.entry.year_id
+            self.letter_num = EntryLineAccount.objects.filter(entry__year_id=self.year_id, link_id__lt=self.id).count()
+            self.is_multiyear = entrylines.exclude(entry__year_id=self.year_id).exists()
+        AccountLink.objects.filter(id=self.id).update(year_id=self.year_id, letter_num=self.letter_num, is_multiyear=self.is_multiyear)
+
+    @classmethod
+    def shift_letters(cls, link_id, nb_lines_by_year):
+        # a removed link no longer counts in the letters of the next links of its years
+        with transaction.atomic():
+            list(FiscalYear.objects.select_for_update().filter(id__in=nb_lines_by_year.keys()))
+            for year_id, nb_lines in nb_lines_by_year.items():
+                cls.objects.filter(year_id=year_id, id__gt=link_id, letter_num__isnull=False).update(letter_num=F('letter_num') - nb_lines)
+
+    @classmethod
+    def fill_emptyletter(cls):
+        link_ids = set(cls.objects.filter(letter_num__isnull=True, entrylineaccount__isnull=False).values_list('id', flat=True))
+        if len(link_ids) == 0:
+            return 0
+        link_years = {}
+        for link_id, year_id in EntryLineAccount.objects.filter(link_id__in=link_ids).order_by(*EntryLineAccount._meta.ordering).values_list('link_id', 'entry__year_id'):
+            if link_id not in link_years:
+                link_years[link_id] = [year_id, False]
+            elif link_years[link_id][0] != year_id:
+                link_years[link_id][1] = True
+        nb_lines_by_link = {}
+        for year_id, link_id, nb_lines in EntryLineAccount.objects.filter(link__isnull=False, entry__year_id__in=set([year_id for year_id, _multi in link_years.values()])).values_list('entry__year_id', 'link_id').annotate(Count('id')).order_by('entry__year_id', 'link_id'):
+            if year_id not in nb_lines_by_link:
+                nb_lines_by_link[year_id] = []
+            nb_lines_by_link[year_id].append((link_id, nb_lines))
+        links = []
+        for year_id, year_links in nb_lines_by_link.items():
+            letter_num = 0
+            for link_id, nb_lines in year_links:
+                if (link_id in link_years) and (link_years[link_id][0] == year_id):
+                    links.append(AccountLink(id=link_id, year_id=year_id, letter_num=letter_num, is_multiyear=link_years[link_id][1]))
+                letter_num += nb_lines
+        cls.objects.bulk_update(links, ['year', 'letter_num', 'is_multiyear'], batch_size=1000)
+        return len(links)
+
     def fill_date(self):
         search_maxdate = self.entrylineaccount_set.aggregate(Max('entry__date_value'))
         if 'entry__date_value__max' in search_maxdate:
@@ -982,8 +1459,8 @@ class AccountLink(LucteriosModel):
 
     @classmethod
     def fill_emptydate(cls):
-        for link in cls.objects.filter(date_max__isnull=True):
-            link.fill_date()
+        date_max = EntryLineAccount.objects.filter(link_id=OuterRef('id')).values('link_id').annotate(date_max=Max('entry__date_value')).values('date_max')
+        return cls.objects.filter(date_max__isnull=True).update(date_max=Subquery(date_max[:1]))
 
     def is_validity(self):
         if self.id is None:
@@ -1009,48 +1486,97 @@ class AccountLink(LucteriosModel):
         return True
 
     @classmethod
-    def create_link(cls, entrylines):
-        import re
-        regex_third = re.compile(current_system_account().get_third_mask())
+    def _check_link_group(cls, entrylines, regex_third):
         years = []
         third_info = None
         sum_amount = 0.0
-        for entryline in set(entrylines):
-            entryline = EntryLineAccount.objects.get(id=entryline.id)
+        for entryline in entrylines:
             if regex_third.match(entryline.account.code) is None:
-                raise LucteriosException(IMPORTANT, _("An entry line is not third!"))
+                return _("An entry line is not third!")
             if entryline.entry.year not in years:
                 years.append(entryline.entry.year)
             if third_info is None:
                 third_info = (entryline.account.code, entryline.third_id)
             elif (third_info[0] != entryline.account.code) or (third_info[1] != entryline.third_id):
-                raise LucteriosException(IMPORTANT, _("This entry lines are not in same third!"))
+                return _("This entry lines are not in same third!")
             sum_amount += float(entryline.amount)
-            entryline.unlink()
         if len(years) > 2:
-            raise LucteriosException(IMPORTANT, _("This entries are over 2 years!"))
-        elif (len(years) == 2) and (years[0].last_fiscalyear != years[1]) and (years[1].last_fiscalyear != years[0]):
-            raise LucteriosException(IMPORTANT, _("These entries are not on 2 consecutive years!"))
+            return _("This entries are over 2 years!")
+        elif (len(years) == 2) and (years[0].last_fiscalyear_id != years[1].id) and (years[1].last_fiscalyear_id != years[0].id):
+            return _("These entries are not on 2 consecutive years!")
         elif (len(years) == 2) and ((years[0].status == FiscalYear.STATUS_FINISHED) or (years[1].status == FiscalYear.STATUS_FINISHED)):
-            raise LucteriosException(IMPORTANT, _("These entries are closed exercises!"))
+            return _("These entries are closed exercises!")
         if abs(sum_amount) > 0.0001:
-            raise LucteriosException(IMPORTANT, _("The input lines are not balanced!"))
-        for entryline in entrylines:
-            entryline = EntryLineAccount.objects.get(id=entryline.id)
-            entryline.unlink()
-        new_link = AccountLink.objects.create()
-        if len(years) == 2:
-            new_multilink = AccountLink.objects.create()
+            return _("The input lines are not balanced!")
+        return None
+
+    @classmethod
+    def _bulk_create_links(cls, new_links):
+        if connection.features.can_return_rows_from_bulk_insert:
+            cls.objects.bulk_create(new_links)
         else:
-            new_multilink = None
-        for entryline in entrylines:
-            entryline.link = new_link
-            if entryline.multilink_id is None:
-                entryline.multilink = new_multilink
-            entryline.save()
-        new_link.fill_date()
-        if new_multilink is not None:
-            new_multilink.fill_date()
+            for new_link in new_links:
+                new_link.save()
+
+    @classmethod
+    def create_links(cls, groups):
+        import re
+        regex_third = re.compile(current_system_account().get_third_mask())
+        groups = [list(set([entryline.id if isinstance(entryline, EntryLineAccount) else int(entryline) for entryline in group])) for group in groups]
+        entrylines_by_id = EntryLineAccount.objects.filter(id__in=set([line_id for group in groups for line_id in group])).select_related('account', 'entry', 'entry__year').in_bulk()
+        errors = []
+        valid_groups = []
+        for group in groups:
+            entrylines = [entrylines_by_id[line_id] for line_id in group if line_id in entrylines_by_id]
+            error = cls._check_link_group(entrylines, regex_third) if len(entrylines) == len(group) else _("Entry line unknown!")
+            errors.append(error)
+            if (error is None) and (len(entrylines) > 0):
+                entrylines.sort(key=lambda entryline: (entryline.entry.date_value, entryline.entry_id, entryline.account.code, entryline.third_id or 0))
+                valid_groups.append(entrylines)
+        if len(valid_groups) == 0:
+            return errors
+        with transaction.atomic():
+            old_link_ids = set([entryline.link_id for entrylines in valid_groups for entryline in entrylines
+                                if (entryline.link_id is not None) and (entryline.entry.year.status != FiscalYear.STATUS_FINISHED)])
+            for old_link in cls.objects.filter(id__in=old_link_ids):
+                old_link.clean()
+            year_ids = set([entryline.entry.year_id for entrylines in valid_groups for entryline in entrylines])
+            # letter of a link: number of lines already lettered in its year
+            list(FiscalYear.objects.select_for_update().filter(id__in=year_ids))
+            nb_lines_by_year = dict(EntryLineAccount.objects.filter(entry__year_id__in=year_ids, link__isnull=False).exclude(id__in=[entryline.id for entrylines in valid_groups for entryline in entrylines]).values_list('entry__year_id').annotate(Count('id')).order_by())
+            new_links = []
+            new_multilinks = []
+            for entrylines in valid_groups:
+                year_id = entrylines[0].entry.year_id
+                letter_num = nb_lines_by_year.get(year_id, 0)
+                for entryline in entrylines:
+                    nb_lines_by_year[entryline.entry.year_id] = nb_lines_by_year.get(entryline.entry.year_id, 0) + 1
+                is_multiyear = len(set([entryline.entry.year_id for entryline in entrylines])) > 1
+                new_links.append(cls(date_max=max([entryline.entry.date_value for entryline in entrylines]), year_id=year_id, letter_num=letter_num, is_multiyear=is_multiyear))
+                if is_multiyear:
+                    new_multilinks.append(cls())
+            cls._bulk_create_links(new_links + new_multilinks)
+            multilinks = iter(new_multilinks)
+            lines_to_update = []
+            for entrylines, new_link in zip(valid_groups, new_links):
+                new_multilink = next(multilinks) if new_link.is_multiyear else None
+                for entryline in entrylines:
+                    entryline.link = new_link
+                    if entryline.multilink_id is None:
+                        entryline.multilink = new_multilink
+                    lines_to_update.append(entryline)
+            EntryLineAccount.objects.bulk_update(lines_to_update, ['link', 'multilink'], batch_size=500)
+            EntryAccount.refresh_has_link([entryline.entry_id for entryline in lines_to_update])
+        bump_ledger_version()
+        return errors
+
+    @classmethod
+    def create_link(cls, entrylines):
+        errors = cls.create_links([entrylines])
+        if errors[0] is not None:
+            for entryline in EntryLineAccount.objects.filter(id__in=[entryline.id for entryline in entrylines], link__isnull=False):
+                entryline.unlink()
+            raise LucteriosException(IMPORTANT, errors[0])
 
     def clean(self):
         if self.id is None:
@@ -1078,6 +1604,7 @@ class EntryAccount(LucteriosModel):
     designation = models.CharField(_('name'), max_length=200)
     costaccounting = models.ForeignKey('CostAccounting', verbose_name=_('cost accounting'), null=True, on_delete=models.PROTECT)
     close = models.BooleanField(verbose_name=_('close'), default=False, db_index=True)
+    has_link = models.BooleanField(verbose_name=_('has link'), default=False)
 
     description = LucteriosVirtualField(verbose_name=_('description'), compute_from='get_description')
 
@@ -1158,7 +1685,7 @@ class EntryAccount(LucteriosModel):
 
     @property
     def is_asset(self):
-        sum_customer = get_amount_sum(self.entrylineaccount_set.filter(account__code__regex=current_system_account().get_third_mask()).aggregate(Sum('amount')))
+        sum_customer = get_amount_sum(self.entrylineaccount_set.filter(account__flag_third=True).aggregate(Sum('amount')))
         return ((sum_customer < 0) and not self.has_cash) or ((sum_customer > 0) and self.has_cash)
 
     def reverse_entry(self):
@@ -1198,37 +1725,40 @@ class EntryAccount(LucteriosModel):
         self.unlink()
         for entryline in self.entrylineaccount_set.all():
             entryline.unlink()
+        ChartsAccountBalance.add_entrylines(self.entrylineaccount_set.all(), -1)
+        EntryLineDayBalance.add_entrylines(self.entrylineaccount_set.all(), -1)
         LucteriosModel.delete(self)
 
     def get_serial(self, entrylines=None):
         if entrylines is None:
             entrylines = self.entrylineaccount_set.all() if self.id is not None else []
-        serial_val = ''
-        for line in entrylines:
-            if serial_val != '':
-                serial_val += '\n'
-            serial_val += line.get_serial()
-        return serial_val
+        return '\n'.join([line.get_serial() for line in entrylines])
 
     def get_entrylineaccounts(self, serial_vals):
+        serial_lines = getattr(self, '_serial_lines', None)
+        if (serial_lines is None) or (serial_lines[0] != serial_vals):
+            lines = [line for line in EntryLineAccount.get_entrylineaccounts_from_records(decode_serial(serial_vals)) if line.account.year_id == self.year.id]
+            for line in lines:
+                line.entry = self
+            serial_lines = (serial_vals, lines)
+            self._serial_lines = serial_lines
         res = QuerySet(model=EntryLineAccount)
-        res._result_cache = []
-        for serial_val in serial_vals.split('\n'):
-            if serial_val != '':
-                new_line = EntryLineAccount.get_entrylineaccount(serial_val)
-                new_line.entry = self
-                if new_line.account.year == self.year:
-                    res._result_cache.append(new_line)
+        res._result_cache = list(serial_lines[1])
         return res
 
     def save_entrylineaccounts(self, serial_vals, check_integrity=True):
         if not self.close:
             old_linkids = [line.link_id for line in self.entrylineaccount_set.all() if line.link_id is not None]
+            ChartsAccountBalance.add_entrylines(self.entrylineaccount_set.all(), -1)
+            EntryLineDayBalance.add_entrylines(self.entrylineaccount_set.all(), -1)
             self.entrylineaccount_set.all().delete()
             for line in self.get_entrylineaccounts(serial_vals):
                 if line.id < 0:
                     line.id = None
-                line.save(check_integrity=check_integrity)
+                line.save(check_integrity=check_integrity, with_balance=False)
+            ChartsAccountBalance.add_entrylines(self.entrylineaccount_set.all(), 1)
+            EntryLineDayBalance.add_entrylines(self.entrylineaccount_set.all(), 1)
+            self._serial_lines = None
             has_link = False
             for line in self.entrylineaccount_set.all():
                 if line.link_id is not None:
@@ -1283,29 +1813,52 @@ class EntryAccount(LucteriosModel):
         return no_change, currency_round(max(0, total_credit - total_debit)), currency_round(max(0, total_debit - total_credit))
 
     def closed(self, check_balance=True, check_needcost=True):
-        if (self.year.status != 2) and not self.close:
-            if check_balance:
-                _no_change, debit_rest, credit_rest = self.serial_control(self.get_serial())
+        EntryAccount.closed_entries([self], check_balance=check_balance, check_needcost=check_needcost)
+
+    @classmethod
+    def closed_entries(cls, entries, check_balance=True, check_needcost=True):
+        entries = [entry for entry in entries if (entry.year.status != FiscalYear.STATUS_FINISHED) and not entry.close]
+        if len(entries) == 0:
+            return 0
+        entry_ids = [entry.id for entry in entries]
+        if check_balance:
+            signed_amount = Case(When(account__type_of_account__in=(ChartsAccount.TYPE_ASSET, ChartsAccount.TYPE_EXPENSE), then=-1 * F('amount')), default=F('amount'), output_field=models.FloatField())
+            balances = dict(EntryLineAccount.objects.filter(entry_id__in=entry_ids, account__year=F('entry__year')).values_list('entry_id').annotate(total=Sum(signed_amount)).order_by())
+            for entry in entries:
+                total = balances.get(entry.id) or 0.0
+                debit_rest, credit_rest = currency_round(max(0, total)), currency_round(max(0, -1 * total))
                 if abs(debit_rest - credit_rest) >= 0.001:
                     raise LucteriosException(GRAVE, _("Account entry not balanced{[br/]}total credit=%(credit)s - total debit=%(debit)s%(info)s") % {'credit': get_amount_from_format_devise(debit_rest, 7),
                                                                                                                                                      'debit': get_amount_from_format_devise(credit_rest, 7),
-                                                                                                                                                     'info': self.get_description()})
-            if check_needcost and Params.getvalue("accounting-needcost"):
-                nocost_filter = Q(account__type_of_account__in=(ChartsAccount.TYPE_REVENUE,
-                                                                ChartsAccount.TYPE_EXPENSE,
-                                                                ChartsAccount.TYPE_CONTRAACCOUNTS))
-                nocost_filter &= Q(costaccounting__isnull=True)
-                enties_nocost = self.entrylineaccount_set.filter(nocost_filter).distinct()
-                if enties_nocost.count() > 0:
-                    raise LucteriosException(IMPORTANT, _("Cost accounting is mandatory !"))
-            self.close = True
-            val = self.year.entryaccount_set.all().aggregate(Max('num'))
-            if val['num__max'] is None:
-                self.num = 1
+                                                                                                                                                     'info': entry.get_description()})
+        if check_needcost and Params.getvalue("accounting-needcost"):
+            nocost_filter = Q(account__type_of_account__in=(ChartsAccount.TYPE_REVENUE,
+                                                            ChartsAccount.TYPE_EXPENSE,
+                                                            ChartsAccount.TYPE_CONTRAACCOUNTS))
+            nocost_filter &= Q(costaccounting__isnull=True)
+            if EntryLineAccount.objects.filter(Q(entry_id__in=entry_ids) & nocost_filter).exists():
+                raise LucteriosException(IMPORTANT, _("Cost accounting is mandatory !"))
+        with transaction.atomic():
+            entries_by_year = {}
+            for entry in entries:
+                entries_by_year.setdefault(entry.year_id, []).append(entry)
+            for year_id, year_entries in entries_by_year.items():
+                list(FiscalYear.objects.select_for_update().filter(id=year_id))
+                last_num = cls.objects.filter(year_id=year_id).aggregate(Max('num'))['num__max'] or 0
+                for entry in year_entries:
+                    last_num += 1
+                    entry.close = True
+                    entry.num = last_num
+                    entry.date_entry = date.today()
+            if auditlog.contains(cls) and auditlog.get_state(cls._meta.app_label):
+                for entry in entries:
+                    entry.save()
             else:
-                self.num = val['num__max'] + 1
-            self.date_entry = date.today()
-            self.save()
+                ChartsAccountBalance.add_entrylines(EntryLineAccount.objects.filter(entry_id__in=entry_ids), -1)
+                cls.objects.bulk_update(entries, ['close', 'num', 'date_entry'], batch_size=500)
+                ChartsAccountBalance.add_entrylines(EntryLineAccount.objects.filter(entry_id__in=entry_ids), 1)
+                bump_ledger_version()
+        return len(entries)
 
     def unlink(self):
         if self.year.status != FiscalYear.STATUS_FINISHED:
@@ -1349,34 +1902,57 @@ class EntryAccount(LucteriosModel):
             return new_entry_line
 
     def get_thirds(self):
-        return self.entrylineaccount_set.filter(account__code__regex=current_system_account().get_third_mask()).distinct()
+        return self.entrylineaccount_set.filter(account__flag_third=True).distinct()
 
     @property
     def has_third(self):
-        return self.entrylineaccount_set.filter(account__code__regex=current_system_account().get_third_mask()).count() > 0
+        return self.entrylineaccount_set.filter(account__flag_third=True).count() > 0
 
     @property
     def has_customer(self):
-        return self.entrylineaccount_set.filter(account__code__regex=current_system_account().get_customer_mask()).count() > 0
+        return self.entrylineaccount_set.filter(account__flag_customer=True).count() > 0
 
     @property
     def has_cash(self):
-        return self.entrylineaccount_set.filter(account__code__regex=current_system_account().get_cash_mask()).count() > 0
+        return self.entrylineaccount_set.filter(account__flag_cash=True).count() > 0
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         if (self.costaccounting is not None) and (self.costaccounting.year_id is not None) and (self.costaccounting.year_id != self.year_id):
             self.costaccounting_id = None
         if ((self.id is None) or not self.close) and (self.year.status == FiscalYear.STATUS_FINISHED):
             raise LucteriosException(IMPORTANT, _('Can not save entry account on finished fiscal year !'))
-        return LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        old_entry = EntryAccount.objects.filter(id=self.id).values('journal_id', 'close', 'date_value').first() if self.id is not None else None
+        balance_changed = (old_entry is not None) and ((old_entry['journal_id'] != self.journal_id) or (old_entry['close'] != self.close))
+        day_changed = (old_entry is not None) and (str(old_entry['date_value']) != str(self.date_value))
+        if balance_changed:
+            ChartsAccountBalance.add_entrylines(self.entrylineaccount_set.all(), -1)
+        if day_changed:
+            EntryLineDayBalance.add_entrylines(self.entrylineaccount_set.all(), -1)
+        res = LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        if balance_changed:
+            ChartsAccountBalance.add_entrylines(self.entrylineaccount_set.all(), 1)
+        if day_changed:
+            EntryLineDayBalance.add_entrylines(self.entrylineaccount_set.all(), 1)
+        if old_entry is not None:
+            EntryAccount.refresh_has_link([self.id])
+        return res
+
+    @classmethod
+    def refresh_has_link(cls, entry_ids):
+        entry_ids = list(set(entry_ids))
+        for idx in range(0, len(entry_ids), 500):
+            cls.objects.filter(id__in=entry_ids[idx:idx + 500]).update(has_link=Exists(EntryLineAccount.objects.filter(entry_id=OuterRef('id'), link__isnull=False)))
 
     class Meta(object):
         verbose_name = _('entry of account')
         verbose_name_plural = _('entries of account')
         ordering = ['date_value']
+        indexes = [models.Index(fields=['year', 'date_value', 'id'], name='entryaccount_year_date_idx')]
 
 
 class EntryLineAccount(LucteriosModel):
+    IMPORT_CHUNK_SIZE = 1000
+
     account = models.ForeignKey('ChartsAccount', verbose_name=_('account'), null=False, on_delete=models.PROTECT)
     entry = models.ForeignKey('EntryAccount', verbose_name=_('entry'), null=False, on_delete=models.CASCADE)
     amount = models.FloatField(_('amount'), db_index=True)
@@ -1503,17 +2079,11 @@ class EntryLineAccount(LucteriosModel):
 
     def equals(self, other):
         res = self.id == other.id
-        res = res and (self.account.id == other.account.id)
+        res = res and (self.account_id == other.account_id)
         res = res and (abs(self.amount - other.amount) < 0.0001)
         res = res and (self.reference == other.reference)
-        if self.third is None:
-            res = res and (other.third is None)
-        else:
-            res = res and (self.third.id == other.third.id)
-        if self.costaccounting is None:
-            res = res and (other.costaccounting is None)
-        else:
-            res = res and (self.costaccounting.id == other.costaccounting.id)
+        res = res and (self.third_id == other.third_id)
+        res = res and (self.costaccounting_id == other.costaccounting_id)
         return res
 
     @classmethod
@@ -1521,88 +2091,144 @@ class EntryLineAccount(LucteriosModel):
         super(EntryLineAccount, cls).initialize_import()
         if hasattr(cls, 'entry_imported'):
             del cls.entry_imported
-        if hasattr(cls, 'serial_entry_imported'):
-            del cls.serial_entry_imported
+        if hasattr(cls, 'lines_imported'):
+            del cls.lines_imported
+        cls.import_cache = {'years': {}, 'accounts': {}, 'thirds': None, 'costaccountings': None}
+        cls.import_pending = []
+        cls.entries_imported = {}
+        cls.import_begin = time()
+        cls.import_nblines = 0
+
+    @classmethod
+    def get_entries_imported(cls):
+        return getattr(cls, 'entries_imported', {})
+
+    @classmethod
+    def _get_import_year(cls, year_id):
+        if year_id not in cls.import_cache['years']:
+            cls.import_cache['years'][year_id] = FiscalYear.objects.get(id=year_id)
+        return cls.import_cache['years'][year_id]
+
+    @classmethod
+    def _get_import_account(cls, year_id, code):
+        if year_id not in cls.import_cache['accounts']:
+            cls.import_cache['accounts'][year_id] = {account.code: account for account in ChartsAccount.objects.filter(year_id=year_id)}
+        return cls.import_cache['accounts'][year_id].get(code)
+
+    @classmethod
+    def _get_import_third(cls, name):
+        if cls.import_cache['thirds'] is None:
+            cls.import_cache['thirds'] = {}
+            for third_id, legalentity_name, lastname, firstname in Third.objects.values_list('id', 'contact__legalentity__name', 'contact__individual__lastname',
+                                                                                              'contact__individual__firstname').order_by('id'):
+                if legalentity_name is not None:
+                    cls.import_cache['thirds'].setdefault(legalentity_name, third_id)
+                if lastname is not None:
+                    cls.import_cache['thirds'].setdefault("%s %s" % (lastname, firstname), third_id)
+        return cls.import_cache['thirds'].get(name)
+
+    @classmethod
+    def _get_import_costaccounting(cls, name):
+        if cls.import_cache['costaccountings'] is None:
+            cls.import_cache['costaccountings'] = {}
+            for cost_id, cost_name, cost_year_id in CostAccounting.objects.filter(status=CostAccounting.STATUS_OPENED).values_list('id', 'name', 'year_id').order_by('id'):
+                cls.import_cache['costaccountings'].setdefault(cost_name, (cost_id, cost_year_id))
+        return cls.import_cache['costaccountings'].get(name)
 
     @classmethod
     def import_data(cls, rowdata, dateformat):
-        new_item = None
         if hasattr(cls, 'entry_imported'):
             if (cls.entry_imported.date_value != rowdata['entry.date_value']) or (cls.entry_imported.designation != rowdata['entry.designation']):
-                new_item = cls.finalize_import()
+                cls._close_entry_imported()
         if not hasattr(cls, 'entry_imported'):
-            cls.entry_imported = EntryAccount(year_id=rowdata['entry.year'], journal_id=rowdata['entry.journal'], date_value=rowdata['entry.date_value'], designation=rowdata['entry.designation'])
-        if not hasattr(cls, 'serial_entry_imported'):
-            cls.serial_entry_imported = ""
-        account = ChartsAccount.objects.filter(code=rowdata['account'], year_id=rowdata['entry.year']).first()
-        third = None
+            cls.entry_imported = EntryAccount(year=cls._get_import_year(rowdata['entry.year']), journal_id=rowdata['entry.journal'],
+                                              date_value=rowdata['entry.date_value'], designation=rowdata['entry.designation'])
+            cls.lines_imported = []
+        account = cls._get_import_account(cls.entry_imported.year_id, rowdata['account'])
+        third_id = None
         if ('third' in rowdata) and (rowdata['third'].strip() != ''):
-            q_legalentity = Q(contact__legalentity__name=rowdata['third'].strip())
-            q_individual = Q(completename=rowdata['third'])
-            third = Third.objects.annotate(completename=Concat('contact__individual__lastname',
-                                                               Value(' '),
-                                                               'contact__individual__firstname')).annotate(num_entryline=Count('entrylineaccount')).filter(q_legalentity | q_individual).first()
-            if third is None:
+            third_id = cls._get_import_third(rowdata['third'].strip())
+            if third_id is None:
                 cls.import_logs.append(_("Third '%s' unknown !") % rowdata['third'].strip())
-
-        costaccounting = None
+        costaccounting_id = None
         if ('costaccounting' in rowdata) and (rowdata['costaccounting'].strip() != ''):
-            costaccounting = CostAccounting.objects.filter(name=rowdata['costaccounting'].strip(), status=0).first()
+            costaccounting = cls._get_import_costaccounting(rowdata['costaccounting'].strip())
             if costaccounting is None:
                 cls.import_logs.append(_("Cost accounting '%s' unknown !") % rowdata['costaccounting'].strip())
+            elif (costaccounting[1] is not None) and (costaccounting[1] != cls.entry_imported.year_id):
+                cls.import_logs.append(_('The cost accounting "%s" has another year!') % rowdata['costaccounting'].strip())
+            else:
+                costaccounting_id = costaccounting[0]
         reference = rowdata['reference'] if 'reference' in rowdata else None
-        if account is not None:
-            cls.serial_entry_imported = cls.entry_imported.add_new_entryline(cls.serial_entry_imported, 0, account.id,
-                                                                             credit_val=rowdata['credit'], debit_val=rowdata['debit'],
-                                                                             third=third.id if third is not None else 0,
-                                                                             costaccounting=costaccounting.id if costaccounting is not None else 0,
-                                                                             reference=reference)
-        else:
+        if account is None:
             cls.import_logs.append(_("Account code '%s' unknown !") % rowdata['account'])
-        return new_item
+        elif (str(cls.entry_imported.journal_id) == '1') and (match(current_system_account().get_revenue_mask(), account.code) or match(current_system_account().get_expence_mask(), account.code)):
+            cls.import_logs.append(_('This kind of entry is not allowed for this journal!'))
+        else:
+            new_line = cls(account=account, third_id=third_id, reference=None if reference == "None" else reference)
+            new_line.costaccounting_id = costaccounting_id if account.type_of_account in (3, 4, 5) else None
+            new_line.set_montant(rowdata['debit'], rowdata['credit'])
+            cls.lines_imported.append(new_line)
+        return None
+
+    @classmethod
+    def _close_entry_imported(cls):
+        entry = cls.entry_imported
+        lines = cls.lines_imported
+        del cls.entry_imported
+        del cls.lines_imported
+        if not entry.check_date(checking=True):
+            cls.import_logs.append(_("Invalid date '%s' !") % entry.date_value)
+            return
+        if entry.year.status == FiscalYear.STATUS_FINISHED:
+            cls.import_logs.append(_('Can not save entry account on finished fiscal year !'))
+            return
+        total = sum([line.amount * line.account.credit_debit_way() for line in lines])
+        debit_rest, credit_rest = currency_round(max(0, total)), currency_round(max(0, -1 * total))
+        if (debit_rest < 0.0001) and (credit_rest < 0.0001) and (len(lines) > 0):
+            cls.import_pending.append((entry, lines))
+            if len(cls.import_pending) >= cls.IMPORT_CHUNK_SIZE:
+                cls._save_import_pending()
+        elif len(lines) > 1:
+            cls.import_logs.append(_("Account entry not balanced{[br/]}total credit=%(credit)s - total debit=%(debit)s%(info)s") % {'credit': get_amount_from_format_devise(debit_rest, 7),
+                                                                                                                                    'debit': get_amount_from_format_devise(credit_rest, 7), 'info': ''})
+        elif len(lines) == 1:
+            cls.import_logs.append(_("Account entry '%s' with only one line") % entry.designation)
+
+    @classmethod
+    def _save_import_pending(cls):
+        entries = [entry for entry, _lines in cls.import_pending]
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                EntryAccount.objects.bulk_create(entries, batch_size=500)
+            else:
+                for entry in entries:
+                    entry.save()
+            new_lines = []
+            for entry, lines in cls.import_pending:
+                for line in lines:
+                    line.entry = entry
+                    new_lines.append(line)
+            cls.bulk_create_lines(new_lines)
+        for entry in entries:
+            cls.entries_imported[entry.id] = entry
+        cls.import_nblines += len(new_lines)
+        cls.import_pending = []
 
     @classmethod
     def finalize_import(cls):
-        new_item = None
         if hasattr(cls, 'entry_imported'):
-            if not hasattr(cls, 'serial_entry_imported'):
-                cls.serial_entry_imported = ""
-            if not cls.entry_imported.check_date(checking=True):
-                cls.import_logs.append(_("Invalid date '%s' !") % cls.entry_imported.date_value)
-            else:
-                _no_change, debit_rest, credit_rest = cls.entry_imported.serial_control(cls.serial_entry_imported)
-                if (debit_rest < 0.0001) and (credit_rest < 0.0001) and (len(cls.serial_entry_imported) > 0):
-                    new_item = cls.entry_imported
-                    new_item.save()
-                    new_item.save_entrylineaccounts(cls.serial_entry_imported)
-                elif len(cls.entry_imported.get_entrylineaccounts(cls.serial_entry_imported)) > 1:
-                    cls.import_logs.append(_("Account entry not balanced{[br/]}total credit=%(credit)s - total debit=%(debit)s%(info)s") % {'credit': get_amount_from_format_devise(debit_rest, 7),
-                                                                                                                                            'debit': get_amount_from_format_devise(credit_rest, 7), 'info': ''})
-                elif len(cls.entry_imported.get_entrylineaccounts(cls.serial_entry_imported)) == 1:
-                    cls.import_logs.append(_("Account entry '%s' with only one line") % cls.entry_imported.designation)
-            del cls.serial_entry_imported
-            del cls.entry_imported
-        return new_item
+            cls._close_entry_imported()
+        if len(getattr(cls, 'import_pending', [])) > 0:
+            cls._save_import_pending()
+        if hasattr(cls, 'import_begin'):
+            duration = max(time() - cls.import_begin, 0.000001)
+            getLogger("diacamma.accounting").info(' * import of entries: entries=%d lines=%d errors=%d in %.3fs (%.0f lines/s)',
+                                                  len(cls.entries_imported), cls.import_nblines, len(cls.import_logs), duration, cls.import_nblines / duration)
+        return None
 
     def get_serial(self):
-        # return serial information: "<id>|<accound id>|<third id> or 0|<amount>|<cost id> or 0|<link id> or 0|<reference> or None"
-        if self.third is None:
-            third_id = 0
-        else:
-            third_id = self.third.id
-        if self.reference is None:
-            reference = 'None'
-        else:
-            reference = self.reference
-        if self.costaccounting is None:
-            costaccounting_id = 0
-        else:
-            costaccounting_id = self.costaccounting.id
-        if self.link is None:
-            link_id = 0
-        else:
-            link_id = self.link.id
-        return "%d|%d|%d|%f|%d|%d|%s|" % (self.id, self.account.id, third_id, self.amount, costaccounting_id, link_id, reference)
+        return encode_serial_line(self.id, self.account_id, self.third_id, self.amount, self.costaccounting_id, self.link_id, self.reference)
 
     @classmethod
     def add_serial(cls, num_cpt, debit_val, credit_val, thirdid=0, costaccountingid=0, reference=None):
@@ -1610,14 +2236,11 @@ class EntryLineAccount(LucteriosModel):
         new_entry_line = cls()
         new_entry_line.id = -1 * int(time.time() * 60)
         new_entry_line.account = ChartsAccount.objects.get(id=num_cpt)
-        if thirdid == 0:
-            new_entry_line.third = None
-        else:
-            new_entry_line.third = Third.objects.get(id=thirdid)
+        new_entry_line.third_id = None if thirdid == 0 else thirdid
         if (costaccountingid == 0) or (new_entry_line.account.type_of_account not in (3, 4, 5)):
-            new_entry_line.costaccounting = None
+            new_entry_line.costaccounting_id = None
         else:
-            new_entry_line.costaccounting = CostAccounting.objects.get(id=costaccountingid)
+            new_entry_line.costaccounting_id = costaccountingid
         new_entry_line.set_montant(debit_val, credit_val)
         if reference == "None":
             new_entry_line.reference = None
@@ -1625,46 +2248,37 @@ class EntryLineAccount(LucteriosModel):
             new_entry_line.reference = reference
         return new_entry_line.get_serial()
 
+    @classmethod
+    def get_entrylineaccounts_from_records(cls, records):
+        def get_item(items_by_id, item_id, model):
+            if item_id not in items_by_id:
+                raise model.DoesNotExist("%s matching query does not exist." % model._meta.object_name)
+            return items_by_id[item_id]
+
+        accounts = ChartsAccount.objects.in_bulk(set([record[1] for record in records]))
+        thirds = Third.objects.select_related('contact').in_bulk(set([record[2] for record in records if record[2] != 0]))
+        costaccountings = CostAccounting.objects.in_bulk(set([record[4] for record in records if record[4] != 0]))
+        links = AccountLink.objects.in_bulk(set([record[5] for record in records if record[5] != 0]))
+        entrylines = []
+        for line_id, account_id, third_id, amount, costaccounting_id, link_id, reference in records:
+            new_entry_line = cls(id=line_id, amount=float(amount), reference=reference)
+            new_entry_line.account = get_item(accounts, account_id, ChartsAccount)
+            new_entry_line.third = get_item(thirds, third_id, Third) if third_id != 0 else None
+            if (costaccounting_id == 0) or (new_entry_line.account.type_of_account not in (3, 4, 5)):
+                new_entry_line.costaccounting = None
+            else:
+                new_entry_line.costaccounting = get_item(costaccountings, costaccounting_id, CostAccounting)
+            new_entry_line.link = get_item(links, link_id, AccountLink) if link_id != 0 else None
+            entrylines.append(new_entry_line)
+        return entrylines
+
     @classmethod
     def get_entrylineaccount(cls, serial_val):
-        serial_vals = serial_val.split('|')
-        new_entry_line = cls()
-        new_entry_line.id = int(serial_vals[0])
-        new_entry_line.account = ChartsAccount.objects.get(id=int(serial_vals[1]))
-        if int(serial_vals[2]) == 0:
-            new_entry_line.third = None
-        else:
-            new_entry_line.third = Third.objects.get(id=int(serial_vals[2]))
-        new_entry_line.amount = float(serial_vals[3])
-        if (int(serial_vals[4]) == 0) or (new_entry_line.account.type_of_account not in (3, 4, 5)):
-            new_entry_line.costaccounting = None
-        else:
-            new_entry_line.costaccounting = CostAccounting.objects.get(id=int(serial_vals[4]))
-        if int(serial_vals[5]) == 0:
-            new_entry_line.link = None
-        else:
-            new_entry_line.link = AccountLink.objects.get(id=int(serial_vals[5]))
-        new_entry_line.reference = "".join(serial_vals[6:-1])
-        if new_entry_line.reference.startswith("None"):
-            new_entry_line.reference = None
-        return new_entry_line
+        return cls.get_entrylineaccounts_from_records(decode_serial(serial_val))[0]
 
     def create_clone_inverse(self):
         import time
-        new_entry_line = EntryLineAccount()
-        new_entry_line.id = -1 * int(time.time() * 60)
-        new_entry_line.account = self.account
-        if self.third:
-            new_entry_line.third = self.third
-        else:
-            new_entry_line.third = None
-        new_entry_line.amount = -1 * self.amount
-        if self.costaccounting:
-            new_entry_line.costaccounting = self.costaccounting
-        else:
-            new_entry_line.costaccounting = None
-        new_entry_line.reference = self.reference
-        return new_entry_line.get_serial()
+        return encode_serial_line(-1 * int(time.time() * 60), self.account_id, self.third_id, -1 * self.amount, self.costaccounting_id, None, self.reference)
 
     @property
     def has_account(self):
@@ -1688,11 +2302,16 @@ class EntryLineAccount(LucteriosModel):
                     pass
                 self.multilink = None
 
-    def delete(self):
+    def delete(self, with_balance=True):
         self.unlink()
+        if not with_balance:
+            return LucteriosModel.delete(self)
+        balance_entries = ChartsAccountBalance.before_line_change(self, removing=True)
+        EntryLineDayBalance.add_entrylines(EntryLineAccount.objects.filter(id=self.id), -1)
         LucteriosModel.delete(self)
+        ChartsAccountBalance.after_line_change(self, balance_entries)
 
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None, check_integrity=True):
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None, check_integrity=True, with_balance=True):
         if self.id == 0:
             self.id = None
         if (self.account.type_of_account not in (3, 4, 5)) and (self.costaccounting is not None):
@@ -1701,7 +2320,44 @@ class EntryLineAccount(LucteriosModel):
             raise LucteriosException(IMPORTANT, _('The cost accounting "%s" is closed !') % self.costaccounting)
         if check_integrity and (self.costaccounting is not None) and (self.costaccounting.year is not None) and (self.costaccounting.year != self.entry.year):
             raise LucteriosException(IMPORTANT, _('The cost accounting "%s" has another year!') % self.costaccounting)
-        return LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        if not with_balance:
+            # balances updated by the caller for the whole entry
+            return LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        balance_entries = ChartsAccountBalance.before_line_change(self)
+        if self.id is not None:
+            EntryLineDayBalance.add_entrylines(EntryLineAccount.objects.filter(id=self.id), -1)
+        res = LucteriosModel.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        ChartsAccountBalance.after_line_change(self, balance_entries)
+        EntryLineDayBalance.add_entrylines(EntryLineAccount.objects.filter(id=self.id), 1)
+        return res
+
+    @classmethod
+    def update_with_daybalance(cls, entryline_ids, **values):
+        nb_update = 0
+        for idx in range(0, len(entryline_ids), 500):
+            entrylines = cls.objects.filter(id__in=entryline_ids[idx:idx + 500])
+            EntryLineDayBalance.add_entrylines(entrylines, -1)
+            nb_update += entrylines.update(**values)
+            EntryLineDayBalance.add_entrylines(entrylines, 1)
+        return nb_update
+
+    @classmethod
+    def bulk_create_lines(cls, new_lines):
+        if connection.features.can_return_rows_from_bulk_insert:
+            cls.objects.bulk_create(new_lines, batch_size=500)
+            new_ids = [new_line.id for new_line in new_lines]
+            for idx in range(0, len(new_ids), 500):
+                ChartsAccountBalance.add_entrylines(cls.objects.filter(id__in=new_ids[idx:idx + 500]), 1)
+                EntryLineDayBalance.add_entrylines(cls.objects.filter(id__in=new_ids[idx:idx + 500]), 1)
+            bump_ledger_version()
+        else:
+            for new_line in new_lines:
+                new_line.save(check_integrity=False, with_balance=False)
+            new_ids = [new_line.id for new_line in new_lines]
+            for idx in range(0, len(new_ids), 500):
+                ChartsAccountBalance.add_entrylines(cls.objects.filter(id__in=new_ids[idx:idx + 500]), 1)
+                EntryLineDayBalance.add_entrylines(cls.objects.filter(id__in=new_ids[idx:idx + 500]), 1)
+        return new_lines
 
     class Meta(object):
         verbose_name = _('entry line of account')
@@ -1936,6 +2592,9 @@ class Budget(LucteriosModel):
         ordering = ['code']
 
 
+CONVERT_SCHEMA_VERSION = 1
+
+
 def is_with_VAT():
     return Params.getvalue("accounting-VAT-arrangements") != FiscalYear.VAT_ARRANGEMENTS_NOT_APPLICABLE
 
@@ -1944,25 +2603,24 @@ def add_vat_info():
     return _(' (duty free)') if is_with_VAT() else ''
 
 
-def check_accountingcost():
-    for entry in EntryAccount.objects.filter(costaccounting_id__gt=0, year__status__in=(FiscalYear.STATUS_BUILDING, FiscalYear.STATUS_RUNNING)):
-        try:
-            if (entry.costaccounting.status == CostAccounting.STATUS_CLOSED) and not entry.close:
-                entry.costaccounting = None
-                entry.save()
-        except ObjectDoesNotExist:
-            entry.costaccounting = None
-            entry.save()
-    entryline_cmp = 0
-    for entryline in EntryLineAccount.objects.filter(costaccounting_id__isnull=True, entry__costaccounting_id__isnull=False, account__type_of_account__in=(ChartsAccount.TYPE_REVENUE, ChartsAccount.TYPE_EXPENSE, ChartsAccount.TYPE_CONTRAACCOUNTS)).distinct():
-        entryline.costaccounting_id = entryline.entry.costaccounting_id
-        entryline.save(check_integrity=False)
-        entryline_cmp += 1
-    if entryline_cmp > 0:
-        getLogger("diacamma.accounting").info(' * convert costaccounting: nb=%d', entryline_cmp)
-
-
-def check_accountlink():
+def check_accountingcost(last_id=0):
+    new_last_id = EntryLineAccount.objects.aggregate(Max('id'))['id__max'] or 0
+    entries = EntryAccount.objects.filter(costaccounting_id__gt=0, year__status__in=(FiscalYear.STATUS_BUILDING, FiscalYear.STATUS_RUNNING))
+    entry_cmp = entries.exclude(costaccounting_id__in=CostAccounting.objects.values('id')).update(costaccounting=None)
+    entry_cmp += entries.filter(costaccounting__status=CostAccounting.STATUS_CLOSED, close=False).update(costaccounting=None)
+    entry_costaccounting = EntryAccount.objects.filter(id=OuterRef('entry_id')).values('costaccounting_id')
+    entryline_ids = list(EntryLineAccount.objects.filter(id__gt=last_id, id__lte=new_last_id, costaccounting_id__isnull=True, entry__costaccounting_id__isnull=False,
+                                                         account__type_of_account__in=(ChartsAccount.TYPE_REVENUE, ChartsAccount.TYPE_EXPENSE, ChartsAccount.TYPE_CONTRAACCOUNTS)).values_list('id', flat=True))
+    entryline_cmp = EntryLineAccount.update_with_daybalance(entryline_ids, costaccounting_id=Subquery(entry_costaccounting[:1]))
+    if (entry_cmp + entryline_cmp) > 0:
+        bump_ledger_version()
+        getLogger("diacamma.accounting").info(' * convert costaccounting: nb=%d', entry_cmp + entryline_cmp)
+    return new_last_id
+
+
+def check_accountlink(version=0):
+    if version >= CONVERT_SCHEMA_VERSION:
+        return version
     new_link = 0
     old_link = 0
     account_link_list = list(AccountLink.objects.filter(entryaccount__isnull=False))
@@ -1994,6 +2652,7 @@ def check_accountlink():
         else:
             addon_linked = 0
         getLogger("diacamma.accounting").info(' * convert AccountLink: old= %d / new= %d + %d', old_link, new_link, addon_linked)
+    return CONVERT_SCHEMA_VERSION
 
 
 def pre_save_datadb(sender, **kwargs):
@@ -2060,6 +2719,7 @@ def accounting_checkparam():
     Parameter.check_and_create(name="accounting-lettering-check", typeparam=Parameter.TYPE_STRING, title=_("accounting-lettering-check"), args="{'Multi':True}", value='',
                                meta='("accounting","ChartsAccount","import diacamma.accounting.tools;django.db.models.Q(code__regex=diacamma.accounting.tools.current_system_account().get_third_mask()) & django.db.models.Q(year__is_actif=True)", "code", False)')
     Parameter.check_and_create(name='accounting-datecurrent', typeparam=Parameter.TYPE_BOOL, title=_("accounting-datecurrent"), args="{}", value='True')
+    Parameter.check_and_create(name='accounting-convert-watermarks', typeparam=Parameter.TYPE_STRING, title=_("accounting-convert-watermarks"), args="{'Multi':False}", value='{}')
     Parameter.check_and_create(name='accounting-VAT-arrangements', typeparam=Parameter.TYPE_SELECT, title=_("accounting-VAT-arrangements"),
                                args="{'Enum':2, 'Min':0}", value='-1', param_titles=(_("accounting-VAT-arrangements.-1"), _("accounting-VAT-arrangements.0"), _("accounting-VAT-arrangements.1")))
 
@@ -2073,8 +2733,9 @@ def accounting_checkparam():
                                     Third.get_permission(True, False, False), EntryAccount.get_permission(True, False, False))
 
 
-def check_total_income():
-    for year in FiscalYear.objects.all().order_by('end'):
+def check_total_income(last_id=0):
+    years = list(FiscalYear.objects.filter(id__gt=last_id).order_by('end'))
+    for year in years:
         try:
             year.check_report()
         except Exception:
@@ -2082,22 +2743,33 @@ def check_total_income():
         entries = year.get_result_entries()
         if (len(entries) == 1) and (entries[0].entrylineaccount_set.count() == 1):
             current_system_account()._add_total_income_entrylines(year, entries[0])
+    new_last_id = last_id
+    for year in sorted(years, key=lambda year: year.id):
+        if year.status != FiscalYear.STATUS_FINISHED:
+            break
+        new_last_id = year.id
+    return new_last_id
 
 
-def check_yearaccount():
-    for entryline in EntryLineAccount.objects.exclude(Q(entry__year=F("account__year"))):  # check link between year of entry and year of account code
+def check_yearaccount(last_id=0):
+    new_last_id = EntryLineAccount.objects.aggregate(Max('id'))['id__max'] or 0
+    for entryline in EntryLineAccount.objects.filter(id__gt=last_id, id__lte=new_last_id).exclude(Q(entry__year=F("account__year"))):  # check link between year of entry and year of account code
         entryline.account = entryline.entry.year.getorcreate_chartaccount(entryline.account.code, entryline.account.name, entryline.account.rubric)
         entryline.save()
+    return new_last_id
 
 
 def check_third():
-    for entryline in EntryLineAccount.objects.filter(Q(third__isnull=False) & ~Q(account__code__regex=current_system_account().get_third_mask())):
-        entryline.third = None
-        entryline.save()
+    entryline_ids = list(EntryLineAccount.objects.filter(third__isnull=False).exclude(account__flag_third=True).values_list('id', flat=True))
+    nb_third = EntryLineAccount.update_with_daybalance(entryline_ids, third=None)
+    if nb_third > 0:
+        bump_ledger_version()
+        getLogger("diacamma.accounting").info(' * remove third of no-third lines: nb=%d', nb_third)
 
 
-def check_multilink():
-    for link in AccountLink.objects.filter(entrylineaccount__multilink__isnull=False).exclude(entrylineaccount__entry__year__status=FiscalYear.STATUS_FINISHED):
+def check_multilink(last_id=0):
+    new_last_id = AccountLink.objects.aggregate(Max('id'))['id__max'] or 0
+    for link in AccountLink.objects.filter(id__gt=last_id, id__lte=new_last_id, entrylineaccount__multilink__isnull=False).exclude(entrylineaccount__entry__year__status=FiscalYear.STATUS_FINISHED):
         lines = link.entrylineaccount_set.all()
         if len(set([line.entry.year for line in lines])) == 1:
             firstline = lines.first()
@@ -2109,6 +2781,7 @@ def check_multilink():
                     pass
                 firstline.multilink = None
     AccountLink.fill_emptydate()
+    return new_last_id
 
 
 def check_prefixyear():
@@ -2126,17 +2799,65 @@ def check_vat_arrangements():
             Params.setvalue("accounting-VAT-arrangements", vat_arrangements_ret[0])
 
 
+def check_accountbalance(version=0):
+    if version < CONVERT_SCHEMA_VERSION:
+        nb_balance = ChartsAccountBalance.rebuild()
+        getLogger("diacamma.accounting").info(' * rebuild balance of accounts: nb=%d', nb_balance)
+    else:
+        for year_id in ChartsAccountBalance.get_unbalanced_years():
+            nb_balance = ChartsAccountBalance.rebuild(year_id)
+            getLogger("diacamma.accounting").info(' * rebuild balance of accounts for year #%d: nb=%d', year_id, nb_balance)
+    return CONVERT_SCHEMA_VERSION
+
+
+def check_daybalance(version=0):
+    if version < CONVERT_SCHEMA_VERSION:
+        nb_balance = EntryLineDayBalance.rebuild()
+        getLogger("diacamma.accounting").info(' * rebuild daily balance of accounts: nb=%d', nb_balance)
+    else:
+        for year_id in EntryLineDayBalance.get_unbalanced_years():
+            nb_balance = EntryLineDayBalance.rebuild(year_id)
+            getLogger("diacamma.accounting").info(' * rebuild daily balance of accounts for year #%d: nb=%d', year_id, nb_balance)
+    return CONVERT_SCHEMA_VERSION
+
+
+def check_accountletter():
+    nb_letter = AccountLink.fill_emptyletter()
+    getLogger("diacamma.accounting").info(' * fill letter of account links: nb=%d', nb_letter)
+
+
+def get_convert_watermarks():
+    try:
+        watermarks = loads(Params.getvalue('accounting-convert-watermarks'))
+    except (LucteriosException, ValueError, TypeError):
+        watermarks = {}
+    return watermarks if isinstance(watermarks, dict) else {}
+
+
+def run_convert_step(watermarks, step_name, step_function):
+    begin = time()
+    watermark = step_function(watermarks.get(step_name, 0))
+    if watermark != watermarks.get(step_name):
+        watermarks[step_name] = watermark
+        Params.setvalue('accounting-convert-watermarks', dumps(watermarks))
+    getLogger("diacamma.accounting").info(' * convert step %s: watermark=%s in %.3fs', step_name, watermark, time() - begin)
+
+
 @Signal.decorate('convertdata')
 def accounting_convertdata():
-    check_accountingcost()
-    check_accountlink()
-    check_total_income()
-    check_yearaccount()
+    watermarks = get_convert_watermarks()
+    run_convert_step(watermarks, 'accountingcost', check_accountingcost)
+    run_convert_step(watermarks, 'accountlink', check_accountlink)
+    run_convert_step(watermarks, 'total_income', check_total_income)
+    run_convert_step(watermarks, 'yearaccount', check_yearaccount)
     check_third()
-    check_multilink()
+    run_convert_step(watermarks, 'multilink', check_multilink)
     check_prefixyear()
     EntryAccount.clear_ghost()
     check_vat_arrangements()
+    run_convert_step(watermarks, 'accountbalance', check_accountbalance)
+    run_convert_step(watermarks, 'daybalance', check_daybalance)
+    check_accountletter()
 
 
 @Signal.decorate('auditlog_register')
@@ -2155,4 +2876,30 @@ def accounting_auditlog_register():
     auditlog.register(EntryLineAccount, include_fields=['entry_account', 'debit', 'credit', 'costaccounting', 'link', 'third', 'reference'])
 
 
+def entryline_link_changed(sender, instance, **kwargs):
+    if kwargs.get('created', False) and (instance.link_id is None):
+        return
+    EntryAccount.refresh_has_link([instance.entry_id])
+
+
+def accountlink_pre_delete(sender, instance, **kwargs):
+    instance.linked_entry_ids = list(EntryLineAccount.objects.filter(link_id=instance.id).values_list('entry_id', flat=True))
+    instance.nb_lines_by_year = dict(EntryLineAccount.objects.filter(link_id=instance.id).values_list('entry__year_id').annotate(Count('id')).order_by())
+
+
+def accountlink_post_delete(sender, instance, **kwargs):
+    EntryAccount.refresh_has_link(getattr(instance, 'linked_entry_ids', []))
+    AccountLink.shift_letters(instance.id, getattr(instance, 'nb_lines_by_year', {}))
+
+
 pre_save.connect(pre_save_datadb)
+post_save.connect(clear_params_snapshot, sender=Parameter)
+request_started.connect(start_params_snapshot)
+request_finished.connect(stop_params_snapshot)
+post_save.connect(entryline_link_changed, sender=EntryLineAccount)
+post_delete.connect(entryline_link_changed, sender=EntryLineAccount)
+pre_delete.connect(accountlink_pre_delete, sender=AccountLink)
+post_delete.connect(accountlink_post_delete, sender=AccountLink)
+for ledger_model in (EntryLineAccount, EntryAccount, Budget, ChartsAccount, AccountLink):
+    post_save.connect(bump_ledger_version, sender=ledger_model)
+    post_delete.connect(bump_ledger_version, sender=ledger_model)
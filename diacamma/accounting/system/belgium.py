@@ -947,14 +947,34 @@ GENERAL_CHARTS_ACCOUNT = [
     ("794", "Intervention d'associés (ou du propriétaire) dans la perte", 3)]
 
 
+GENERAL_PATTERN = re.compile(GENERAL_MASK)
+
+
+def _build_charts_index(charts_list):
+    # positions of charts in list by prefix
+    charts_index = {}
+    for chart_idx, chart_item in enumerate(charts_list):
+        charts_index.setdefault(chart_item[0], []).append(chart_idx)
+    return charts_index
+
+
+CHARTS_INDEX = _build_charts_index(GENERAL_CHARTS_ACCOUNT)
+CHARTS_PREFIX_SIZES = sorted(set([len(chart_item[0]) for chart_item in GENERAL_CHARTS_ACCOUNT]))
+
+
 def find_charts(code):
-    current_charts = None
-    for chart_item in GENERAL_CHARTS_ACCOUNT:
-        if code[:len(chart_item[0])] == chart_item[0]:
-            current_charts = chart_item
-        elif current_charts is not None:
+    matching_idx = set()
+    for prefix_size in CHARTS_PREFIX_SIZES:
+        if prefix_size > len(code):
             break
-    return current_charts
+        matching_idx.update(CHARTS_INDEX.get(code[:prefix_size], []))
+    if len(matching_idx) == 0:
+        return None
+    # last chart of the first run of consecutive matching charts in list
+    chart_idx = min(matching_idx)
+    while (chart_idx + 1) in matching_idx:
+        chart_idx += 1
+    return GENERAL_CHARTS_ACCOUNT[chart_idx]
 
 
 class BelgiumSystemAcounting(DefaultSystemAccounting):
@@ -1014,12 +1034,11 @@ class BelgiumSystemAcounting(DefaultSystemAccounting):
         code = code.strip()
         if code == '':
             return '', -1
-        pattern = re.compile(GENERAL_MASK)
-        if pattern.match(code):
+        if GENERAL_PATTERN.match(code):
             current_charts = find_charts(code)
             if current_charts is not None:
                 return current_charts[1], current_charts[2]
         return '', -2
 
-    def get_export_xmlfiles(self):
+    def get_export_xsdfile(self):
         return None
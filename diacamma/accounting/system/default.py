@@ -32,9 +32,14 @@ from django.db.models.aggregates import Sum
 from django.db.models import Q
 
 from lucterios.framework.xferadvance import TITLE_OK, TITLE_CANCEL
-from lucterios.framework.error import LucteriosException
+from lucterios.framework.error import LucteriosException, IMPORTANT
 
-from diacamma.accounting.tools import get_amount_from_format_devise, correct_accounting_code
+from diacamma.accounting.tools import get_amount_from_format_devise, correct_accounting_code, get_amount_sum, currency_round
+
+# stored classification flag of account code => mask of accounting system
+CLASSIFICATION_MASKS = (('flag_cash', 'get_cash_mask'), ('flag_customer', 'get_customer_mask'), ('flag_provider', 'get_provider_mask'),
+                        ('flag_employed', 'get_employed_mask'), ('flag_societary', 'get_societary_mask'), ('flag_third', 'get_third_mask'),
+                        ('flag_vat_collected', 'get_vat_collected_mask'), ('flag_vat_deductible', 'get_vat_deductible_mask'), ('flag_annexe', 'get_annexe_mask'))
 
 
 class DefaultSystemAccounting(object):
@@ -88,6 +93,16 @@ class DefaultSystemAccounting(object):
     def new_charts_account(self, code):
         return '', -1
 
+    def get_compiled_masks(self):
+        current_class = type(self)
+        if '_compiled_masks' not in current_class.__dict__:
+            current_class._compiled_masks = {flag_name: re.compile(getattr(self, mask_method)()) for flag_name, mask_method in CLASSIFICATION_MASKS}
+        return current_class._compiled_masks
+
+    def get_code_classification(self, code, flag_names):
+        compiled_masks = self.get_compiled_masks()
+        return {flag_name: compiled_masks[flag_name].search(code) is not None for flag_name in flag_names}
+
     def get_vat_deductible_mask(self):
         return ''
 
@@ -178,9 +193,14 @@ class DefaultSystemAccounting(object):
             return xfer.confirme(text)
 
     def _add_total_income_entrylines(self, year, new_entry):
-        for chart_account in year.chartsaccount_set.filter(type_of_account__in=(3, 4, 5)).order_by('code'):
-            if abs(chart_account.current_validated) > 1e-4:
-                new_entry.add_entry_line(-1 * chart_account.get_current_validated(False), chart_account.code)
+        from diacamma.accounting.models import ChartsAccountBalance, EntryLineAccount
+        balances = ChartsAccountBalance.objects.filter(year=year, validated=True, account__type_of_account__in=(3, 4, 5)).exclude(bucket=ChartsAccountBalance.BUCKET_RESULT)
+        new_lines = []
+        for balance in balances.values('account_id', 'account__code').annotate(Sum('amount')).order_by('account__code'):
+            amount = currency_round(get_amount_sum(balance))
+            if abs(amount) > 1e-4:
+                new_lines.append(EntryLineAccount(entry=new_entry, account_id=balance['account_id'], amount=-1 * amount))
+        EntryLineAccount.bulk_create_lines(new_lines)
 
     def _create_result_entry(self, year):
         revenue = year.total_revenue
@@ -195,15 +215,10 @@ class DefaultSystemAccounting(object):
                 new_entry.add_entry_line(revenue - expense, self.POSITIF_ACCOUNT)
             new_entry.closed(check_needcost=False)
 
-    def _add_sumline_in_account(self, last_account_id, sum_account, new_entry):
+    def _add_sumline_in_account(self, last_account_id, sum_account, new_entry, new_lines):
         from diacamma.accounting.models import EntryLineAccount
         if abs(sum_account) > 0.0001:
-            new_line = EntryLineAccount()
-            new_line.entry = new_entry
-            new_line.account_id = last_account_id
-            new_line.amount = sum_account
-            new_line.third = None
-            new_line.save()
+            new_lines.append(EntryLineAccount(entry=new_entry, account_id=last_account_id, amount=sum_account, third=None))
             return True
         return False
 
@@ -212,42 +227,43 @@ class DefaultSystemAccounting(object):
         from lucterios.CORE.parameters import Params
 
         new_entry = EntryAccount.objects.create(year=year, journal_id=5, designation=self.CLOSE_TITLE_THIRD, date_value=year.end)
+        new_lines = []
         nolettering_account = ChartsAccount.objects.filter(year=year, code__in=Params.getvalue("accounting-lettering-check")).order_by('code').distinct()
+        amounts_by_account = {}
+        for amount_and_third in EntryLineAccount.objects.filter(account__in=nolettering_account).values('account_id', 'third').annotate(amount=Sum('amount')).order_by('account__code', 'third'):
+            amounts_by_account.setdefault(amount_and_third['account_id'], []).append(amount_and_third)
         for account_item in nolettering_account:
-            amounts_by_third = EntryLineAccount.objects.filter(Q(account=account_item)).order_by('third').values('third').annotate(amount=Sum('amount'))
+            amounts_by_third = amounts_by_account.get(account_item.id, [])
             sum_account = reduce(lambda item1, item2: item1 + item2, [float(item['amount']) for item in amounts_by_third], 0.0)
-            self._add_sumline_in_account(account_item.id, sum_account, new_entry)
+            self._add_sumline_in_account(account_item.id, sum_account, new_entry, new_lines)
             for amount_and_third in amounts_by_third:
-                new_line = EntryLineAccount()
-                new_line.entry = new_entry
-                new_line.amount = -1 * float(amount_and_third['amount'])
-                new_line.account = account_item
-                new_line.third_id = amount_and_third['third']
-                new_line.save()
+                new_lines.append(EntryLineAccount(entry=new_entry, amount=-1 * float(amount_and_third['amount']), account_id=account_item.id, third_id=amount_and_third['third']))
 
         last_account_id = None
         sum_account = 0.0
-        for entry_line in EntryLineAccount.objects.filter(account__code__regex=self.get_third_mask(), account__year=year, link__isnull=True, third__isnull=False).exclude(account__in=nolettering_account).order_by('account'):
-            if last_account_id != entry_line.account_id:
-                if self._add_sumline_in_account(last_account_id, sum_account, new_entry):
+        link_lines = []
+        open_lines = EntryLineAccount.objects.filter(account__flag_third=True, account__year=year, link__isnull=True, third__isnull=False).exclude(account__in=nolettering_account)
+        for entry_line_id, account_id, third_id, amount, reference, designation in open_lines.values_list('id', 'account_id', 'third_id', 'amount', 'reference', 'entry__designation').order_by('account', 'id').iterator(chunk_size=2000):
+            if last_account_id != account_id:
+                if self._add_sumline_in_account(last_account_id, sum_account, new_entry, new_lines):
                     sum_account = 0
-            last_account_id = entry_line.account_id
-            new_line = EntryLineAccount()
-            new_line.entry = new_entry
-            new_line.amount = -1 * entry_line.amount
-            new_line.account_id = entry_line.account_id
-            new_line.third_id = entry_line.third_id
-            if (entry_line.reference is not None) and (entry_line.reference != ''):
-                new_line.reference = entry_line.reference
+            last_account_id = account_id
+            new_line = EntryLineAccount(entry=new_entry, amount=-1 * amount, account_id=account_id, third_id=third_id)
+            if (reference is not None) and (reference != ''):
+                new_line.reference = reference
             else:
-                new_line.reference = entry_line.entry.designation
-            new_line.save()
-            AccountLink.create_link([new_line, entry_line])
-            sum_account += float(entry_line.amount)
+                new_line.reference = designation
+            new_lines.append(new_line)
+            link_lines.append((new_line, entry_line_id))
+            sum_account += float(amount)
+        self._add_sumline_in_account(last_account_id, sum_account, new_entry, new_lines)
+        EntryLineAccount.bulk_create_lines(new_lines)
+        for link_error in AccountLink.create_links([[new_line.id, entry_line_id] for new_line, entry_line_id in link_lines]):
+            if link_error is not None:
+                raise LucteriosException(IMPORTANT, link_error)
         if last_account_id == 0:
             new_entry.delete()
         else:
-            self._add_sumline_in_account(last_account_id, sum_account, new_entry)
             new_entry.closed()
 
     def finalize_year(self, year):
@@ -287,17 +303,20 @@ class DefaultSystemAccounting(object):
                         multilinks_to_transfere[multilink].append(new_entry_line)
                         multilinks_to_transfere[multilink].extend(EntryLineAccount.objects.filter(entry__year=year, multilink=multilink).distinct())
             new_entry.closed()
+            multilinks_to_link = []
             for multilink, entrylines_to_link in multilinks_to_transfere.items():
                 if len(entrylines_to_link) > 1:
-                    try:
-                        AccountLink.create_link(entrylines_to_link)
-                        multilink.delete()
-                    except LucteriosException:
-                        bad_link_third.append(str(entrylines_to_link[0].third))
-                        getLogger("diacamma.accounting").warning("Bad balanced entry lines : %s" % entrylines_to_link)
+                    multilinks_to_link.append((multilink, entrylines_to_link))
                 else:
                     bad_link_third.append(str(entrylines_to_link[0].third))
                     getLogger("diacamma.accounting").warning("Bad entry lines : %s" % entrylines_to_link)
+            link_errors = AccountLink.create_links([entrylines_to_link for _multilink, entrylines_to_link in multilinks_to_link])
+            for (multilink, entrylines_to_link), link_error in zip(multilinks_to_link, link_errors):
+                if link_error is None:
+                    multilink.delete()
+                else:
+                    bad_link_third.append(str(entrylines_to_link[0].third))
+                    getLogger("diacamma.accounting").warning("Bad balanced entry lines : %s" % entrylines_to_link)
         if len(bad_link_third) > 0:
             return _('Link problem for: {[br]} - %s{[br]}') % '{[br]} - '.join(bad_link_third)
         else:
@@ -311,8 +330,8 @@ class DefaultSystemAccounting(object):
 
     def fill_fiscalyear_balancesheet(self, grid, currentfilter, lastfilter):
         from diacamma.accounting.tools_reports import convert_query_to_account, add_cell_in_grid, add_item_in_grid, fill_grid, get_spaces
-        cash_filter = Q(account__code__regex=self.get_cash_mask())
-        third_filter = Q(account__code__regex=self.get_third_mask())
+        cash_filter = Q(account__flag_cash=True)
+        third_filter = Q(account__flag_third=True)
 
         left_line_idx = 0
         actif1 = Q(account__type_of_account=0) & ~cash_filter & ~third_filter
@@ -399,5 +418,11 @@ class DefaultSystemAccounting(object):
         if show_right:
             add_cell_in_grid(grid, line_idx, 'right', get_spaces(5) + "{[i]}{[b]}%s{[/b]}{[/i]}" % _('result (profit)'))
 
-    def get_export_xmlfiles(self):
+    def get_export_xsdfile(self):
         return None
+
+    def write_export_xml(self, year, xml_file):
+        raise LucteriosException(IMPORTANT, _('No export for this accounting system!'))
+
+    def iter_export_fec(self, year, separator='\t'):
+        raise LucteriosException(IMPORTANT, _('No export for this accounting system!'))
@@ -19,6 +19,9 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 from __future__ import unicode_literals
 import re
+from bisect import bisect_right
+from itertools import groupby
+from lxml import etree
 
 from diacamma.accounting.system.default import DefaultSystemAccounting
 from os.path import dirname, join
@@ -174,13 +177,31 @@ GENERAL_CHARTS_ACCOUNT = [
     ("89", "89999999", "Bilan", 5)]
 
 
+GENERAL_PATTERN = re.compile(GENERAL_MASK)
+
+
+def _build_charts_index(charts_list):
+    # elementary intervals between bounds of charts, each one resolved to the first chart covering it
+    bounds = sorted(set([chart_item[0] for chart_item in charts_list] + [chart_item[1] + '\x00' for chart_item in charts_list]))
+    resolved = []
+    for bound in bounds:
+        current_charts = None
+        for chart_item in charts_list:
+            if (chart_item[0] <= bound) and (bound <= chart_item[1]):
+                current_charts = chart_item
+                break
+        resolved.append(current_charts)
+    return bounds, resolved
+
+
+CHARTS_INDEX = _build_charts_index(GENERAL_CHARTS_ACCOUNT)
+
+
 def find_charts(code):
-    current_charts = None
-    for chart_item in GENERAL_CHARTS_ACCOUNT:
-        if (chart_item[0] <= code) and (code <= chart_item[1]):
-            current_charts = chart_item
-            break
-    return current_charts
+    bound_idx = bisect_right(CHARTS_INDEX[0], code) - 1
+    if bound_idx < 0:
+        return None
+    return CHARTS_INDEX[1][bound_idx]
 
 
 class FrenchSystemAcounting(DefaultSystemAccounting):
@@ -237,13 +258,104 @@ class FrenchSystemAcounting(DefaultSystemAccounting):
         code = code.strip()
         if code == '':
             return '', -1
-        pattern = re.compile(GENERAL_MASK)
-        if pattern.match(code):
+        if GENERAL_PATTERN.match(code):
             current_charts = find_charts(code)
             if current_charts is not None:
                 return current_charts[2], current_charts[3]
         return '', -2
 
-    def get_export_xmlfiles(self):
-        file_path = dirname(__file__)
-        return (join(file_path, 'french_accountexport.xml'), join(file_path, 'french_fichedescriptive_6709.xsd'))
+    def get_export_xsdfile(self):
+        return join(dirname(__file__), 'french_fichedescriptive_6709.xsd')
+
+    def _add_export_element(self, parent, tag, value=None):
+        new_element = etree.SubElement(parent, tag)
+        new_element.text = '' if value is None else str(value)
+        return new_element
+
+    def _get_export_entry(self, entry, entry_lines, third_names):
+        ecriture = etree.Element('ecriture')
+        self._add_export_element(ecriture, 'EcritureNum', entry.num)
+        self._add_export_element(ecriture, 'EcritureDate', entry.date_value.isoformat())
+        self._add_export_element(ecriture, 'EcritureLib', entry.designation)
+        self._add_export_element(ecriture, 'PieceRef')
+        self._add_export_element(ecriture, 'PieceDate', entry.date_value.isoformat())
+        if entry.link is not None:
+            self._add_export_element(ecriture, 'EcritureLet', entry.link)
+        date_entry = entry.date_entry.isoformat() if entry.date_entry is not None else None
+        self._add_export_element(ecriture, 'ValidDate', date_entry)
+        self._add_export_element(ecriture, 'DateRglt', date_entry)
+        self._add_export_element(ecriture, 'ModeRglt')
+        for line in entry_lines:
+            ligne = etree.SubElement(ecriture, 'ligne')
+            self._add_export_element(ligne, 'CompteNum', line.account.code)
+            self._add_export_element(ligne, 'CompteLib', line.account.name)
+            if line.third_id is not None:
+                if line.third_id not in third_names:
+                    third_names[line.third_id] = str(line.third)
+                self._add_export_element(ligne, 'CompAuxLib', third_names[line.third_id])
+            self._add_export_element(ligne, 'Debit', line.get_debit())
+            self._add_export_element(ligne, 'Credit', line.get_credit())
+        if len(entry_lines) == 1:
+            ligne = etree.SubElement(ecriture, 'ligne')
+            self._add_export_element(ligne, 'CompteLib')
+            self._add_export_element(ligne, 'Debit', 0)
+        return ecriture
+
+    FEC_FIELDS = ('JournalCode', 'JournalLib', 'EcritureNum', 'EcritureDate', 'CompteNum', 'CompteLib', 'CompAuxNum', 'CompAuxLib', 'PieceRef',
+                  'PieceDate', 'EcritureLib', 'Debit', 'Credit', 'EcritureLet', 'DateLet', 'ValidDate', 'Montantdevise', 'Idevise')
+
+    def _get_fec_text(self, value, separator):
+        if value is None:
+            return ''
+        return str(value).replace(separator, ' ').replace('\r', ' ').replace('\n', ' ')
+
+    def _get_fec_date(self, value):
+        return value.strftime('%Y%m%d') if value is not None else ''
+
+    def _get_fec_amount(self, value, prec):
+        return ('%.*f' % (prec, value)).replace('.', ',')
+
+    def iter_export_fec(self, year, separator='\t'):
+        from lucterios.CORE.parameters import Params
+        from diacamma.accounting.models import Journal, EntryLineAccount
+        prec = Params.getvalue("accounting-devise-prec")
+        journal_names = dict(Journal.objects.values_list('id', 'name'))
+        third_names = {}
+        yield separator.join(self.FEC_FIELDS) + '\n'
+        entrylines = EntryLineAccount.objects.filter(entry__year=year, entry__close=True).select_related('entry', 'account', 'link')
+        for line in entrylines.order_by('entry__num', 'entry_id', 'account__code', 'id').iterator(chunk_size=2000):
+            if (line.third_id is not None) and (line.third_id not in third_names):
+                third_names[line.third_id] = self._get_fec_text(line.third, separator)
+            entry = line.entry
+            yield separator.join([str(entry.journal_id), self._get_fec_text(journal_names.get(entry.journal_id), separator),
+                                  str(entry.num), self._get_fec_date(entry.date_value),
+                                  self._get_fec_text(line.account.code, separator), self._get_fec_text(line.account.name, separator),
+                                  str(line.third_id) if line.third_id is not None else '', third_names.get(line.third_id, ''),
+                                  self._get_fec_text(line.reference if line.reference else entry.num, separator), self._get_fec_date(entry.date_value),
+                                  self._get_fec_text(entry.designation, separator),
+                                  self._get_fec_amount(line.get_debit(with_correction=False), prec), self._get_fec_amount(line.get_credit(), prec),
+                                  self._get_fec_text(line.link.letter if line.link_id is not None else None, separator),
+                                  self._get_fec_date(line.link.date_max if line.link_id is not None else None),
+                                  self._get_fec_date(entry.date_entry), '', '']) + '\n'
+
+    def write_export_xml(self, year, xml_file):
+        from diacamma.accounting.models import Journal, EntryLineAccount
+        third_names = {}
+        with etree.xmlfile(xml_file, encoding='utf-8') as xml_output:
+            xml_output.write_declaration()
+            with xml_output.element('comptabilite'):
+                with xml_output.element('exercice'):
+                    with xml_output.element('DateCloture'):
+                        xml_output.write(year.end.isoformat())
+                    for journal in Journal.objects.all():
+                        entrylines = EntryLineAccount.objects.filter(entry__year=year, entry__journal=journal, entry__close=True)
+                        if not entrylines.exists():
+                            continue
+                        with xml_output.element('journal'):
+                            with xml_output.element('JournalLib'):
+                                xml_output.write(journal.name)
+                            entrylines = entrylines.select_related('entry', 'entry__link', 'account').order_by('entry__date_value', 'entry_id', 'account__code', 'third_id')
+                            for _entry_id, entry_lines in groupby(entrylines.iterator(chunk_size=2000), key=lambda line: line.entry_id):
+                                entry_lines = list(entry_lines)
+                                xml_output.write(self._get_export_entry(entry_lines[0].entry, entry_lines, third_names))
+                                xml_output.flush()
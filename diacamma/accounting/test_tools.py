@@ -24,6 +24,7 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import unicode_literals
 from base64 import b64encode
+from random import Random
 
 from lucterios.framework import signal_and_lock
 from lucterios.CORE.models import Parameter
@@ -33,7 +34,7 @@ from lucterios.contacts.models import Individual, LegalEntity, AbstractContact
 from lucterios.contacts.test_tools import change_ourdetail
 from lucterios.documents.models import DocumentContainer
 
-from diacamma.accounting.tools import clear_system_account
+from diacamma.accounting.tools import clear_system_account, increment_ledger_version
 from diacamma.accounting.models import Third, AccountThird, FiscalYear, \
     ChartsAccount, EntryAccount, Journal, AccountLink, \
     CostAccounting, ModelEntry, ModelLineEntry, Budget
@@ -175,6 +176,8 @@ def set_accounting_system(country='FR'):
     Parameter.change_value('accounting-system', country_list[country])
     Params.clear()
     clear_system_account()
+    # the transaction of a test case is never committed: start each test with a new ledger version
+    increment_ledger_version()
     signal_and_lock.Signal.call_signal("param_change", ['accounting-system'])
 
 
@@ -244,6 +247,47 @@ def fill_entries_fr(yearid, withyear=False):
     AccountLink.create_link(list(entry7.get_thirds()) + list(entry8.get_thirds()))
 
 
+def fill_synthetic_ledger(nb_years=1, nb_thirds=10, nb_entries=100, nb_costs=2, seed=0):
+    random = Random(seed)
+    thirds = []
+    for third_idx in range(nb_thirds):
+        contact = create_individual('first%d' % third_idx, 'last%d' % third_idx)
+        create_third([contact.id], ['411', '401'])
+        thirds.append(Third.objects.get(contact_id=contact.id).id)
+    default_compta_fr(status=1)
+    years = [FiscalYear.objects.get(begin='2015-01-01')]
+    for year_idx in range(1, nb_years):
+        new_year = create_year(status=1, year=2015 + year_idx, lastyear=years[-1])
+        fill_accounts_fr(new_year)
+        years.append(new_year)
+    years = list(FiscalYear.objects.filter(id__in=[year.id for year in years]).order_by('begin'))
+    years[0].set_has_actif()
+    for year in years:
+        accounts = dict(ChartsAccount.objects.filter(year=year).values_list('code', 'id'))
+        costs = [CostAccounting.objects.create(name='cost %d-%d' % (year.begin.year, cost_idx), description='synthetic cost', status=0, year=year).id for cost_idx in range(nb_costs)]
+        for code in ('601', '602', '604', '706', '707'):
+            Budget.objects.create(year=year, code=code, amount=random.randint(1000, 100000) / 100)
+        for entry_idx in range(nb_entries):
+            date_value = '%s-%02d-%02d' % (year.begin.year, random.randint(1, 12), random.randint(1, 28))
+            third_id = random.choice(thirds)
+            cost_id = random.choice(costs) if (len(costs) > 0) and (random.random() < 0.5) else 0
+            amount = random.randint(100, 500000) / 100
+            kind = entry_idx % 4
+            if kind == 0:
+                serial = '-1|%d|0|%.2f|%d|0|None|\n-2|%d|%d|%.2f|0|0|None|' % (accounts[random.choice(('706', '707'))], amount, cost_id, accounts['411'], third_id, amount)
+                add_entry(year.id, 3, date_value, 'vente %d' % entry_idx, serial, random.random() < 0.7)
+            elif kind == 1:
+                serial = '-1|%d|0|%.2f|%d|0|None|\n-2|%d|%d|%.2f|0|0|None|' % (accounts[random.choice(('601', '602', '604'))], amount, cost_id, accounts['401'], third_id, amount)
+                add_entry(year.id, 2, date_value, 'depense %d' % entry_idx, serial, random.random() < 0.7)
+            elif kind == 2:
+                serial = '-1|%d|0|%.2f|0|0|ref %d|\n-2|%d|%d|%.2f|0|0|None|' % (accounts['512'], amount, entry_idx, accounts['411'], third_id, -1 * amount)
+                add_entry(year.id, 4, date_value, 'reglement vente %d' % entry_idx, serial, random.random() < 0.7)
+            else:
+                serial = '-1|%d|0|%.2f|0|0|ref %d|\n-2|%d|%d|%.2f|0|0|None|' % (accounts['512'], -1 * amount, entry_idx, accounts['401'], third_id, -1 * amount)
+                add_entry(year.id, 4, date_value, 'reglement depense %d' % entry_idx, serial, random.random() < 0.7)
+    return years
+
+
 def check_pdfreport(testobj, year, pdfname, printclassname, modulename):
     doc = DocumentContainer.objects.filter(name=pdfname).first()
     testobj.assertTrue(doc is not None)
@@ -1126,8 +1126,8 @@ class ModelTest(LucteriosTest):
         self.assertEqual(self.response_json["action"]["id"], "diacamma.accounting/entryAccountEdit")
         self.assertEqual(len(self.response_json["action"]["params"]), 1)
         serial_entry = self.response_json["action"]["params"]['serial_entry'].split('\n')
-        self.assertEqual(serial_entry[0][-24:], "|1|3|48.430000|0|0|None|", serial_entry[0])
-        self.assertEqual(serial_entry[1][-25:], "|2|0|-48.430000|0|0|None|", serial_entry[1])
+        self.assertEqual(serial_entry[0][-20:], ",1,3,48.43,0,0,null]", serial_entry[0])
+        self.assertEqual(serial_entry[1][-21:], ",2,0,-48.43,0,0,null]", serial_entry[1])
 
     def test_insert_with_costaccounting(self):
         add_models()
@@ -1142,5 +1142,5 @@ class ModelTest(LucteriosTest):
         self.assertEqual(self.response_json["action"]["id"], "diacamma.accounting/entryAccountEdit")
         self.assertEqual(len(self.response_json["action"]["params"]), 1)
         serial_entry = self.response_json["action"]["params"]['serial_entry'].split('\n')
-        self.assertEqual(serial_entry[0][-25:], "|1|3|-37.910000|0|0|None|", serial_entry[0])
-        self.assertEqual(serial_entry[1][-25:], "|11|0|37.910000|2|0|None|", serial_entry[1])
+        self.assertEqual(serial_entry[0][-21:], ",1,3,-37.91,0,0,null]", serial_entry[0])
+        self.assertEqual(serial_entry[1][-21:], ",11,0,37.91,2,0,null]", serial_entry[1])
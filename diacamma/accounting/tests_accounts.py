@@ -22,14 +22,18 @@ from shutil import rmtree
 from importlib import import_module
 from base64 import b64decode
 from time import sleep
+from threading import Thread
 from os.path import join, dirname
 
 from django.db.models import Q
+from django.db.models.aggregates import Sum
 
 from lucterios.framework.test import LucteriosTest
 from lucterios.framework.filetools import get_user_dir
 from lucterios.framework.model_fields import LucteriosScheduler
+from lucterios.framework.signal_and_lock import Signal
 from lucterios.CORE.parameters import Params
+from lucterios.CORE.models import Parameter
 from lucterios.documents.views import DocumentSearch
 
 from diacamma.accounting.test_tools import initial_thirds_fr, default_compta_fr, fill_entries_fr, set_accounting_system, add_entry, \
@@ -38,13 +42,18 @@ from diacamma.accounting.views_accounts import ChartsAccountList, ChartsAccountD
     ChartsAccountInitial
 from diacamma.accounting.views_accounts import FiscalYearBegin, FiscalYearClose, FiscalYearReportLastYear
 from diacamma.accounting.views_entries import EntryAccountEdit, EntryAccountList
-from diacamma.accounting.models import FiscalYear
+from diacamma.accounting.models import FiscalYear, ChartsAccount, ChartsAccountBalance, AccountThird, EntryLineAccount, EntryLineDayBalance, EntryAccount, Third, \
+    check_third
 from diacamma.accounting.views import ThirdList
 from diacamma.accounting.views_budget import BudgetList, BudgetAddModify, BudgetDel
 from diacamma.payoff.test_tools import PaymentTest
-from diacamma.accounting.views_reports import FiscalYearIncomeStatement, \
+from diacamma.accounting.views_reports import FiscalYearIncomeStatement, FiscalYearAgedBalance, FiscalYearAgedBalanceLines, \
     FiscalYearBalanceSheet
+from diacamma.accounting.tools import currency_round, correct_accounting_code, format_with_devise, start_params_snapshot, stop_params_snapshot, \
+    PARAMS_SNAPSHOT, remove_scheduled_job
 from diacamma.accounting.tools_reports import get_budget_total
+from diacamma.accounting.system.french import FrenchSystemAcounting
+from diacamma.accounting.system.belgium import BelgiumSystemAcounting
 
 
 class ChartsAccountTest(LucteriosTest):
@@ -66,6 +75,71 @@ class ChartsAccountTest(LucteriosTest):
         self.assert_json_equal('LABELFORM', 'result', [230.62, 348.60, -117.98, 1050.66, 1244.74])
         self.assert_select_equal('type_of_account', {0: 'Actif', 1: 'Passif', 2: 'Capitaux', 3: 'Produit', 4: 'Charge', 5: 'Autres comptes', -1: '---'})
 
+    def test_find_charts(self):
+        french = FrenchSystemAcounting()
+        self.assertEqual(french.new_charts_account('150'), ('Provisions règlementées', 2))
+        self.assertEqual(french.new_charts_account('1599'), ('Provisions règlementées', 2))
+        self.assertEqual(french.new_charts_account('411'), ('Clients et comptes rattachés', 0))
+        self.assertEqual(french.new_charts_account('4456'), ('TVA déductible', 1))
+        self.assertEqual(french.new_charts_account('799'), ('Compte pour résultat négatif', 3))
+        self.assertEqual(french.new_charts_account('7990'), ('', -2))
+        self.assertEqual(french.new_charts_account('89'), ('', -2))
+        self.assertEqual(french.new_charts_account(''), ('', -1))
+        belgium = BelgiumSystemAcounting()
+        self.assertEqual(belgium.new_charts_account('000'), ('Créanciers, bénéficiaires de garanties de tiers', 5))
+        self.assertEqual(belgium.new_charts_account('7719'), ('Impôts belges sur le résultat', 3))
+        self.assertEqual(belgium.new_charts_account('400000'), ('Clients belges', 0))
+        self.assertEqual(belgium.new_charts_account('9000'), ('', -2))
+
+    def test_account_classification(self):
+        self.assertEqual(list(ChartsAccount.objects.filter(flag_cash=True).values_list('code', flat=True)), ['512', '531'])
+        self.assertEqual(list(ChartsAccount.objects.filter(flag_third=True).values_list('code', flat=True)), ['401', '411'])
+        self.assertEqual(list(ChartsAccount.objects.filter(flag_customer=True).values_list('code', flat=True)), ['411'])
+        self.assertEqual(ChartsAccount.objects.filter(flag_vat_deductible=True).count(), 0)
+        self.assertEqual(AccountThird.objects.filter(flag_customer=True).count(), AccountThird.objects.filter(code='411').count())
+        self.assertTrue(ChartsAccount.objects.get(code='411').is_third)
+        self.assertFalse(ChartsAccount.objects.get(code='411').is_cash)
+        new_account = ChartsAccount.objects.create(code='4456', name='TVA', type_of_account=1, year=FiscalYear.get_current())
+        self.assertTrue(new_account.flag_vat_deductible)
+        self.assertTrue(new_account.flag_third)
+
+        set_accounting_system('BE')
+        self.assertEqual(list(ChartsAccount.objects.filter(flag_vat_deductible=True).values_list('code', flat=True)), ['411'])
+        self.assertEqual(list(ChartsAccount.objects.filter(flag_customer=True).values_list('code', flat=True)), ['401'])
+        self.assertEqual(list(ChartsAccount.objects.filter(flag_provider=True).values_list('code', flat=True)), ['4456'])
+        self.assertEqual(AccountThird.objects.filter(flag_customer=True).count(), AccountThird.objects.filter(code='401').count())
+
+        set_accounting_system('FR')
+        self.assertEqual(list(ChartsAccount.objects.filter(flag_customer=True).values_list('code', flat=True)), ['411'])
+        self.assertEqual(AccountThird.objects.filter(flag_customer=True).count(), AccountThird.objects.filter(code='411').count())
+
+    def test_params_snapshot(self):
+        start_params_snapshot()
+        self.addCleanup(stop_params_snapshot)
+        self.assertEqual(currency_round(12.3456), 12.35)
+        self.assertEqual(correct_accounting_code('4110'), '411')
+        format_euro = format_with_devise(5)
+        with self.assertNumQueries(0):
+            self.assertEqual(currency_round(1.005), 1.0)
+            self.assertEqual(correct_accounting_code('70'), '700')
+            self.assertEqual(format_with_devise(5), format_euro)
+        Params.setvalue('accounting-devise-prec', 3)
+        self.assertEqual(currency_round(12.3456), 12.346)
+        self.assertEqual(format_with_devise(5), format_euro.replace('C2', 'C3'))
+        Params.setvalue('accounting-sizecode', 4)
+        self.assertEqual(correct_accounting_code('70'), '7000')
+
+        # other requests (other threads) do not share this snapshot
+        other_values = []
+        other_thread = Thread(target=lambda: other_values.append(PARAMS_SNAPSHOT.get()))
+        other_thread.start()
+        other_thread.join()
+        self.assertEqual(other_values, [None])
+        stop_params_snapshot()
+        Parameter.objects.filter(name='accounting-devise-prec').update(value='2')
+        Params.clear()
+        self.assertEqual(currency_round(12.3456), 12.35)
+
     def test_asset(self):
         self.factory.xfer = ChartsAccountList()
         self.calljson('/diacamma.accounting/chartsAccountList', {'year': '1', 'type_of_account': '0'}, False)
@@ -508,6 +582,68 @@ class ChartsAccountTest(LucteriosTest):
         self.assert_json_equal('LABELFORM', 'type_of_account', 3)
         self.assert_json_equal('LABELFORM', 'error_code', "")
 
+    def test_balance(self):
+        def get_totals():
+            return {account.code: (account.get_last_year_total(), account.get_current_total(), account.get_current_validated())
+                    for account in ChartsAccount.objects.filter(year_id=1)}
+        totals = get_totals()
+        self.assertEqual(totals['411'], (0.0, -159.98, -125.97))
+        self.assertEqual(totals['512'], (-1135.93, -1130.29, -1130.29))
+        self.assertEqual(totals['401'], (0.0, 78.24, 0.0))
+        self.assertEqual(totals['707'], (0.0, 230.62, 196.61))
+
+        ChartsAccountBalance.objects.all().update(amount=0.0)
+        self.assertEqual(ChartsAccountBalance.rebuild(), 15)
+        self.assertEqual(get_totals(), totals)
+
+        self.factory.xfer = EntryAccountEdit()
+        self.calljson('/diacamma.accounting/entryAccountEdit', {'year': '1', 'journal': '3', 'entryaccount': '10', 'SAVE': 'YES',
+                                                                 'date_value': '2015-02-24', 'designation': 'vente 3'}, False)
+        ChartsAccountBalance.objects.filter(account__code='707').delete()
+        ChartsAccountBalance.rebuild(FiscalYear.objects.get(id=1))
+        self.assertEqual(get_totals(), totals)
+
+    def test_daybalance(self):
+        def get_line_totals(current_date):
+            return {code: round(value, 2) for code, value in EntryLineAccount.objects.filter(entry__date_value__lte=current_date).values_list('account__code').annotate(Sum('amount')) if abs(value) > 0.0001}
+
+        def get_day_totals(current_date):
+            return {val['account__code']: round(val['debit_sum'] + val['credit_sum'], 2) for val in EntryLineDayBalance.get_balances(Q(), current_date, ('account__code', ))
+                    if abs(val['debit_sum'] + val['credit_sum']) > 0.0001}
+        self.assertEqual(EntryLineDayBalance.check_balances(), [])
+        for current_date in ('2015-02-01', '2015-02-20', '2015-02-21', '2015-12-31'):
+            self.assertEqual(get_day_totals(current_date), get_line_totals(current_date), current_date)
+        movements = {val['account__code']: round(val['debit_sum'] + val['credit_sum'], 2) for val in EntryLineDayBalance.get_movements(Q(), '2015-02-16', '2015-02-22', ('account__code', ))}
+        self.assertEqual(movements['707'], round(EntryLineAccount.objects.filter(account__code='707', entry__date_value__gte='2015-02-16', entry__date_value__lte='2015-02-22').aggregate(Sum('amount'))['amount__sum'], 2))
+        third = Third.objects.get(id=4)
+        self.assertAlmostEqual(third.get_total('2015-02-20'), third.get_total('2015-02-20', ignore_close=True), delta=0.0001)
+        self.assertAlmostEqual(third.get_total('2015-12-31'), third.get_total(), delta=0.0001)
+
+        self.factory.xfer = EntryAccountEdit()
+        self.calljson('/diacamma.accounting/entryAccountEdit', {'year': '1', 'journal': '3', 'entryaccount': '10', 'SAVE': 'YES',
+                                                                 'date_value': '2015-02-24', 'designation': 'vente 3'}, False)
+        self.assertEqual(EntryLineDayBalance.check_balances(), [])
+        self.assertEqual(get_day_totals('2015-02-23'), get_line_totals('2015-02-23'))
+        EntryAccount.objects.get(id=10).delete()
+        self.assertEqual(EntryLineDayBalance.check_balances(), [])
+
+        EntryLineDayBalance.objects.filter(account__code='707').update(total_debit=0.0)
+        self.assertEqual(len(EntryLineDayBalance.check_balances()) > 0, True)
+        nb_balance = EntryLineDayBalance.rebuild(FiscalYear.objects.get(id=1))
+        self.assertEqual(EntryLineDayBalance.check_balances(), [])
+        self.assertEqual(EntryLineDayBalance.objects.count(), nb_balance)
+
+    def test_daybalance_convert(self):
+        entry = EntryAccount.objects.get(id=1)
+        line = entry.add_entry_line(12.34, '607', third=Third.objects.get(id=4))
+        entry.add_entry_line(-12.34, '512')
+        self.assertEqual(EntryLineDayBalance.objects.filter(account__code='607', third_id=4).count(), 1)
+        self.assertEqual(EntryLineDayBalance.check_balances(), [])
+        check_third()
+        self.assertEqual(EntryLineAccount.objects.get(id=line.id).third_id, None)
+        self.assertEqual(EntryLineDayBalance.objects.filter(account__code='607', third_id=4).count(), 0)
+        self.assertEqual(EntryLineDayBalance.check_balances(), [])
+
 
 class FiscalYearWorkflowTest(PaymentTest):
 
@@ -949,6 +1085,73 @@ class FiscalYearWorkflowTest(PaymentTest):
         self.assert_json_equal('', 'report_1/@10/right', {"format": "{[u]}{[b]}{0}{[/b]}{[/u]}", "value": "Total"})
         self.assert_json_equal('', 'report_1/@10/right_n', {"value": 1506.16, "format": "{[u]}{[b]}{0}{[/b]}{[/u]}"})
 
+    def test_close_background(self):
+        FiscalYear.objects.create(begin='2016-01-01', end='2016-12-31', status=0, last_fiscalyear=FiscalYear.objects.get(id=1))
+        self.factory.xfer = FiscalYearBegin()
+        self.calljson('/diacamma.accounting/fiscalYearBegin', {'CONFIRME': 'YES', 'year': '1', 'type_of_account': '-1'}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.accounting', 'fiscalYearBegin')
+        FiscalYear.CLOSE_BACKGROUND_NBLINES = 10
+        try:
+            self.factory.xfer = FiscalYearClose()
+            self.calljson('/diacamma.accounting/fiscalYearClose', {'CONFIRME': 'YES', 'year': '1', 'type_of_account': '-1'}, False)
+            self.assert_observer('core.dialogbox', 'diacamma.accounting', 'fiscalYearClose')
+        finally:
+            FiscalYear.CLOSE_BACKGROUND_NBLINES = 20000
+        self.assertIn('Close fiscal year', [job[1] for job in LucteriosScheduler.get_list()])
+        self.assertEqual(FiscalYear.objects.get(id=1).status, 1)
+        self.assertEqual(FiscalYear.objects.get(id=1).close_progress, 'attente')
+
+        self.factory.xfer = FiscalYearClose()
+        self.calljson('/diacamma.accounting/fiscalYearClose', {'CONFIRME': 'YES', 'year': '1', 'type_of_account': '-1'}, False)
+        self.assert_observer('core.exception', 'diacamma.accounting', 'fiscalYearClose')
+
+        self.factory.xfer = ChartsAccountList()
+        self.calljson('/diacamma.accounting/chartsAccountList', {'year': '1', 'type_of_account': '-1'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'chartsAccountList')
+        self.assert_json_equal('LABELFORM', 'close_info', "Clôture de l'exercice en cours : attente")
+
+        # a lost job does not lock the year
+        remove_scheduled_job('accounting-close-1')
+        self.assertEqual(FiscalYear.objects.get(id=1).close_progress, None)
+        self.factory.xfer = ChartsAccountList()
+        self.calljson('/diacamma.accounting/chartsAccountList', {'year': '1', 'type_of_account': '-1'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'chartsAccountList')
+        self.assertFalse('close_info' in self.json_data.keys(), self.json_data.keys())
+
+        create_account(['860'], 5)  # annexe N°18
+        add_entry(1, 1, '2015-02-20', 'annexe', '-1|18|0|-10.000000|0|0|None|\n-2|2|0|-10.000000|0|0|None|', True)
+        FiscalYear.close_backend(1)
+        self.assertEqual(FiscalYear.objects.get(id=1).status, 1)
+        self.assertEqual(FiscalYear.objects.get(id=1).close_progress, None)
+        self.assertEqual(FiscalYear.objects.get(id=1).close_error, "La somme des comptes annexes doit être nulle !")
+        self.factory.xfer = ChartsAccountList()
+        self.calljson('/diacamma.accounting/chartsAccountList', {'year': '1', 'type_of_account': '-1'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'chartsAccountList')
+        self.assert_json_equal('LABELFORM', 'close_info', "Échec de la clôture de l'exercice : La somme des comptes annexes doit être nulle !")
+
+        add_entry(1, 1, '2015-02-21', 'annexe', '-1|18|0|10.000000|0|0|None|\n-2|2|0|10.000000|0|0|None|', True)
+        finalized_years = []
+
+        def finalize_year_after_test(xfer):
+            finalized_years.append(xfer.getparam('year'))
+        Signal.decorate('finalize_year_after')(finalize_year_after_test)
+        try:
+            FiscalYear.close_backend(1, None, {'CONFIRME': 'YES', 'year': '1', 'type_of_account': '-1'})
+        finally:
+            Signal._SIGNAL_LIST['finalize_year_after'].remove(finalize_year_after_test)
+        self.assertEqual(finalized_years, ['1'])
+        self.assertEqual(FiscalYear.objects.get(id=1).status, 2)
+        self.assertEqual(FiscalYear.objects.get(id=1).close_progress, None)
+        self.assertEqual(FiscalYear.objects.get(id=1).close_error, None)
+        self.factory.xfer = ChartsAccountList()
+        self.calljson('/diacamma.accounting/chartsAccountList', {'year': '1', 'type_of_account': '-1'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'chartsAccountList')
+        self.assertFalse('close_info' in self.json_data.keys(), self.json_data.keys())
+        self.factory.xfer = EntryAccountList()
+        self.calljson('/diacamma.accounting/entryAccountList', {'year': '1', 'journal': '5', 'filter': '2'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'entryAccountList')
+        self.assert_count_equal('entryline', 8)
+
     def test_import_lastyear(self):
         self._add_subvention()
 
@@ -1027,3 +1230,22 @@ class FiscalYearWorkflowTest(PaymentTest):
         self.assert_observer('core.custom', 'diacamma.accounting', 'chartsAccountList')
         self.assertEqual(len(self.json_actions), 3)
         self.assert_count_equal('', 8)
+
+        self.factory.xfer = FiscalYearAgedBalance()
+        self.calljson('/diacamma.accounting/fiscalYearAgedBalance', {'year': '2', 'end': '2016-01-31', 'filtercode': '411'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearAgedBalance')
+        self.assert_count_equal('report_2', 3)
+        self.assert_json_equal('', 'report_2/@0/id', '411#4')
+        self.assert_json_equal('', 'report_2/@0/bucket_0', -34.01)
+        self.assert_json_equal('', 'report_2/@1/id', '411#5')
+        self.assert_json_equal('', 'report_2/@1/total', -125.97)
+        self.assert_json_equal('', 'report_2/@1/bucket_0', 0.0)
+        self.assert_json_equal('', 'report_2/@1/bucket_3', -125.97)
+
+        self.factory.xfer = FiscalYearAgedBalanceLines()
+        self.calljson('/diacamma.accounting/fiscalYearAgedBalanceLines', {'year': '2', 'end': '2016-01-31', 'gridname': 'report_2', 'report_2': '411#5'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearAgedBalanceLines')
+        self.assert_count_equal('lines', 1)
+        self.assert_json_equal('', 'lines/@0/entry.date_value', '2016-01-01')
+        self.assert_json_equal('', 'lines/@0/age', 344)
+        self.assert_json_equal('', 'lines/@0/amount', -125.97)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark of accounting reports on a synthetic ledger
+
+Skipped unless DIACAMMA_BENCHMARK is set, configurable with:
+ - DIACAMMA_BENCHMARK_YEARS, DIACAMMA_BENCHMARK_THIRDS, DIACAMMA_BENCHMARK_ENTRIES, DIACAMMA_BENCHMARK_COSTS: size of synthetic ledger
+ - DIACAMMA_BENCHMARK_RESULT: JSON file of measures (default 'accounting_benchmark.json')
+ - DIACAMMA_BENCHMARK_BASELINE: JSON file of reference measures, test fails on regression
+ - DIACAMMA_BENCHMARK_THRESHOLD: tolerated ratio of regression (default 0.5)
+ - DIACAMMA_BENCHMARK_CODES: number of account codes classified by code classification benchmark
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from os import environ
+from os.path import isfile
+from json import dump, load
+from time import time
+from random import Random
+from unittest import skipUnless, TestCase
+import tracemalloc
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from lucterios.framework.test import LucteriosTest
+
+from diacamma.accounting.test_tools import fill_synthetic_ledger
+from diacamma.accounting.tools import current_system_account
+from diacamma.accounting.models import EntryAccount, ChartsAccount
+from diacamma.accounting.views import ThirdList
+from diacamma.accounting.views_reports import FiscalYearBalanceSheet, FiscalYearIncomeStatement, FiscalYearLedger, FiscalYearTrialBalance
+from diacamma.accounting.system.french import FrenchSystemAcounting
+from diacamma.accounting.system.belgium import BelgiumSystemAcounting
+
+# measures under these minimums are noise and never reported as regressions
+MIN_DURATION = 0.05
+MIN_MEMORY = 1024 * 1024
+
+
+@skipUnless(environ.get('DIACAMMA_BENCHMARK', '') != '', 'set DIACAMMA_BENCHMARK to run accounting benchmark')
+class AccountingBenchmarkTest(LucteriosTest):
+
+    def setUp(self):
+        LucteriosTest.setUp(self)
+        self.config = {'years': int(environ.get('DIACAMMA_BENCHMARK_YEARS', 2)),
+                       'thirds': int(environ.get('DIACAMMA_BENCHMARK_THIRDS', 50)),
+                       'entries': int(environ.get('DIACAMMA_BENCHMARK_ENTRIES', 1000)),
+                       'costs': int(environ.get('DIACAMMA_BENCHMARK_COSTS', 3))}
+        self.years = fill_synthetic_ledger(self.config['years'], self.config['thirds'], self.config['entries'], self.config['costs'])
+        self.measures = {}
+
+    def _measure(self, name, callback):
+        tracemalloc.start()
+        begin = time()
+        with CaptureQueriesContext(connection) as queries:
+            callback()
+        duration = time() - begin
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.measures[name] = {'duration': duration, 'queries': len(queries), 'memory': peak}
+
+    def _call_view(self, xfer_class, url, params):
+        def callback():
+            self.factory.xfer = xfer_class()
+            self.calljson(url, params, False)
+            self.assert_observer('core.custom', 'diacamma.accounting', url.split('/')[-1])
+        return callback
+
+    def _finalize_year(self):
+        year = self.years[0]
+        EntryAccount.closed_entries(list(EntryAccount.objects.filter(year=year, close=False)))
+        self._measure('finalize_year', lambda: current_system_account().finalize_year(year))
+
+    def _check_regressions(self, baseline, threshold):
+        regressions = []
+        for name, measure in self.measures.items():
+            reference = baseline.get('measures', {}).get(name)
+            if reference is None:
+                continue
+            for key, minimum in (('duration', MIN_DURATION), ('queries', 0), ('memory', MIN_MEMORY)):
+                if (measure[key] > minimum) and (measure[key] > reference[key] * (1 + threshold)):
+                    regressions.append("%s %s: %s > %s" % (name, key, measure[key], reference[key]))
+        return regressions
+
+    def test_reports(self):
+        year_id = self.years[0].id
+        self._measure('balance_sheet', self._call_view(FiscalYearBalanceSheet, '/diacamma.accounting/fiscalYearBalanceSheet', {'year': year_id}))
+        self._measure('income_statement', self._call_view(FiscalYearIncomeStatement, '/diacamma.accounting/fiscalYearIncomeStatement', {'year': year_id}))
+        self._measure('ledger', self._call_view(FiscalYearLedger, '/diacamma.accounting/fiscalYearLedger', {'year': year_id}))
+        self._measure('trial_balance', self._call_view(FiscalYearTrialBalance, '/diacamma.accounting/fiscalYearTrialBalance', {'year': year_id}))
+        self._measure('third_totals', self._call_view(ThirdList, '/diacamma.accounting/thirdList', {'show_filter': 1}))
+        self._finalize_year()
+        with open(environ.get('DIACAMMA_BENCHMARK_RESULT', 'accounting_benchmark.json'), 'w') as result_file:
+            dump({'config': self.config, 'measures': self.measures}, result_file, indent=2)
+        baseline_file = environ.get('DIACAMMA_BENCHMARK_BASELINE', '')
+        if isfile(baseline_file):
+            with open(baseline_file) as baseline_content:
+                baseline = load(baseline_content)
+            self.assertEqual(baseline.get('config'), self.config, 'baseline built with an other configuration')
+            regressions = self._check_regressions(baseline, float(environ.get('DIACAMMA_BENCHMARK_THRESHOLD', 0.5)))
+            self.assertEqual(regressions, [], 'performance regressions')
+
+
+@skipUnless(environ.get('DIACAMMA_BENCHMARK', '') != '', 'set DIACAMMA_BENCHMARK to run accounting benchmark')
+class CodeClassificationBenchmarkTest(TestCase):
+
+    def _get_throughput(self, callback, codes):
+        begin = time()
+        for code in codes:
+            callback(code)
+        return len(codes) / max(time() - begin, 0.000001)
+
+    def test_code_classification(self):
+        random = Random(0)
+        nb_codes = int(environ.get('DIACAMMA_BENCHMARK_CODES', 100000))
+        codes = [''.join([random.choice('0123456789') for _idx in range(random.randint(3, 8))]) for _code_idx in range(nb_codes)]
+        measures = {}
+        for system_name, system_account in (('french', FrenchSystemAcounting()), ('belgium', BelgiumSystemAcounting())):
+            measures['%s_new_charts_account' % system_name] = self._get_throughput(system_account.new_charts_account, codes)
+            measures['%s_classification' % system_name] = self._get_throughput(lambda code: system_account.get_code_classification(code, ChartsAccount.CLASSIFICATION_FLAGS), codes)
+        with open(environ.get('DIACAMMA_BENCHMARK_RESULT', 'accounting_benchmark.json').replace('.json', '_codes.json'), 'w') as result_file:
+            dump({'codes': nb_codes, 'codes_per_second': measures}, result_file, indent=2)
+        baseline_file = environ.get('DIACAMMA_BENCHMARK_BASELINE', '').replace('.json', '_codes.json')
+        if isfile(baseline_file):
+            with open(baseline_file) as baseline_content:
+                baseline = load(baseline_content)['codes_per_second']
+            threshold = float(environ.get('DIACAMMA_BENCHMARK_THRESHOLD', 0.5))
+            regressions = ["%s: %.0f < %.0f" % (name, value, baseline[name]) for name, value in measures.items() if (name in baseline) and (value * (1 + threshold) < baseline[name])]
+            self.assertEqual(regressions, [], 'performance regressions')
@@ -26,27 +26,37 @@ from __future__ import unicode_literals
 from shutil import rmtree
 from os.path import exists
 from base64 import b64decode
+from lxml import etree
 from datetime import date
+from json import loads
 
 from django.utils import formats
-from django.db.models import Q
+from django.conf import settings
+from django.db.models import Q, Sum
 
 from lucterios.framework.test import LucteriosTest
+from lucterios.framework.model_fields import LucteriosScheduler
 from lucterios.framework.filetools import get_user_dir, get_user_path
 from lucterios.CORE.parameters import Params
+from lucterios.CORE.models import LucteriosUser
 from lucterios.CORE.views import StatusMenu
-from lucterios.contacts.models import CustomField
+from lucterios.contacts.models import CustomField, LegalEntity
 
 from diacamma.accounting.views_entries import EntryAccountList, EntryAccountListing, EntryAccountEdit, EntryAccountShow, \
-    EntryAccountClose, EntryAccountCostAccounting, EntryAccountSearch
+    EntryAccountClose, EntryAccountCostAccounting, EntryAccountSearch, EntryAccountAutoLink
 from diacamma.accounting.test_tools import default_compta_fr, initial_thirds_fr, fill_entries_fr, add_entry, create_year
 from diacamma.accounting.views_other import CostAccountingList, CostAccountingClose, CostAccountingAddModify, CostAccountingRecreate, ModelEntryList
 from diacamma.accounting.views_reports import FiscalYearBalanceSheet, FiscalYearIncomeStatement, FiscalYearLedger, FiscalYearTrialBalance, \
     CostAccountingTrialBalance, CostAccountingLedger, CostAccountingIncomeStatement, \
-    FiscalYearReportPrint, FiscalYearLedgerShow, CostAccountingReportPrint
-from diacamma.accounting.views_admin import FiscalYearExport
-from diacamma.accounting.models import FiscalYear, Third, CostAccounting, ModelEntry
-from diacamma.accounting.tools_reports import get_totalaccount_for_query, get_budget_total
+    FiscalYearReportPrint, FiscalYearLedgerShow, CostAccountingReportPrint, FiscalYearComparativeIncomeStatement, \
+    FiscalYearAgedBalance, FiscalYearAgedBalanceLines, FiscalYearAgedBalanceExport
+from diacamma.accounting.views_admin import FiscalYearExport, FiscalYearExportFEC
+from diacamma.accounting.models import FiscalYear, Third, CostAccounting, ModelEntry, AccountLink, EntryLineAccount, EntryAccount, \
+    ChartsAccountBalance, EntryLineDayBalance, accounting_convertdata, get_convert_watermarks
+from diacamma.accounting.tools import current_system_account, xml_file_validator, has_scheduled_job, remove_scheduled_job
+from diacamma.accounting.tools_reports import get_totalaccount_for_query, get_budget_total, REPORT_CACHE
+from diacamma.accounting.tools_matching import ThirdLineMatcher
+from diacamma.accounting.tools_profiling import ActionProfiler, get_sql_template
 from diacamma.accounting.views_budget import BudgetList, BudgetAddModify, BudgetDel, BudgetImport
 
 
@@ -83,6 +93,88 @@ class EntryTest(LucteriosTest):
 
 class CompletedEntryTest(EntryTest):
 
+    def test_profiling_entrylist(self):
+        with ActionProfiler('entryAccountList') as profiler:
+            self._goto_entrylineaccountlist(0, 0, '', 25)
+        self.assertLessEqual(profiler.nb_queries, 20)
+        self.assertGreater(profiler.sql_time, 0)
+        self.assertGreater(profiler.duration, profiler.sql_time)
+        # queries by report (not by line): no template repeated for each of the 25 lines
+        self.assertEqual(profiler.get_repeated_queries(min_count=5), [])
+        with self.assertLogs('diacamma.profiling', level='INFO') as logs:
+            profiler.log()
+        self.assertIn('"action": "entryAccountList"', logs.output[0])
+        self.assertIn('"queries": %d' % profiler.nb_queries, logs.output[0])
+
+    def test_profiling_sql_template(self):
+        self.assertEqual(get_sql_template("SELECT * FROM t WHERE a = 'x''y' AND b IN (%s, %s, 3) AND c = 12.5"), "SELECT * FROM t WHERE a = ? AND b IN (...) AND c = ?")
+
+    def test_profiling_middleware(self):
+        self.client.force_login(LucteriosUser.objects.get(username='admin'))
+        with self.settings(MIDDLEWARE=list(settings.MIDDLEWARE) + ['diacamma.accounting.tools_profiling.ProfilingMiddleware']):
+            with self.assertLogs('diacamma.profiling', level='INFO') as logs:
+                response = self.client.get('/diacamma.accounting/entryAccountList', {'year': '1', 'journal': '0', 'filter': '0'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(logs.records), 1)
+            stats = loads(logs.records[0].getMessage())
+            self.assertEqual(stats['action'], 'diacamma.accounting/entryAccountList')
+            self.assertGreater(stats['queries'], 0)
+            self.assertLessEqual(stats['queries'], 25)
+            self.assertGreaterEqual(stats['python_time'], 0)
+            self.assertEqual([count for _template, count in stats['repeated'] if count >= 5], [])
+            with self.assertNoLogs('diacamma.profiling', level='INFO'):
+                response = self.client.get('/CORE/statusMenu')
+            self.assertEqual(response.status_code, 200)
+
+    def test_entrylist_keyset(self):
+        self.factory.xfer = EntryAccountList()
+        self.calljson('/diacamma.accounting/entryAccountList', {'year': '1', 'journal': '0', 'filter': '0', 'GRID_SIZE%entryline': 100}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'entryAccountList')
+        nb_lines = len(self.json_data['entryline'])
+        full_ids = [self.json_data['entryline'][idx]['id'] for idx in range(nb_lines)]
+        self.assertEqual(nb_lines, EntryLineAccount.objects.filter(entry__year_id=1).count())
+        for page_num in (4, 1, 3, 2):
+            self.factory.xfer = EntryAccountList()
+            self.calljson('/diacamma.accounting/entryAccountList', {'year': '1', 'journal': '0', 'filter': '0', 'GRID_SIZE%entryline': 3, 'GRID_PAGE%entryline': page_num}, False)
+            self.assert_observer('core.custom', 'diacamma.accounting', 'entryAccountList')
+            self.assertEqual([record['id'] for record in self.json_data['entryline']], full_ids[page_num * 3:(page_num + 1) * 3], page_num)
+        for _loop in range(2):
+            page_ids = []
+            for page_num in range((nb_lines + 2) // 3):
+                self.factory.xfer = EntryAccountList()
+                self.calljson('/diacamma.accounting/entryAccountList', {'year': '1', 'journal': '0', 'filter': '0', 'GRID_SIZE%entryline': 3, 'GRID_PAGE%entryline': page_num}, False)
+                self.assert_observer('core.custom', 'diacamma.accounting', 'entryAccountList')
+                page_ids.extend([record['id'] for record in self.json_data['entryline']])
+            self.assertEqual(page_ids, full_ids)
+
+        nb_lettered = EntryLineAccount.objects.filter(entry__year_id=1, entry__has_link=True).count()
+        self.assertEqual(nb_lettered, EntryLineAccount.objects.filter(entry__year_id=1, entry__entrylineaccount__link__isnull=False).distinct().count())
+        self._goto_entrylineaccountlist(0, 3, '', nb_lettered)
+        self._goto_entrylineaccountlist(0, 4, '', nb_lines - nb_lettered)
+        link = AccountLink.objects.filter(year_id=1).first()
+        entry_ids = list(EntryLineAccount.objects.filter(link=link).values_list('entry_id', flat=True))
+        link.delete()
+        self.assertEqual(EntryAccount.objects.filter(id__in=entry_ids, has_link=True).count(), 0)
+        AccountLink.create_link(list(EntryLineAccount.objects.filter(entry_id__in=entry_ids, account__code__startswith='4')))
+        self.assertEqual(EntryAccount.objects.filter(id__in=entry_ids, has_link=True).count(), len(set(entry_ids)))
+
+    def test_close_batch(self):
+        add_entry(1, 5, '2015-02-25', 'déséquilibré', '-1|2|0|-12.340000|0|0|None|\n-2|15|0|10.000000|1|0|None|')
+        self.factory.xfer = EntryAccountClose()
+        self.calljson('/diacamma.accounting/entryAccountClose', {'CONFIRME': 'YES', 'year': '1', 'journal': '0', 'entryaccount': '4;6;13'}, False)
+        self.assert_observer('core.exception', 'diacamma.accounting', 'entryAccountClose')
+        self.assertEqual(EntryAccount.objects.filter(close=True).count(), 8)
+        self.assertEqual(EntryAccount.objects.filter(num__isnull=False).count(), 8)
+
+        self.factory.xfer = EntryAccountClose()
+        self.calljson('/diacamma.accounting/entryAccountClose', {'CONFIRME': 'YES', 'year': '1', 'journal': '0', 'entryaccount': '4;5;6;10;1'}, False)
+        self.assert_observer('core.acknowledge', 'diacamma.accounting', 'entryAccountClose')
+        self.assertEqual(EntryAccount.objects.filter(close=True).count(), 12)
+        self.assertEqual(list(EntryAccount.objects.filter(id__in=(4, 5, 6, 10)).order_by('id').values_list('num', flat=True)), [9, 10, 11, 12])
+        self.assertEqual(EntryAccount.objects.get(id=1).num, 1)
+        self.assertEqual(EntryAccount.objects.filter(date_entry=date.today()).count(), 12)
+        self.assertEqual(EntryAccount.closed_entries(EntryAccount.objects.filter(id__in=(4, 5))), 0)
+
     def test_lastyear(self):
         self._goto_entrylineaccountlist(1, 0, '', 3)
         self.assert_json_equal('', 'entryline/@0/entry.num', '1')
@@ -184,6 +276,119 @@ class CompletedEntryTest(EntryTest):
     def test_noletter(self):
         self._goto_entrylineaccountlist(0, 4, '', 13)
 
+    def test_letter_backfill(self):
+        self.assertEqual([str(link) for link in AccountLink.objects.order_by('id')], ['A', 'C', 'E'])
+        AccountLink.objects.all().update(year=None, letter_num=None)
+        self.assertEqual(list(AccountLink.objects.order_by('id').values_list('letter_num', flat=True)), [None, None, None])
+        self.assertEqual(AccountLink.fill_emptyletter(), 3)
+        self.assertEqual(list(AccountLink.objects.order_by('id').values_list('year_id', 'letter_num', 'is_multiyear')), [(1, 0, False), (1, 2, False), (1, 4, False)])
+        self.assertEqual(AccountLink.fill_emptyletter(), 0)
+        self._goto_entrylineaccountlist(4, 0, '', 6)
+        self.assert_json_equal('', 'entryline/@0/link', 'A')
+        self.assert_json_equal('', 'entryline/@2/link', 'C')
+        self.assert_json_equal('', 'entryline/@4/link', 'E')
+
+    def test_letter_delete(self):
+        self.assertEqual([str(link) for link in AccountLink.objects.order_by('id')], ['A', 'C', 'E'])
+        AccountLink.objects.order_by('id').first().clean()
+        self.assertEqual([str(link) for link in AccountLink.objects.order_by('id')], ['A', 'C'])
+        self.assertEqual(list(AccountLink.objects.order_by('id').values_list('letter_num', flat=True)), [0, 2])
+
+    def test_letter_bulk(self):
+        lines_by_link = {}
+        for line_id, link_id in EntryLineAccount.objects.filter(link__isnull=False).order_by('id').values_list('id', 'link_id'):
+            lines_by_link.setdefault(link_id, []).append(line_id)
+        groups = [lines_by_link[link_id] for link_id in sorted(lines_by_link.keys())]
+        for link in AccountLink.objects.all():
+            link.clean()
+        self.assertEqual(EntryLineAccount.objects.filter(link__isnull=False).count(), 0)
+        errors = AccountLink.create_links([groups[0], groups[1][:1], groups[2], [9999]])
+        self.assertEqual(errors, [None, "Ces lignes d'écritures ne s'équilibrent pas !", None, "Ligne d'écriture inconnue !"])
+        self.assertEqual(AccountLink.objects.count(), 2)
+        self.assertEqual(EntryLineAccount.objects.filter(link__isnull=False).count(), 4)
+        self.assertEqual([str(link) for link in AccountLink.objects.order_by('id')], ['A', 'C'])
+
+    def test_convertdata_watermark(self):
+        accounting_convertdata()
+        last_line_id = EntryLineAccount.objects.order_by('-id').first().id
+        watermarks = get_convert_watermarks()
+        self.assertEqual(watermarks['accountingcost'], last_line_id)
+        self.assertFalse('third' in watermarks.keys())
+        self.assertEqual(watermarks['yearaccount'], last_line_id)
+        self.assertEqual(watermarks['multilink'], AccountLink.objects.order_by('-id').first().id)
+        self.assertEqual(watermarks['total_income'], 0)
+        self.assertEqual(watermarks['accountlink'], 1)
+        self.assertEqual(watermarks['accountbalance'], 1)
+
+        EntryLineAccount.objects.filter(id=1).update(third_id=1)
+        new_entry = add_entry(1, 5, '2015-12-30', 'Mauvais tiers', '-1|2|4|-10.000000|0|0|None|\n-2|3|0|10.000000|0|0|None|')
+        self.assertEqual(new_entry.entrylineaccount_set.filter(third__isnull=False).count(), 1)
+        accounting_convertdata()
+        self.assertEqual(new_entry.entrylineaccount_set.filter(third__isnull=False).count(), 0)
+        self.assertEqual(EntryLineAccount.objects.get(id=1).third_id, None)
+        self.assertEqual(EntryLineDayBalance.check_balances(), [])
+
+        ChartsAccountBalance.objects.filter(account__code='512').update(amount=0.0)
+        EntryLineDayBalance.objects.filter(account__code='707').update(debit=0.0, credit=0.0)
+        self.assertEqual(ChartsAccountBalance.get_unbalanced_years(), [1])
+        self.assertEqual(EntryLineDayBalance.get_unbalanced_years(), [1])
+        accounting_convertdata()
+        self.assertEqual(get_convert_watermarks()['accountbalance'], 1)
+        self.assertEqual(ChartsAccountBalance.get_unbalanced_years(), [])
+        self.assertEqual(EntryLineDayBalance.get_unbalanced_years(), [])
+        self.assertEqual(EntryLineDayBalance.check_balances(), [])
+
+    def test_auto_link(self):
+        for link in AccountLink.objects.all():
+            link.clean()
+        add_entry(1, 4, '2015-02-25', 'reglement depense 3', '-1|2|0|-50.000000|0|0|None|\n-2|4|2|-50.000000|0|0|None|', True)
+        add_entry(1, 4, '2015-02-26', 'reglement depense 3', '-1|2|0|-28.240000|0|0|None|\n-2|4|2|-28.240000|0|0|None|', True)
+        stats = ThirdLineMatcher(FiscalYear.get_current()).run()
+        self.assertEqual(stats['lines'], 11)
+        self.assertEqual(stats['thirds'], 6)
+        self.assertEqual(stats['links'], 4)
+        self.assertEqual(stats['lettered'], 9)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(EntryLineAccount.objects.filter(link__isnull=True, account__code__in=('401', '411')).count(), 2)
+        self._goto_entrylineaccountlist(0, 4, '', 11)
+        stats = ThirdLineMatcher(FiscalYear.get_current()).run()
+        self.assertEqual(stats['lines'], 2)
+        self.assertEqual(stats['links'], 0)
+
+        self.factory.xfer = EntryAccountAutoLink()
+        self.calljson('/diacamma.accounting/entryAccountAutoLink', {'year': '1', 'CONFIRME': 'YES'}, False)
+        self.assert_observer('core.dialogbox', 'diacamma.accounting', 'entryAccountAutoLink')
+        self.assertIn('Automatic lettering', [job[1] for job in LucteriosScheduler.get_list()])
+        self.assertTrue(has_scheduled_job('accounting-autolink-1'))
+        self.factory.xfer = EntryAccountAutoLink()
+        self.calljson('/diacamma.accounting/entryAccountAutoLink', {'year': '1', 'CONFIRME': 'YES'}, False)
+        self.assert_observer('core.exception', 'diacamma.accounting', 'entryAccountAutoLink')
+        remove_scheduled_job('accounting-autolink-1')
+        self.assertFalse(has_scheduled_job('accounting-autolink-1'))
+
+    def test_auto_link_large_group(self):
+        for link in AccountLink.objects.all():
+            link.clean()
+        ThirdLineMatcher(FiscalYear.get_current()).run()
+        for idx in range(9):
+            add_entry(1, 4, '2015-03-%02d' % (idx + 1), 'facture %d' % idx, '-1|2|0|%d.000000|0|0|None|\n-2|4|2|%d.000000|0|0|None|' % (30 + idx, 30 + idx), True)
+            add_entry(1, 4, '2015-03-%02d' % (idx + 1), 'acompte %d' % idx, '-1|2|0|-10.000000|0|0|None|\n-2|4|2|-10.000000|0|0|None|', True)
+            add_entry(1, 4, '2015-03-%02d' % (idx + 1), 'solde %d' % idx, '-1|2|0|-%d.000000|0|0|None|\n-2|4|2|-%d.000000|0|0|None|' % (20 + idx, 20 + idx), True)
+        stats = ThirdLineMatcher(FiscalYear.get_current(), '401', max_candidates=8).run()
+        self.assertEqual(stats['lines'], 27 + 1)
+        self.assertEqual(stats['links'], 9)
+        self.assertEqual(stats['lettered'], 27)
+        self.assertEqual(stats['errors'], 0)
+
+    def test_auto_link_lettering_check(self):
+        for link in AccountLink.objects.all():
+            link.clean()
+        Params.setvalue('accounting-lettering-check', '401')
+        stats = ThirdLineMatcher(FiscalYear.get_current()).run()
+        self.assertEqual(EntryLineAccount.objects.filter(link__isnull=False, account__code='401').count(), 0)
+        self.assertEqual(EntryLineAccount.objects.filter(link__isnull=False, account__code='411').count(), stats['lettered'])
+        self.assertGreater(stats['lettered'], 0)
+
     def test_code(self):
         self._goto_entrylineaccountlist(0, 0, '60', 6)
 
@@ -317,6 +522,13 @@ class CompletedEntryTest(EntryTest):
         self.calljson('/diacamma.accounting/fiscalYearExport', {}, False)
         self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearExport')
         self.assertTrue(exists(get_user_path('accounting', 'fiscalyear_export_1.xml')))
+        self.assertEqual(xml_file_validator(get_user_path('accounting', 'fiscalyear_export_1.xml'), current_system_account().get_export_xsdfile()), None)
+        export_xml = etree.parse(get_user_path('accounting', 'fiscalyear_export_1.xml'))
+        self.assertEqual(export_xml.findtext('exercice/DateCloture'), '2015-12-31')
+        self.assertEqual(len(export_xml.findall('exercice/journal')), 5)
+        self.assertEqual(len(export_xml.findall('exercice/journal/ecriture')), 8)
+        self.assertEqual(len(export_xml.findall('exercice/journal/ecriture/ligne')), 17)
+        self.assertEqual(export_xml.findtext('exercice/journal/ecriture/ligne/Credit'), '1250.38')
 
         self.assertFalse(exists(get_user_path('accounting', 'fiscalyear_export_2.xml')))
         self.factory.xfer = FiscalYearExport()
@@ -326,6 +538,34 @@ class CompletedEntryTest(EntryTest):
         self.assert_json_equal('', 'code', '3')
         self.assert_json_equal('', 'message', "Cet exercice n'a pas d'écriture validée !")
 
+    def test_export_fec(self):
+        self.factory.xfer = FiscalYearExportFEC()
+        self.calljson('/diacamma.accounting/fiscalYearExportFEC', {}, False)
+        self.assert_observer('core.exception', 'diacamma.accounting', 'fiscalYearExportFEC')
+        self.assert_json_equal('', 'message', "Le SIREN de votre structure (identification légale) est nécessaire à l'export FEC !")
+        self.assertFalse(exists(get_user_path('accounting', 'fiscalyear_fec_1.txt')))
+
+        LegalEntity.objects.filter(id=1).update(legal_identification='123 456 789 00012')
+        self.factory.xfer = FiscalYearExportFEC()
+        self.calljson('/diacamma.accounting/fiscalYearExportFEC', {}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearExportFEC')
+        self.assert_json_equal('LABELFORM', 'title', "Exporter l'exercice au format FEC")
+        self.assert_json_equal('DOWNLOAD', 'filename', '123456789FEC20151231.txt')
+        with open(get_user_path('accounting', 'fiscalyear_fec_1.txt'), 'r', encoding='utf-8') as fec_file:
+            fec_lines = [fec_line.rstrip('\n').split('\t') for fec_line in fec_file.readlines()]
+        self.assertEqual(len(fec_lines), 18)
+        self.assertEqual(fec_lines[0][:5], ['JournalCode', 'JournalLib', 'EcritureNum', 'EcritureDate', 'CompteNum'])
+        self.assertEqual(len(fec_lines[0]), 18)
+        self.assertEqual(fec_lines[4], ['2', 'Achats', '2', '20150214', '401', '401', '4', 'Minimum', '2', '20150214', 'depense 1',
+                                        '0,00', '63,94', 'A', '20150215', date.today().strftime('%Y%m%d'), '', ''])
+        self.assertEqual(fec_lines[7][8], 'ch N°34543')
+        self.assertEqual(fec_lines[17][11:13], ['1234,00', '0,00'])
+
+        self.factory.xfer = FiscalYearExportFEC()
+        self.calljson('/diacamma.accounting/fiscalYearExportFEC', {'fiscalyear': '2'}, False)
+        self.assert_observer('core.exception', 'diacamma.accounting', 'fiscalYearExportFEC')
+        self.assertFalse(exists(get_user_path('accounting', 'fiscalyear_fec_2.txt')))
+
     def test_search_advanced(self):
         CustomField.objects.create(modelname='accounting.Third', name='categorie', kind=4, args="{'list':['---','petit','moyen','gros']}")
         CustomField.objects.create(modelname='accounting.Third', name='value', kind=1, args="{'min':0,'max':100}")
@@ -561,6 +801,98 @@ class FiscalYearTest(EntryTest):
         self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearIncomeStatement')
         self._check_result_with_filter()
 
+    def test_comparative_incomestatement(self):
+        self.factory.xfer = FiscalYearComparativeIncomeStatement()
+        self.calljson('/diacamma.accounting/fiscalYearComparativeIncomeStatement', {}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearComparativeIncomeStatement')
+        self.assert_json_equal('SELECT', 'period', 0)
+        self.assert_select_equal('period', {0: 'par exercice', 1: 'par mois'})
+        self.assertEqual(self.json_comp['period']['description'], 'comparaison')
+        self.assert_json_equal('FLOAT', 'nb_years', 5)
+        self.assertEqual(self.json_comp['nb_years']['description'], "nombre d'exercices")
+        self.assert_count_equal('report_1', 12)
+        self.assert_grid_equal('report_1', {'designation': 'nom', 'period_0': '2014', 'period_1': '2015'}, 12)
+        self.assert_json_equal('', 'report_1/@1/designation', '[707] 707')
+        self.assert_json_equal('', 'report_1/@1/period_0', 0.0)
+        self.assert_json_equal('', 'report_1/@1/period_1', 230.62)
+        self.assert_json_equal('', 'report_1/@2/period_1', {'format': '{[u]}{[b]}{0}{[/b]}{[/u]}', 'value': 230.62})
+        self.assert_json_equal('', 'report_1/@5/designation', '[601] 601')
+        self.assert_json_equal('', 'report_1/@5/period_1', 78.24)
+        self.assert_json_equal('', 'report_1/@8/designation', '[627] 627')
+        self.assert_json_equal('', 'report_1/@9/period_0', {'format': '{[u]}{[b]}{0}{[/b]}{[/u]}', 'value': 0.0})
+        self.assert_json_equal('', 'report_1/@9/period_1', {'format': '{[u]}{[b]}{0}{[/b]}{[/u]}', 'value': 348.60})
+        self.assert_json_equal('', 'report_1/@11/period_1', {'format': '{[b]}{0}{[/b]}', 'value': -117.98})
+
+        self.factory.xfer = FiscalYearComparativeIncomeStatement()
+        self.calljson('/diacamma.accounting/fiscalYearComparativeIncomeStatement', {'nb_years': '1.0'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearComparativeIncomeStatement')
+        self.assert_json_equal('FLOAT', 'nb_years', 1)
+        self.assert_grid_equal('report_1', {'designation': 'nom', 'period_0': '2015'}, 12)
+        self.assert_json_equal('', 'report_1/@1/period_0', 230.62)
+
+        self.factory.xfer = FiscalYearComparativeIncomeStatement()
+        self.calljson('/diacamma.accounting/fiscalYearComparativeIncomeStatement', {'period': 1}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearComparativeIncomeStatement')
+        self.assert_json_equal('SELECT', 'period', 1)
+        self.assert_count_equal('report_1', 12)
+        self.assert_grid_equal('report_1', {'designation': 'nom', 'period_0': 'janvier 2015', 'period_1': 'février 2015', 'period_2': 'mars 2015', 'period_3': 'avril 2015',
+                                            'period_4': 'mai 2015', 'period_5': 'juin 2015', 'period_6': 'juillet 2015', 'period_7': 'août 2015', 'period_8': 'septembre 2015',
+                                            'period_9': 'octobre 2015', 'period_10': 'novembre 2015', 'period_11': 'décembre 2015'}, 12)
+        self.assert_json_equal('', 'report_1/@1/designation', '[707] 707')
+        self.assert_json_equal('', 'report_1/@1/period_0', 0.0)
+        self.assert_json_equal('', 'report_1/@1/period_1', 230.62)
+        self.assert_json_equal('', 'report_1/@11/period_1', {'format': '{[b]}{0}{[/b]}', 'value': -117.98})
+
+    def test_agedbalance(self):
+        self.factory.xfer = FiscalYearAgedBalance()
+        self.calljson('/diacamma.accounting/fiscalYearAgedBalance', {'end': '2015-03-31', 'filtercode': ''}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearAgedBalance')
+        self.assert_grid_equal('report_1', {'designation': 'nom', 'total': 'total', 'bucket_0': '0-30 jours', 'bucket_1': '31-60 jours', 'bucket_2': '61-90 jours', 'bucket_3': 'plus de 90 jours'}, 4)
+        self.assert_json_equal('', 'report_1/@0/id', '401#2')
+        self.assert_json_equal('', 'report_1/@0/designation', '[401 Maximum]')
+        self.assert_json_equal('', 'report_1/@0/total', 78.24)
+        self.assert_json_equal('', 'report_1/@0/bucket_0', 0.0)
+        self.assert_json_equal('', 'report_1/@0/bucket_1', 78.24)
+        self.assert_json_equal('', 'report_1/@1/id', '411#4')
+        self.assert_json_equal('', 'report_1/@1/total', -34.01)
+        self.assert_json_equal('', 'report_1/@1/bucket_1', -34.01)
+        self.assert_json_equal('', 'report_1/@2/id', '411#5')
+        self.assert_json_equal('', 'report_1/@2/bucket_1', -125.97)
+        self.assert_json_equal('', 'report_1/@3/bucket_1', {'value': -81.74, 'format': '{[u]}{[b]}{0}{[/b]}{[/u]}'})
+
+        self.factory.xfer = FiscalYearAgedBalance()
+        self.calljson('/diacamma.accounting/fiscalYearAgedBalance', {'end': '2015-02-28', 'filtercode': '411'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearAgedBalance')
+        self.assert_count_equal('report_1', 3)
+        self.assert_json_equal('', 'report_1/@1/id', '411#5')
+        self.assert_json_equal('', 'report_1/@1/bucket_0', -125.97)
+        self.assert_json_equal('', 'report_1/@1/bucket_1', 0.0)
+
+        self.factory.xfer = FiscalYearAgedBalanceLines()
+        self.calljson('/diacamma.accounting/fiscalYearAgedBalanceLines', {'end': '2015-03-31', 'gridname': 'report_1', 'report_1': '411#5'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearAgedBalanceLines')
+        self.assert_count_equal('lines', 1)
+        self.assert_json_equal('', '#lines/headers/@3/@1', 'âge (jours)')
+        self.assert_json_equal('', 'lines/@0/entry.date_value', '2015-02-21')
+        self.assert_json_equal('', 'lines/@0/age', 38)
+        self.assert_json_equal('', 'lines/@0/amount', -125.97)
+
+        self.factory.xfer = FiscalYearAgedBalanceLines()
+        self.calljson('/diacamma.accounting/fiscalYearAgedBalanceLines', {'end': '2015-03-31', 'gridname': 'report_1', 'report_1': 'total'}, False)
+        self.assert_observer('core.exception', 'diacamma.accounting', 'fiscalYearAgedBalanceLines')
+        self.assert_json_equal('', 'message', "Sélectionnez un compte de tiers !")
+
+        self.factory.xfer = FiscalYearAgedBalanceExport()
+        self.calljson('/diacamma.accounting/fiscalYearAgedBalanceExport', {'end': '2015-03-31', 'filtercode': ''}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearAgedBalanceExport')
+        self.assert_json_equal('DOWNLOAD', 'filename', 'aged_balance_20150331.csv')
+        with open(get_user_path('accounting', 'aged_balance_1.csv'), 'r', encoding='utf-8') as csv_file:
+            csv_lines = [csv_line.rstrip('\r\n').split(';') for csv_line in csv_file.readlines()]
+        self.assertEqual(len(csv_lines), 4)
+        self.assertEqual(csv_lines[0], ['code', 'third', 'total', '0-30', '31-60', '61-90', '>90'])
+        self.assertEqual(csv_lines[1], ['401', 'Maximum', '78.24', '0.00', '78.24', '0.00', '0.00'])
+        self.assertEqual(csv_lines[3], ['411', 'Dalton William', '-125.97', '0.00', '-125.97', '0.00', '0.00'])
+
     def test_incomestatement_print(self):
         self.factory.xfer = FiscalYearReportPrint()
         self.calljson('/diacamma.accounting/fiscalYearReportPrint', {'classname': 'FiscalYearIncomeStatement', "PRINT_MODE": 3}, False)
@@ -622,6 +954,63 @@ class FiscalYearTest(EntryTest):
         self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearLedger')
         self._check_result_with_filter()
 
+    def test_ledger_page(self):
+        self.factory.xfer = FiscalYearLedger()
+        self.calljson('/diacamma.accounting/fiscalYearLedger', {'page_size': 3}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearLedger')
+        self.assert_count_equal('report_1', 9)
+        self.assert_json_equal('', 'report_1/@6/designation_ref_with_third', "&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;{[b]}[401 Dalton Avrel]{[/b]}")
+        self.assert_json_equal('', 'report_1/@8/id', 'L0009-5')
+        self.assert_json_equal('', 'report_1/@8/debit', -194.08)
+        self.assertFalse('first_report_1' in self.json_data.keys())
+        self.assert_action_equal('GET', '#next_report_1/action', ('page suivante', 'mdi:mdi-page-next', "diacamma.accounting", "fiscalYearLedger", "0", '2', '1', {"after_report_1": "401|1|2015-02-17|11"}))
+
+        self.factory.xfer = FiscalYearLedger()
+        self.calljson('/diacamma.accounting/fiscalYearLedger', {'page_size': 3, 'after_report_1': "401|1|2015-02-17|11"}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearLedger')
+        self.assert_count_equal('report_1', 9)
+        self.assert_json_equal('', 'report_1/@0/designation_ref_with_third', '&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;{[i]}sous-total{[/i]}')
+        self.assert_json_equal('', 'report_1/@0/debit', {'value': 194.08, 'format': '{[i]}{0}{[/i]}'})
+        self.assert_json_equal('', 'report_1/@0/credit', {'value': 194.08, 'format': '{[i]}{0}{[/i]}'})
+        self.assert_json_equal('', 'report_1/@2/designation_ref_with_third', "&#160;&#160;&#160;&#160;&#160;&#160;&#160;&#160;{[b]}[401 Maximum]{[/b]}")
+        self.assert_json_equal('', 'report_1/@3/id', 'L0004-6')
+        self.assert_json_equal('', 'report_1/@3/credit', 78.24)
+        self.assert_action_equal('GET', '#first_report_1/action', ('première page', 'mdi:mdi-page-first', "diacamma.accounting", "fiscalYearLedger", "0", '2', '1', {"after_report_1": ""}))
+
+        self.factory.xfer = FiscalYearLedger()
+        self.calljson('/diacamma.accounting/fiscalYearLedger', {'page_size': 100}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearLedger')
+        self.assert_count_equal('report_1', 91)
+        self.assertFalse('next_report_1' in self.json_data.keys())
+
+    def test_report_cache(self):
+        REPORT_CACHE.clear()
+        self.factory.xfer = FiscalYearLedger()
+        self.calljson('/diacamma.accounting/fiscalYearLedger', {}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearLedger')
+        self.assert_count_equal('report_1', 91)
+        self.assertEqual(REPORT_CACHE.get_stats(), {'hits': 0, 'misses': 1, 'size': 1, 'max_size': 50})
+
+        self.factory.xfer = FiscalYearLedger()
+        self.calljson('/diacamma.accounting/fiscalYearLedger', {}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearLedger')
+        self.assert_count_equal('report_1', 91)
+        self.assert_json_equal('', 'report_1/@1/designation_ref_with_third', 'Report à nouveau')
+        self.assertEqual(REPORT_CACHE.get_stats(), {'hits': 1, 'misses': 1, 'size': 1, 'max_size': 50})
+
+        self.factory.xfer = FiscalYearLedger()
+        self.calljson('/diacamma.accounting/fiscalYearLedger', {'filtercode': '4'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearLedger')
+        self.assertEqual(REPORT_CACHE.get_stats(), {'hits': 1, 'misses': 2, 'size': 2, 'max_size': 50})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            add_entry(1, 2, '2015-02-20', 'Frais bancaire', '-1|2|0|12.340000|0|0|None|\n-2|4|0|12.340000|0|0|None|', True)
+        self.factory.xfer = FiscalYearLedger()
+        self.calljson('/diacamma.accounting/fiscalYearLedger', {}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'fiscalYearLedger')
+        self.assert_count_equal('report_1', 93)
+        self.assertEqual(REPORT_CACHE.get_stats(), {'hits': 1, 'misses': 3, 'size': 2, 'max_size': 50})
+
     def test_ledger_print(self):
         self.factory.xfer = FiscalYearReportPrint()
         self.calljson('/diacamma.accounting/fiscalYearReportPrint', {'classname': 'FiscalYearLedger', "PRINT_MODE": 3}, False)
@@ -1531,6 +1920,20 @@ class CostAccountingTest(EntryTest):
         self.assert_observer('core.print', 'diacamma.accounting', 'costAccountingReportPrint')
         self.save_pdf()
 
+    def test_trialbalance_filter(self):
+        self.factory.xfer = CostAccountingTrialBalance()
+        self.calljson('/diacamma.accounting/costAccountingTrialBalance', {'costaccounting': '2'}, False)
+        self.assert_observer('core.custom', 'diacamma.accounting', 'costAccountingTrialBalance')
+        self.assert_count_equal('report_2', 5)
+        self.assert_json_equal('', 'report_2/@0/designation', '[602] 602')
+        self.assert_json_equal('', 'report_2/@0/total_debit', 63.94)
+        self.assert_json_equal('', 'report_2/@1/designation', '[607] 607')
+        self.assert_json_equal('', 'report_2/@1/total_debit', 194.08)
+        self.assert_json_equal('', 'report_2/@2/designation', '[707] 707')
+        self.assert_json_equal('', 'report_2/@2/total_credit', 70.64)
+        self.assertAlmostEqual(abs(float(EntryLineAccount.objects.filter(costaccounting_id=2, account__code='707').aggregate(Sum('amount'))['amount__sum'])), 70.64, 2)
+        self.assertNotAlmostEqual(abs(float(EntryLineAccount.objects.filter(account__code='707').aggregate(Sum('amount'))['amount__sum'])), 70.64, 2)
+
     def test_recreate(self):
         old_year = create_year(0, 2021)
         old_year.begin = '2020-07-01'
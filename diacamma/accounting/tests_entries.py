@@ -27,7 +27,11 @@ from shutil import rmtree
 from datetime import date
 from _io import StringIO
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from lucterios.framework.test import LucteriosTest
+from lucterios.framework.error import LucteriosException
 from lucterios.framework.filetools import get_user_dir
 from lucterios.CORE.parameters import Params
 
@@ -39,7 +43,8 @@ from diacamma.accounting.views_entries import EntryAccountList, \
     EntryLineAccountDel, EntryAccountUnlock, EntryAccountImport
 from diacamma.accounting.test_tools import default_compta_fr, initial_thirds_fr, \
     fill_entries_fr, default_costaccounting, fill_thirds_fr, fill_accounts_fr
-from diacamma.accounting.models import EntryAccount, CostAccounting, FiscalYear
+from diacamma.accounting.models import EntryAccount, CostAccounting, FiscalYear, EntryLineAccount, EntryLineDayBalance
+from diacamma.accounting.tools import encode_serial_line, decode_serial
 from diacamma.accounting.views_other import CostAccountingAddModify
 from diacamma.accounting.views import ThirdShow
 from diacamma.accounting.views_accounts import FiscalYearBegin, FiscalYearClose, \
@@ -445,7 +450,7 @@ class EntryTest(LucteriosTest):
         self.assertEqual(self.response_json['action']['id'], "diacamma.accounting/entryAccountEdit")
         self.assertEqual(len(self.response_json['action']['params']), 1)
         serial_value = self.response_json['action']['params']['serial_entry']
-        self.assertEqual(serial_value[-25:], "|3|0|152.340000|0|0|ccdd|")
+        self.assertEqual(serial_value[-23:], ",3,0,152.34,0,0,\"ccdd\"]")
 
     def test_valid_entry(self):
         self.factory.xfer = EntryAccountEdit()
@@ -639,7 +644,7 @@ class EntryTest(LucteriosTest):
         self.assertEqual(len(self.response_json['action']['params']), 5)
         self.assertEqual(self.response_json['action']['params']['entryaccount'], 2)
         self.assertEqual(self.response_json['action']['params']['linked_entryaccount'], 1)
-        self.assertEqual(self.response_json['action']['params']['serial_entry'][-26:-1], "|4|3|-152.340000|0|0|None")
+        self.assertEqual(self.response_json['action']['params']['serial_entry'][-22:], ",4,3,-152.34,0,0,null]")
         self.assertEqual(self.response_json['action']['params']['num_cpt_txt'], "5")
         self.assertEqual(self.response_json['action']['params']['journal'], "4")
         self.assertEqual(len(self.json_context), 3)
@@ -739,7 +744,7 @@ class EntryTest(LucteriosTest):
         self.assert_observer('core.acknowledge', 'diacamma.accounting', 'entryAccountCreateLinked')
         self.assertEqual(self.response_json['action']['id'], "diacamma.accounting/entryAccountEdit")
         self.assertEqual(len(self.response_json['action']['params']), 5)
-        self.assertEqual(self.response_json['action']['params']['serial_entry'][-26:-1], "|4|3|-152.340000|0|0|None")
+        self.assertEqual(self.response_json['action']['params']['serial_entry'][-22:], ",4,3,-152.34,0,0,null]")
         self.assertEqual(len(self.json_context), 3)
 
         self.assertEqual(2, EntryAccount.objects.all().count())
@@ -914,7 +919,7 @@ class EntryTest(LucteriosTest):
         self.assert_observer('core.acknowledge', 'diacamma.accounting', 'entryLineAccountDel')
         self.assertEqual(self.response_json['action']['id'], "diacamma.accounting/entryAccountEdit")
         self.assertEqual(len(self.response_json['action']['params']), 1)
-        self.assertEqual(self.response_json['action']['params']['serial_entry'], "1|9|0|364.910000|0|0|None|")
+        self.assertEqual(self.response_json['action']['params']['serial_entry'], "[2,1,9,0,364.91,0,0,null]")
         self.assertEqual(len(self.json_context), 3)
         self.assertEqual(self.json_context['entryaccount'], "1")
         self.assertEqual(self.json_context['year'], "1")
@@ -1024,6 +1029,46 @@ class EntryTest(LucteriosTest):
                                                                    'num_cpt': '4', 'third': 0, 'debit_val': '0.0', 'credit_val': '152.34'}, False)
         self.assert_observer('core.acknowledge', 'diacamma.accounting', 'entryLineAccountAdd')
 
+    def test_serial_codec(self):
+        records = decode_serial("-1|4|0|152.340000|0|0|None|\n-2|12|0|152.340000|0|0|ch N°1|")
+        self.assertEqual(records, [(-1, 4, 0, 152.34, 0, 0, None), (-2, 12, 0, 152.34, 0, 0, 'ch N°1')])
+        serial_entry = "\n".join([encode_serial_line(*record) for record in records])
+        self.assertEqual(serial_entry, '[2,-1,4,0,152.34,0,0,null]\n[2,-2,12,0,152.34,0,0,"ch N°1"]')
+        self.assertEqual(decode_serial(serial_entry), records)
+        with self.assertRaises(LucteriosException):
+            decode_serial('[1,-1,4,0,152.34,0,0,null]')
+
+        entry = EntryAccount(year=FiscalYear.get_current(), journal_id=2)
+        with self.assertNumQueries(1):
+            lines = entry.get_entrylineaccounts(serial_entry)
+        self.assertEqual([line.account.code for line in lines], ['401', '602'])
+        with self.assertNumQueries(0):
+            self.assertEqual(entry.serial_control(serial_entry), (False, 0, 0))
+            self.assertEqual(len(entry.get_entrylineaccounts(serial_entry)), 2)
+
+    def test_save_entrylines_balances(self):
+        def get_nb_queries(nb_lines):
+            entry = EntryAccount.objects.create(year=FiscalYear.get_current(), journal_id=2, date_value='2015-02-13', designation='lines %d' % nb_lines)
+            serial_entry = "\n".join([encode_serial_line(-1 - idx, 12, 0, 10.0, 0, 0, None) for idx in range(nb_lines)] + [encode_serial_line(-99, 4, 0, 10.0 * nb_lines, 0, 0, None)])
+            with CaptureQueriesContext(connection) as queries:
+                entry.save_entrylineaccounts(serial_entry)
+            self.assertEqual(entry.entrylineaccount_set.count(), nb_lines + 1)
+            return len(queries)
+        nb_queries_2 = get_nb_queries(2)
+        nb_queries_12 = get_nb_queries(12)
+        # balances updated once for the entry: only the insertion and the computed designation of each line remain
+        self.assertLessEqual(nb_queries_12 - nb_queries_2, 2 * 10)
+        self.assertEqual(EntryLineDayBalance.check_balances(FiscalYear.get_current()), [])
+
+    def test_serial_codec_v1(self):
+        # serials of version 1 saved or built before the JSON codec
+        self.assertEqual(decode_serial("1|9|0|364.910000|0|0|None|"), [(1, 9, 0, 364.91, 0, 0, None)])
+        self.assertEqual(decode_serial("-3|3|0|152.340000|0|0|ccdd|"), [(-3, 3, 0, 152.34, 0, 0, 'ccdd')])
+        self.assertEqual(decode_serial("-2|4|3|-152.340000|0|0|None|\n"), [(-2, 4, 3, -152.34, 0, 0, None)])
+        records = decode_serial("-1|1|3|48.430000|0|0|None|\n-2|2|0|-48.430000|0|0|None|\n-3|11|0|37.910000|2|0|None|")
+        self.assertEqual(records, [(-1, 1, 3, 48.43, 0, 0, None), (-2, 2, 0, -48.43, 0, 0, None), (-3, 11, 0, 37.91, 2, 0, None)])
+        self.assertEqual(decode_serial("\n".join([encode_serial_line(*record) for record in records])), records)
+
     def test_import_entries(self):
         default_costaccounting()
         fill_thirds_fr()
@@ -1140,6 +1185,33 @@ class EntryTest(LucteriosTest):
         self.assert_json_equal('', 'entryline/@9/costaccounting', None)
         self.assert_json_equal('', 'entryline/@9/debit', -37.01)
 
+    def test_import_entries_chunked(self):
+        fill_thirds_fr()
+        csv_content = "date;code;description;debit;credit;third\n"
+        for entry_idx in range(1, 31):
+            csv_content += "%02d/10/2015;411;Facture %d;;%d.50;Dalton Joe\n" % (entry_idx, entry_idx, entry_idx)
+            csv_content += "%02d/10/2015;512;Facture %d;%d.50;;\n" % (entry_idx, entry_idx, entry_idx)
+        csv_content += "31/10/2015;411;Inconnu;;12.00;Nobody\n31/10/2015;512;Inconnu;12.00;;\n"
+        old_chunk_size = EntryLineAccount.IMPORT_CHUNK_SIZE
+        EntryLineAccount.IMPORT_CHUNK_SIZE = 7
+        try:
+            self.factory.xfer = EntryAccountImport()
+            self.calljson('/diacamma.accounting/entryAccountImport', {'step': 4, 'year': 1, 'journal': 3, 'quotechar': "'", 'delimiter': ';',
+                                                                      'encoding': 'utf-8', 'dateformat': '%d/%m/%Y', 'importcontent0': csv_content,
+                                                                      "fld_entry.date_value": "date", "fld_entry.designation": "description", "fld_account": "code",
+                                                                      'fld_debit': 'debit', 'fld_credit': 'credit', 'fld_third': 'third'}, False)
+        finally:
+            EntryLineAccount.IMPORT_CHUNK_SIZE = old_chunk_size
+        self.assert_observer('core.custom', 'diacamma.accounting', 'entryAccountImport')
+        self.assert_json_equal('LABELFORM', 'result', "31 éléments ont été importés")
+        self.assert_json_equal('LABELFORM', 'import_error', ["Tiers 'Nobody' inconnu !"])
+        self.assert_count_equal('entryline', 62)
+        self.assertEqual(EntryAccount.objects.filter(journal_id=3, close=False).count(), 31)
+        self.assertEqual(EntryLineAccount.objects.filter(third__isnull=False).count(), 30)
+        self.assert_json_equal('', 'entryline/@0/entry.date_value', '2015-10-01')
+        self.assert_json_equal('', 'entryline/@0/entry_account', '[411 Dalton Joe]')
+        self.assert_json_equal('', 'entryline/@0/credit', 1.50)
+
     def test_link_entries_multiyear(self):
         # data last year
         self.factory.xfer = FiscalYearBegin()
@@ -23,14 +23,24 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
+from time import time
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from json import dumps, loads
+from lxml import etree
+from apscheduler.jobstores.base import ConflictingIdError
 
-from django.utils.translation import gettext_lazy as _
+from django.utils.translation import gettext_lazy as _, get_language
+from django.core.cache import cache
+from django.db import transaction
 
 from lucterios.CORE.parameters import Params
 
 from diacamma.accounting.system import get_accounting_system
 from lucterios.framework.tools import format_to_string
 from lucterios.framework.models import extract_format
+from lucterios.framework.error import LucteriosException, IMPORTANT
+from lucterios.framework.model_fields import LucteriosScheduler
 
 
 def current_system_account():
@@ -47,6 +57,122 @@ def clear_system_account():
 
     if hasattr(current_module, 'SYSTEM_ACCOUNT_CACHE'):
         del current_module.SYSTEM_ACCOUNT_CACHE
+    clear_params_snapshot()
+
+
+# values of parameters and derived formats, kept for the current request only (outside a request, parameters are read each time)
+PARAMS_SNAPSHOT = ContextVar('accounting_params_snapshot', default=None)
+
+
+def _get_snapshot_value(key, get_value):
+    snapshot = PARAMS_SNAPSHOT.get()
+    if snapshot is None:
+        return get_value()
+    if key not in snapshot:
+        snapshot[key] = get_value()
+    return snapshot[key]
+
+
+def get_param_snapshot(name):
+    return _get_snapshot_value(name, lambda: Params.getvalue(name))
+
+
+def start_params_snapshot(*args, **kwargs):
+    PARAMS_SNAPSHOT.set({})
+
+
+def stop_params_snapshot(*args, **kwargs):
+    PARAMS_SNAPSHOT.set(None)
+
+
+def clear_params_snapshot(*args, **kwargs):
+    snapshot = PARAMS_SNAPSHOT.get()
+    if snapshot is not None:
+        snapshot.clear()
+
+
+def add_scheduled_job(callback, job_id, delay, **kwargs):
+    '''Queue a callback in LucteriosScheduler under its own identifier, return False if this identifier is already queued'''
+    try:
+        LucteriosScheduler.get_scheduler().add_job(callback, 'date', run_date=datetime.now() + timedelta(seconds=delay), id=job_id, kwargs=kwargs)
+        return True
+    except ConflictingIdError:
+        return False
+
+
+def has_scheduled_job(job_id):
+    return LucteriosScheduler.get_scheduler().get_job(job_id) is not None
+
+
+def remove_scheduled_job(job_id):
+    if has_scheduled_job(job_id):
+        LucteriosScheduler.get_scheduler().remove_job(job_id)
+
+
+LEDGER_VERSION_KEY = 'diacamma_accounting_ledger_version'
+
+
+def get_ledger_version():
+    version = cache.get(LEDGER_VERSION_KEY)
+    if version is None:
+        # seeded with the clock so that a flushed cache never reuses an old version
+        cache.add(LEDGER_VERSION_KEY, int(time() * 1000), timeout=None)
+        version = cache.get(LEDGER_VERSION_KEY)
+    return version
+
+
+def increment_ledger_version():
+    get_ledger_version()
+    try:
+        cache.incr(LEDGER_VERSION_KEY)
+    except ValueError:
+        cache.add(LEDGER_VERSION_KEY, int(time() * 1000), timeout=None)
+
+
+def bump_ledger_version(*args, **kwargs):
+    # increment once the transaction is committed
+    transaction.on_commit(increment_ledger_version)
+
+
+SERIAL_VERSION = 2
+
+
+def encode_serial_line(line_id, account_id, third_id, amount, costaccounting_id, link_id, reference):
+    # version 2: compact JSON array "[2,<id>,<account id>,<third id> or 0,<amount>,<cost id> or 0,<link id> or 0,<reference> or null]"
+    return dumps([SERIAL_VERSION, line_id, account_id, third_id or 0, round(float(amount), 6), costaccounting_id or 0, link_id or 0, reference],
+                 separators=(',', ':'), ensure_ascii=False)
+
+
+def decode_serial(serial_vals):
+    records = []
+    for serial_val in serial_vals.split('\n'):
+        if serial_val == '':
+            continue
+        if serial_val.startswith('['):
+            values = loads(serial_val)
+            if values[0] != SERIAL_VERSION:
+                raise LucteriosException(IMPORTANT, _('Unknown version of entry serial!'))
+            records.append(tuple(values[1:8]))
+        else:
+            # version 1: "<id>|<accound id>|<third id> or 0|<amount>|<cost id> or 0|<link id> or 0|<reference> or None|"
+            values = serial_val.split('|')
+            reference = "".join(values[6:-1])
+            if reference.startswith("None"):
+                reference = None
+            records.append((int(values[0]), int(values[1]), int(values[2]), float(values[3]), int(values[4]), int(values[5]), reference))
+    return records
+
+
+def xml_file_validator(xml_file, xsd_file):
+    try:
+        schema = etree.XMLSchema(file=xsd_file)
+        for _event, element in etree.iterparse(xml_file, events=('end',), schema=schema):
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        return None
+    except etree.XMLSyntaxError as xml_error:
+        return str(xml_error)
 
 
 def get_amount_sum(val):
@@ -57,7 +183,7 @@ def get_amount_sum(val):
 
 
 def currency_round(amount):
-    currency_decimal = Params.getvalue("accounting-devise-prec")
+    currency_decimal = get_param_snapshot("accounting-devise-prec")
     try:
         return round(float(amount), currency_decimal)
     except Exception:
@@ -67,7 +193,7 @@ def currency_round(amount):
 def correct_accounting_code(code):
     code = code.strip()
     if current_system_account().has_minium_code_size() and (code != ''):
-        code_size = Params.getvalue("accounting-sizecode")
+        code_size = get_param_snapshot("accounting-sizecode")
         if code == '0' * code_size:
             return ''
         while len(code) > code_size and code[-1] == '0':
@@ -86,9 +212,13 @@ def get_currency_symbole(iso_ident):
 
 
 def format_with_devise(mode):
+    return _get_snapshot_value(('format_with_devise', mode, get_language()), lambda: _get_format_with_devise(mode))
+
+
+def _get_format_with_devise(mode):
     result = []
-    currency_iso = Params.getvalue("accounting-devise-iso")
-    currency_decimal = Params.getvalue("accounting-devise-prec")
+    currency_iso = get_param_snapshot("accounting-devise-iso")
+    currency_decimal = get_param_snapshot("accounting-devise-prec")
     result.append('C%d%s' % (currency_decimal, currency_iso))
     if mode == 0:  # 25.45 => 25,45€ / -25.45 => / 0 =>
         result.append('%s')
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+'''
+Automatic lettering of third account lines
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from itertools import groupby, combinations
+from logging import getLogger
+from time import time
+
+from lucterios.CORE.parameters import Params
+
+from diacamma.accounting.models import EntryLineAccount, AccountLink
+
+
+class ThirdLineMatcher(object):
+
+    def __init__(self, year, account_code='', max_subset_size=4, max_candidates=16):
+        self.year = year
+        self.account_code = account_code
+        self.max_subset_size = max_subset_size
+        self.max_candidates = max_candidates
+        self.stats = {}
+
+    def get_open_lines(self):
+        lines = EntryLineAccount.objects.filter(entry__year=self.year, link__isnull=True, account__flag_third=True)
+        lines = lines.exclude(account__code__in=Params.getvalue("accounting-lettering-check"))
+        if self.account_code != '':
+            lines = lines.filter(account__code__startswith=self.account_code)
+        lines = lines.values_list('account__code', 'third_id', 'id', 'amount', 'reference').order_by('account__code', 'third_id', 'entry__date_value', 'id')
+        return lines.iterator(chunk_size=2000)
+
+    def _match_pairs(self, lines):
+        pairs = []
+        lines_by_amount = {}
+        for line in lines:
+            lines_by_amount.setdefault(line[1], []).append(line)
+        used_ids = set()
+        for line in lines:
+            if (line[0] in used_ids) or (line[1] <= 0):
+                continue
+            candidates = [other for other in lines_by_amount.get(-line[1], []) if other[0] not in used_ids]
+            if len(candidates) == 0:
+                continue
+            same_ref = [other for other in candidates if (line[2] or '') != '' and other[2] == line[2]]
+            other = same_ref[0] if len(same_ref) > 0 else candidates[0]
+            used_ids.add(line[0])
+            used_ids.add(other[0])
+            pairs.append([line[0], other[0]])
+        return pairs, [line for line in lines if line[0] not in used_ids]
+
+    def _is_balanced(self, lines):
+        return abs(sum([line[1] for line in lines])) <= 0.0001
+
+    def _match_subsets(self, lines):
+        subsets = []
+        if (len(lines) > 1) and self._is_balanced(lines):
+            return [[line[0] for line in lines]], []
+        if len(lines) > self.max_candidates:
+            return self._match_nearest_subsets(lines)
+        for subset_size in range(2, min(self.max_subset_size, len(lines)) + 1):
+            found = True
+            while found:
+                found = False
+                for subset in combinations(lines, subset_size):
+                    if self._is_balanced(subset):
+                        subsets.append([line[0] for line in subset])
+                        lines = [line for line in lines if line not in subset]
+                        found = True
+                        break
+        return subsets, lines
+
+    def _match_nearest_subsets(self, lines):
+        # too many lines for an exhaustive search: balance each line with its nearest candidates (in date order) only
+        subsets = []
+        half_window = self.max_candidates // 2
+        index = 0
+        while index < len(lines):
+            anchor = lines[index]
+            first = max(0, min(index - half_window, len(lines) - self.max_candidates))
+            others = [other for other in lines[first:first + self.max_candidates] if other is not anchor]
+            subset = None
+            for subset_size in range(1, self.max_subset_size):
+                for candidates in combinations(others, subset_size):
+                    if self._is_balanced((anchor,) + candidates):
+                        subset = (anchor,) + candidates
+                        break
+                if subset is not None:
+                    break
+            if subset is not None:
+                subsets.append([line[0] for line in subset])
+                index -= len([line for line in lines[:index] if line in subset])
+                lines = [line for line in lines if line not in subset]
+            else:
+                index += 1
+        return subsets, lines
+
+    def match_group(self, lines):
+        pairs, lines = self._match_pairs(lines)
+        subsets, lines = self._match_subsets(lines)
+        return pairs + subsets
+
+    def search(self):
+        groups = []
+        nb_lines = 0
+        nb_thirds = 0
+        for _third_key, third_lines in groupby(self.get_open_lines(), key=lambda line: (line[0], line[1])):
+            third_lines = [(line_id, float(amount), reference) for _code, _third, line_id, amount, reference in third_lines]
+            nb_lines += len(third_lines)
+            nb_thirds += 1
+            groups.extend(self.match_group(third_lines))
+        self.stats['lines'] = nb_lines
+        self.stats['thirds'] = nb_thirds
+        return groups
+
+    def run(self):
+        begin = time()
+        groups = self.search()
+        errors = AccountLink.create_links(groups) if len(groups) > 0 else []
+        duration = max(time() - begin, 0.000001)
+        self.stats['links'] = len([error for error in errors if error is None])
+        self.stats['lettered'] = sum([len(group) for group, error in zip(groups, errors) if error is None])
+        self.stats['errors'] = len(errors) - self.stats['links']
+        self.stats['duration'] = duration
+        self.stats['lines_per_second'] = self.stats['lines'] / duration
+        getLogger("diacamma.accounting").info(' * automatic lettering of %s: lines=%d thirds=%d links=%d lettered=%d errors=%d in %.3fs (%.0f lines/s)',
+                                              self.year, self.stats['lines'], self.stats['thirds'], self.stats['links'], self.stats['lettered'],
+                                              self.stats['errors'], duration, self.stats['lines_per_second'])
+        return self.stats
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+'''
+Opt-in SQL and timing profiling of Xfer actions
+
+To enable it, add 'diacamma.accounting.tools_profiling.ProfilingMiddleware' to MIDDLEWARE of the instance settings:
+each action of accounting, invoice and payoff is then logged in 'profiling.log' of user directory.
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from collections import Counter
+from json import dumps
+from logging import getLogger, Formatter
+from logging.handlers import RotatingFileHandler
+from os.path import join
+from re import compile as re_compile
+from time import time
+
+from django.db import connection
+
+from lucterios.framework.xferbasic import XferContainerAbstract
+from lucterios.framework.filetools import get_user_dir
+
+PROFILED_MODULES = ('diacamma.accounting.', 'diacamma.invoice.', 'diacamma.payoff.')
+PROFILING_LOGGER = "diacamma.profiling"
+PROFILING_LOGSIZE = 5 * 1024 * 1024
+PROFILING_LOGCOUNT = 5
+
+SQL_STRING = re_compile(r"'(?:[^']|'')*'")
+SQL_NUMBER = re_compile(r"\b\d+(?:\.\d+)?\b")
+SQL_LIST = re_compile(r"\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)")
+
+
+def get_sql_template(sql):
+    sql = SQL_STRING.sub('?', sql)
+    sql = SQL_NUMBER.sub('?', sql)
+    return SQL_LIST.sub('(...)', sql)
+
+
+class ActionProfiler(object):
+
+    def __init__(self, url_text=''):
+        self.url_text = url_text
+        self.nb_queries = 0
+        self.sql_time = 0.0
+        self.duration = 0.0
+        self.templates = Counter()
+        self._begin = None
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        begin = time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time() - begin
+            self.nb_queries += 1
+            self.templates[get_sql_template(sql)] += 1
+
+    def start(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        self._begin = time()
+        return self
+
+    def stop(self):
+        if self._wrapper is not None:
+            self.duration = time() - self._begin
+            self._wrapper.__exit__(None, None, None)
+            self._wrapper = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def python_time(self):
+        return max(self.duration - self.sql_time, 0.0)
+
+    def get_repeated_queries(self, min_count=2, nb_max=5):
+        return [(template, count) for template, count in self.templates.most_common(nb_max) if count >= min_count]
+
+    def get_stats(self):
+        return {'action': self.url_text, 'queries': self.nb_queries, 'sql_time': round(self.sql_time, 6),
+                'python_time': round(self.python_time, 6), 'repeated': self.get_repeated_queries()}
+
+    def log(self):
+        getLogger(PROFILING_LOGGER).info(dumps(self.get_stats()))
+
+
+class ProfilingMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        profiling_logger = getLogger(PROFILING_LOGGER)
+        if len(profiling_logger.handlers) == 0:
+            handler = RotatingFileHandler(join(get_user_dir(), 'profiling.log'), maxBytes=PROFILING_LOGSIZE, backupCount=PROFILING_LOGCOUNT)
+            handler.setFormatter(Formatter('%(asctime)s %(message)s'))
+            profiling_logger.addHandler(handler)
+            profiling_logger.setLevel('INFO')
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            profiler = getattr(request, 'diacamma_profiler', None)
+            if profiler is not None:
+                profiler.stop().log()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        if (view_class is not None) and issubclass(view_class, XferContainerAbstract) and view_class.__module__.startswith(PROFILED_MODULES):
+            request.diacamma_profiler = ActionProfiler(view_class.url_text).start()
+        return None
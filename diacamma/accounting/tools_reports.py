@@ -23,12 +23,27 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
+from re import match
+from datetime import date, timedelta
+from os import remove
+from os.path import join, isfile
+from csv import writer
+from time import time
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+from logging import getLogger
 
-from django.db.models import Q
+from django.db.models import Q, F, Value, Case, When, FloatField
 from django.db.models.aggregates import Sum
+from django.db.models.functions import Coalesce, TruncMonth
 
-from diacamma.accounting.models import EntryLineAccount, ChartsAccount, Budget, Third
-from diacamma.accounting.tools import correct_accounting_code
+from lucterios.framework.tools import get_format_value
+from lucterios.framework.filetools import get_user_path
+from lucterios.CORE.parameters import Params
+
+from diacamma.accounting.models import EntryLineAccount, ChartsAccount, Budget, Third, FiscalYear, EntryAccount, AccountLink, CostAccounting, Journal
+from diacamma.accounting.tools import correct_accounting_code, current_system_account, get_ledger_version
 
 
 def get_spaces(size):
@@ -46,100 +61,483 @@ def credit_debit_way(data_line):
     return 0
 
 
-def get_totalaccount_for_query(query, sign_value=None, with_third=False):
-    total = 0
-    values = {}
-    if with_third:
-        fields = ['account', 'third']
+def get_signed_amount(amount, way, sign_value):
+    if sign_value is None:
+        return amount
+    elif isinstance(sign_value, bool):
+        if sign_value:
+            return way * amount
+        else:
+            return -1 * way * amount
     else:
-        fields = ['account']
-    for data_line in EntryLineAccount.objects.filter(query).order_by(*fields).values(*fields).annotate(data_sum=Sum('amount')):
-        if abs(data_line['data_sum']) > 0.001:
-            account = ChartsAccount.objects.get(id=data_line['account'])
-            account_code = correct_accounting_code(account.code)
-            if ('third' in data_line.keys()) and (data_line['third'] is not None):
-                account_code = "%s#%s" % (account_code, data_line['third'])
-                third = Third.objects.get(id=data_line['third'])
-                account_title = "[%s %s]" % (account.code, str(third))
-            else:
-                account_title = account.get_name()
-            amount = None
-            if sign_value is None:
-                amount = data_line['data_sum']
-            elif isinstance(sign_value, bool):
-                if sign_value:
-                    amount = credit_debit_way(data_line) * data_line['data_sum']
+        amount = sign_value * way * amount
+        if (amount < 0):
+            return None
+        return amount
+
+
+class EntryLineTotals(object):
+
+    def __init__(self, query, with_third=False):
+        self.with_third = with_third
+        fields = ['account', 'account__code', 'account__name', 'account__type_of_account']
+        if with_third:
+            fields.append('third')
+        self.lines = list(EntryLineAccount.objects.filter(query).values(*fields).annotate(data_sum=Sum('amount')).order_by())
+        self.lines.sort(key=lambda data_line: (data_line['account'], data_line['third'] if data_line.get('third') is not None else -1))
+        self.lines_by_code = {}
+        for data_line in self.lines:
+            data_line['way'] = ChartsAccount(type_of_account=data_line['account__type_of_account']).credit_debit_way()
+            if data_line['account__code'] not in self.lines_by_code:
+                self.lines_by_code[data_line['account__code']] = []
+            self.lines_by_code[data_line['account__code']].append(data_line)
+        self.third_names = None
+
+    def get_third_name(self, third_id):
+        if self.third_names is None:
+            third_ids = set([data_line['third'] for data_line in self.lines if data_line['third'] is not None])
+            third_list = Third.objects.filter(id__in=third_ids).select_related('contact', 'contact__legalentity', 'contact__individual')
+            self.third_names = {third.id: str(third) for third in third_list}
+        return self.third_names[third_id]
+
+    def get_values(self, sign_value=None, exclude_codes=None):
+        total = 0
+        values = {}
+        for data_line in self.lines:
+            if (exclude_codes is not None) and (data_line['account__code'] in exclude_codes):
+                continue
+            if abs(data_line['data_sum']) > 0.001:
+                account_code = correct_accounting_code(data_line['account__code'])
+                if self.with_third and (data_line['third'] is not None):
+                    account_title = "[%s %s]" % (data_line['account__code'], self.get_third_name(data_line['third']))
+                    account_code = "%s#%s" % (account_code, data_line['third'])
                 else:
-                    amount = -1 * credit_debit_way(data_line) * data_line['data_sum']
-            else:
-                amount = sign_value * credit_debit_way(data_line) * data_line['data_sum']
-                if (amount < 0):
-                    amount = None
-            if amount is not None:
-                if account_code not in values.keys():
-                    values[account_code] = [0, account_title]
-                values[account_code][0] += amount
-                total += amount
-    return values, total
+                    account_title = "[%s] %s" % (account_code, data_line['account__name'])
+                amount = get_signed_amount(data_line['data_sum'], data_line['way'], sign_value)
+                if amount is not None:
+                    if account_code not in values.keys():
+                        values[account_code] = [0, account_title]
+                    values[account_code][0] += amount
+                    total += amount
+        return values, total
 
+    def get_total(self, account_codethird, sign_value=None):
+        account_code_and_third = account_codethird.split('#')
+        third_id = int(account_code_and_third[1]) if len(account_code_and_third) == 2 else None
+        account_sums = {}
+        for data_line in self.lines_by_code.get(account_code_and_third[0], []):
+            if (third_id is None) or (data_line.get('third') == third_id):
+                if data_line['account'] not in account_sums:
+                    account_sums[data_line['account']] = [0, data_line['way']]
+                account_sums[data_line['account']][0] += data_line['data_sum']
+        total = 0
+        for data_sum, way in account_sums.values():
+            if abs(data_sum) > 0.001:
+                amount = get_signed_amount(data_sum, way, sign_value)
+                if amount is not None:
+                    total += amount
+        return total
 
-def get_account_total(query, account_codethird, sign_value=None):
-    total = 0
-    account_code_and_third = account_codethird.split('#')
-    if len(account_code_and_third) == 2:
-        extra_filter = Q(account__code=account_code_and_third[0]) & Q(third_id=int(account_code_and_third[1]))
-    else:
-        extra_filter = Q(account__code=account_code_and_third[0])
-    for data_line in EntryLineAccount.objects.filter(query & extra_filter).order_by('account').values('account').annotate(data_sum=Sum('amount')):
-        if abs(data_line['data_sum']) > 0.001:
-            amount = None
-            if sign_value is None:
-                amount = data_line['data_sum']
-            elif isinstance(sign_value, bool):
-                if sign_value:
-                    amount = credit_debit_way(data_line) * data_line['data_sum']
+
+class BudgetTotals(object):
+
+    def __init__(self, query):
+        self.values = {data_line['code']: data_line['data_sum'] for data_line in Budget.objects.filter(query).values('code').annotate(data_sum=Sum('amount')).order_by()}
+        self.ways = None
+
+    def get_way(self, code):
+        if self.ways is None:
+            account_types = {}
+            current_codes = [correct_accounting_code(budget_code) for budget_code in self.values.keys()]
+            for account_code, type_of_account in ChartsAccount.objects.filter(year=FiscalYear.get_current(), code__in=current_codes).values_list('code', 'type_of_account'):
+                account_types[account_code] = type_of_account
+            self.ways = {}
+            for budget_code in self.values.keys():
+                account_code = correct_accounting_code(budget_code)
+                if account_code in account_types:
+                    type_of_account = account_types[account_code]
                 else:
-                    amount = -1 * credit_debit_way(data_line) * data_line['data_sum']
-            else:
-                amount = sign_value * credit_debit_way(data_line) * data_line['data_sum']
-                if (amount < 0):
-                    amount = None
+                    type_of_account = current_system_account().new_charts_account(account_code)[1]
+                self.ways[budget_code] = ChartsAccount(type_of_account=type_of_account).credit_debit_way()
+        return self.ways[code]
+
+    def get_total(self, account_codethird, sign_value=None):
+        account_code = account_codethird.split('#')[0]
+        data_sum = self.values.get(account_code, 0)
+        if abs(data_sum) > 0.001:
+            amount = get_signed_amount(data_sum, self.get_way(account_code) if sign_value is not None else 0, sign_value)
             if amount is not None:
-                total += amount
-    return total
+                return amount
+        return 0
 
 
-def get_budget_total(query, account_codethird, sign_value=None):
-    total = 0
-    account_code_and_third = account_codethird.split('#')
-    extra_filter = Q(code=account_code_and_third[0])
-    for data_line in Budget.objects.filter(query & extra_filter).order_by('code').values('code').annotate(data_sum=Sum('amount')):
-        if abs(data_line['data_sum']) > 0.001:
-            amount = None
-            if sign_value is None:
-                amount = data_line['data_sum']
-            elif isinstance(sign_value, bool):
-                if sign_value:
-                    amount = credit_debit_way(data_line) * data_line['data_sum']
+class ComparativeTotals(object):
+
+    def __init__(self, query, year_ids, by_month=False):
+        entrylines = EntryLineAccount.objects.filter(query)
+        if by_month:
+            entrylines = entrylines.annotate(period=TruncMonth('entry__date_value'))
+        else:
+            entrylines = entrylines.annotate(period=F('entry__year_id'))
+        self.amounts = {}
+        for data_line in entrylines.values('period', 'account__code', 'account__type_of_account').annotate(data_sum=Sum('amount')).order_by():
+            account_key = (data_line['account__type_of_account'], correct_accounting_code(data_line['account__code']))
+            if account_key not in self.amounts:
+                self.amounts[account_key] = {}
+            self.amounts[account_key][data_line['period']] = self.amounts[account_key].get(data_line['period'], 0.0) + data_line['data_sum']
+        self.account_names = {}
+        codes = set([account_code for _type_of_account, account_code in self.amounts.keys()])
+        for account_code, account_name in ChartsAccount.objects.filter(year_id__in=year_ids, code__in=codes).order_by('year__begin').values_list('code', 'name'):
+            self.account_names[account_code] = account_name
+
+    def get_values(self, type_of_account, periods):
+        values = []
+        totals = [0.0 for _period in periods]
+        for account_type, account_code in sorted(self.amounts.keys(), key=lambda account_key: account_key[1]):
+            if account_type != type_of_account:
+                continue
+            amounts = [self.amounts[(account_type, account_code)].get(period, 0.0) for period in periods]
+            if max([abs(amount) for amount in amounts]) > 0.001:
+                values.append(("[%s] %s" % (account_code, self.account_names.get(account_code, '')), amounts))
+                totals = [total + amount for total, amount in zip(totals, amounts)]
+        return values, totals
+
+
+class CSVEchoBuffer(object):
+
+    def write(self, value):
+        return value
+
+
+class AgingBalance(object):
+
+    BUCKETS = ((0, 30), (31, 60), (61, 90), (91, None))
+
+    def __init__(self, year, reference_date, account_code=''):
+        self.year = year
+        self.reference_date = reference_date
+        self.query = Q(entry__year=year) & Q(entry__date_value__lte=reference_date) & Q(account__flag_third=True) & Q(third__isnull=False)
+        self.query &= Q(link__isnull=True) | Q(link__date_max__gt=reference_date)
+        if account_code != '':
+            self.query &= Q(account__code__startswith=account_code)
+        self.third_names = {}
+        self._origin_dates = None
+
+    def get_bucket_filter(self, min_age, max_age):
+        bucket_filter = Q(entry__date_value__lte=self.reference_date - timedelta(days=min_age))
+        if max_age is not None:
+            bucket_filter &= Q(entry__date_value__gte=self.reference_date - timedelta(days=max_age))
+        return bucket_filter
+
+    def get_bucket_index(self, age):
+        for bucket_idx, (min_age, max_age) in enumerate(self.BUCKETS):
+            if (age >= min_age) and ((max_age is None) or (age <= max_age)):
+                return bucket_idx
+        return 0
+
+    @classmethod
+    def _get_line_key(cls, account_code, third_id, amount, reference):
+        return (account_code, third_id, round(float(amount), 4), reference if reference is not None else '')
+
+    def get_origin_dates(self):
+        # A carried-forward line mirrors a line of the third closing entry of the last fiscal year,
+        # itself lettered with the open line it closes: follow this chain to age it from its original date.
+        if self._origin_dates is None:
+            self._origin_dates = {}
+            pending_lines = {}
+            carried_lines = EntryLineAccount.objects.filter(self.query & Q(entry__journal_id=Journal.DEFAULT_LASTYEAR))
+            for line_id, account_code, third_id, amount, reference in carried_lines.values_list('id', 'account__code', 'third_id', 'amount', 'reference').order_by('id'):
+                pending_lines.setdefault(self._get_line_key(account_code, third_id, amount, reference), []).append(line_id)
+            close_title = current_system_account().CLOSE_TITLE_THIRD
+            year = self.year
+            while (len(pending_lines) > 0) and (year.last_fiscalyear_id is not None):
+                year = year.last_fiscalyear
+                carried_by_link = {}
+                closing_lines = EntryLineAccount.objects.filter(entry__year=year, entry__journal_id=Journal.DEFAULT_OTHER, entry__designation=close_title, link__isnull=False)
+                for link_id, account_code, third_id, amount, reference in closing_lines.values_list('link_id', 'account__code', 'third_id', 'amount', 'reference').order_by('id'):
+                    carried_ids = pending_lines.get(self._get_line_key(account_code, third_id, -1 * amount, reference), [])
+                    if len(carried_ids) > 0:
+                        carried_by_link[link_id] = carried_ids.pop(0)
+                pending_lines = {}
+                origin_lines = EntryLineAccount.objects.filter(link_id__in=carried_by_link.keys()).exclude(entry__journal_id=Journal.DEFAULT_OTHER, entry__designation=close_title)
+                for link_id, journal_id, date_value, account_code, third_id, amount, reference in origin_lines.values_list('link_id', 'entry__journal_id', 'entry__date_value', 'account__code', 'third_id', 'amount', 'reference'):
+                    carried_id = carried_by_link[link_id]
+                    self._origin_dates[carried_id] = date_value
+                    if journal_id == Journal.DEFAULT_LASTYEAR:
+                        pending_lines.setdefault(self._get_line_key(account_code, third_id, amount, reference), []).append(carried_id)
+        return self._origin_dates
+
+    @classmethod
+    def get_way(cls, type_of_account):
+        return -1 if type_of_account == ChartsAccount.TYPE_ASSET else 1
+
+    def _load_third_names(self, third_ids):
+        third_ids = set(third_ids) - set(self.third_names.keys())
+        for third in Third.objects.filter(id__in=third_ids).select_related('contact', 'contact__legalentity', 'contact__individual'):
+            self.third_names[third.id] = Third.get_cache_text(third)
+
+    def _complete(self, balance):
+        way = self.get_way(balance['account__type_of_account'])
+        balance['code'] = correct_accounting_code(balance['account__code'])
+        balance['third'] = self.third_names.get(balance['third_id'], '')
+        for fieldname in ['total'] + ['bucket_%d' % bucket_idx for bucket_idx in range(len(self.BUCKETS))]:
+            balance[fieldname] = way * balance[fieldname] if abs(balance[fieldname]) > 0.0001 else 0.0
+        return balance
+
+    def get_balances(self, chunk_size=500):
+        origin_dates = self.get_origin_dates()
+        origin_amounts = {}
+        for line_id, account_code, third_id, amount in EntryLineAccount.objects.filter(id__in=origin_dates.keys()).values_list('id', 'account__code', 'third_id', 'amount'):
+            origin_amounts.setdefault((account_code, third_id), []).append((self.get_bucket_index((self.reference_date - origin_dates[line_id]).days), float(amount)))
+        annotations = {'bucket_%d' % bucket_idx: Coalesce(Sum(Case(When(self.get_bucket_filter(min_age, max_age) & ~Q(id__in=origin_dates.keys()), then='amount'), default=0.0, output_field=FloatField())), 0.0)
+                       for bucket_idx, (min_age, max_age) in enumerate(self.BUCKETS)}
+        balances = EntryLineAccount.objects.filter(self.query).values('account__code', 'account__type_of_account', 'third_id')
+        balances = balances.annotate(total=Sum('amount'), **annotations).order_by('account__code', 'third_id')
+        chunk = []
+        for balance in balances.iterator(chunk_size=chunk_size):
+            for bucket_idx, amount in origin_amounts.get((balance['account__code'], balance['third_id']), []):
+                balance['bucket_%d' % bucket_idx] += amount
+            if abs(balance['total']) > 0.0001:
+                chunk.append(balance)
+            if len(chunk) >= chunk_size:
+                self._load_third_names([balance['third_id'] for balance in chunk])
+                for balance in chunk:
+                    yield self._complete(balance)
+                chunk = []
+        self._load_third_names([balance['third_id'] for balance in chunk])
+        for balance in chunk:
+            yield self._complete(balance)
+
+    def get_lines(self, account_code, third_id):
+        lines = EntryLineAccount.objects.filter(self.query & Q(account__code=account_code) & Q(third_id=third_id))
+        lines = lines.values('id', 'entry_id', 'entry__num', 'entry__date_value', 'entry__designation', 'reference', 'amount', 'account__type_of_account')
+        origin_dates = self.get_origin_dates()
+        for line in lines.order_by('entry__date_value', 'id'):
+            line['age'] = (self.reference_date - origin_dates.get(line['id'], line['entry__date_value'])).days
+            line['amount'] = self.get_way(line['account__type_of_account']) * line['amount']
+            yield line
+
+    def iter_csv(self, separator=';'):
+        prec = Params.getvalue("accounting-devise-prec")
+        csv_writer = writer(CSVEchoBuffer(), delimiter=separator)
+        yield csv_writer.writerow(['code', 'third', 'total'] + ["%d-%d" % (min_age, max_age) if max_age is not None else ">%d" % (min_age - 1) for min_age, max_age in self.BUCKETS])
+        for balance in self.get_balances():
+            yield csv_writer.writerow([balance['code'], balance['third']] + ["%.*f" % (prec, balance[fieldname]) for fieldname in ['total'] + ['bucket_%d' % bucket_idx for bucket_idx in range(len(self.BUCKETS))]])
+
+    def export_csv(self, file_name, separator=';'):
+        begin = time()
+        csv_file = get_user_path("accounting", file_name)
+        nb_lines = 0
+        try:
+            with open(csv_file, 'w', encoding='utf-8', newline='') as csv_output:
+                for csv_line in self.iter_csv(separator):
+                    csv_output.write(csv_line)
+                    nb_lines += 1
+        except Exception:
+            if isfile(csv_file):
+                remove(csv_file)
+            raise
+        getLogger("diacamma.accounting").info(' * aged balance export of %s: lines=%d in %.3fs', self.year, nb_lines - 1, time() - begin)
+        return join("accounting", file_name)
+
+
+class LedgerLines(object):
+
+    FIELDS = ('id', 'amount', 'reference', 'third_id', 'account__code', 'account__name', 'account__type_of_account',
+              'entry_id', 'entry__num', 'entry__date_entry', 'entry__date_value', 'entry__designation', 'link_id', 'link__letter_num', 'link__is_multiyear', 'costaccounting_id')
+    ORDER = ('account__code', 'third_key', 'entry__date_value', 'id')
+
+    def __init__(self, query, after_key=None, chunk_size=2000):
+        self.query = query
+        self.after_key = self.decode_key(after_key) if isinstance(after_key, str) else after_key
+        self.chunk_size = chunk_size
+        self.third_mask = current_system_account().get_third_mask()
+        self.is_third_by_code = {}
+        self.third_names = {}
+        self.link_names = {}
+        self.cost_names = {}
+        self.entry_format = {fieldname: EntryAccount._meta.get_field(fieldname) for fieldname in ('num', 'date_entry', 'date_value')}
+
+    @classmethod
+    def encode_key(cls, data_line):
+        return "%s|%d|%s|%d" % (data_line['account__code'], data_line['third_key'], data_line['entry__date_value'].isoformat(), data_line['id'])
+
+    @classmethod
+    def decode_key(cls, key_text):
+        if (key_text is None) or (key_text == ''):
+            return None
+        account_code, third_key, date_value, line_id = key_text.split('|')
+        return (account_code, int(third_key), date.fromisoformat(date_value), int(line_id))
+
+    def _get_queryset(self):
+        return EntryLineAccount.objects.filter(self.query).annotate(third_key=Coalesce('third_id', Value(0)))
+
+    def _get_after_filter(self):
+        account_code, third_key, date_value, line_id = self.after_key
+        return Q(account__code__gt=account_code) | Q(account__code=account_code, third_key__gt=third_key) | \
+            Q(account__code=account_code, third_key=third_key, entry__date_value__gt=date_value) | \
+            Q(account__code=account_code, third_key=third_key, entry__date_value=date_value, id__gt=line_id)
+
+    def get_carried_totals(self):
+        account_code, third_key = self.after_key[:2]
+        carried_lines = self._get_queryset().filter(Q(account__code=account_code) & ~self._get_after_filter())
+        type_of_account = carried_lines.values_list('account__type_of_account', flat=True).first()
+        totals = carried_lines.aggregate(debit_sum=Coalesce(Sum(Case(When(amount__gt=0, then='amount'), default=0.0, output_field=FloatField())), 0.0),
+                                         credit_sum=Coalesce(Sum(Case(When(amount__lt=0, then='amount'), default=0.0, output_field=FloatField())), 0.0),
+                                         third_debit_sum=Coalesce(Sum(Case(When(amount__gt=0, third_key=third_key, then='amount'), default=0.0, output_field=FloatField())), 0.0),
+                                         third_credit_sum=Coalesce(Sum(Case(When(amount__lt=0, third_key=third_key, then='amount'), default=0.0, output_field=FloatField())), 0.0))
+        return {'account__code': account_code, 'third_id': third_key if third_key != 0 else None,
+                'way': ChartsAccount(type_of_account=type_of_account).credit_debit_way(),
+                'total': [totals['debit_sum'], -1 * totals['credit_sum']],
+                'third_total': [totals['third_debit_sum'], -1 * totals['third_credit_sum']]}
+
+    def is_third(self, account_code):
+        if account_code not in self.is_third_by_code:
+            self.is_third_by_code[account_code] = match(self.third_mask, account_code) is not None
+        return self.is_third_by_code[account_code]
+
+    def _load_names(self, data_lines):
+        entry_ids = set([data_line['entry_id'] for data_line in data_lines if not self.is_third(data_line['account__code'])])
+        entry_thirds = {}
+        for entry_id, third_id in EntryLineAccount.objects.filter(entry_id__in=entry_ids, third__isnull=False).values_list('entry_id', 'third_id').distinct():
+            if entry_id not in entry_thirds:
+                entry_thirds[entry_id] = set()
+            entry_thirds[entry_id].add(third_id)
+        third_ids = set([data_line['third_id'] for data_line in data_lines if data_line['third_id'] is not None])
+        for thirds in entry_thirds.values():
+            third_ids |= thirds
+        third_ids -= set(self.third_names.keys())
+        for third in Third.objects.filter(id__in=third_ids).select_related('contact', 'contact__legalentity', 'contact__individual'):
+            self.third_names[third.id] = Third.get_cache_text(third)
+        for data_line in data_lines:
+            if (data_line['link_id'] is not None) and (data_line['link__letter_num'] is not None):
+                self.link_names[data_line['link_id']] = AccountLink.format_letter(data_line['link__letter_num'], data_line['link__is_multiyear'])
+        link_ids = set([data_line['link_id'] for data_line in data_lines if data_line['link_id'] is not None]) - set(self.link_names.keys())
+        for link in AccountLink.objects.filter(id__in=link_ids):
+            self.link_names[link.id] = str(link)
+        cost_ids = set([data_line['costaccounting_id'] for data_line in data_lines if data_line['costaccounting_id'] is not None]) - set(self.cost_names.keys())
+        for cost in CostAccounting.objects.filter(id__in=cost_ids):
+            self.cost_names[cost.id] = str(cost)
+        return entry_thirds
+
+    def _get_designation(self, data_line, entry_thirds):
+        val = data_line['entry__designation']
+        if not self.is_third(data_line['account__code']):
+            thirds = sorted(set([self.third_names[third_id] for third_id in entry_thirds.get(data_line['entry_id'], [])]))
+            if len(thirds) > 0:
+                if len(thirds) <= 5:
+                    val = "%s (%s)" % (val, ",".join(thirds))
                 else:
-                    amount = -1 * credit_debit_way(data_line) * data_line['data_sum']
+                    val = "%s (%s ...)" % (val, ",".join(thirds[:5]))
+        if (data_line['reference'] is not None) and (data_line['reference'] != ''):
+            val = "%s{[br/]}%s" % (val, data_line['reference'])
+        return val
+
+    def _complete(self, data_line, entry_thirds):
+        way = ChartsAccount(type_of_account=data_line['account__type_of_account']).credit_debit_way()
+        data_line['way'] = way
+        if data_line['third_id'] is None:
+            data_line['entry_account'] = "[%s] %s" % (data_line['account__code'], data_line['account__name'])
+        else:
+            data_line['entry_account'] = "[%s %s]" % (data_line['account__code'], self.third_names[data_line['third_id']])
+        data_line['entry.num'] = get_format_value(self.entry_format['num'], data_line['entry__num'])
+        data_line['entry.date_entry'] = get_format_value(self.entry_format['date_entry'], data_line['entry__date_entry'])
+        data_line['entry.date_value'] = get_format_value(self.entry_format['date_value'], data_line['entry__date_value'])
+        data_line['designation_ref_with_third'] = self._get_designation(data_line, entry_thirds)
+        if data_line['link_id'] is not None:
+            data_line['link_costaccounting'] = self.link_names[data_line['link_id']]
+        elif data_line['costaccounting_id'] is not None:
+            data_line['link_costaccounting'] = self.cost_names[data_line['costaccounting_id']]
+        else:
+            data_line['link_costaccounting'] = '---'
+        data_line['debit'] = min(0, way * data_line['amount'])
+        data_line['credit'] = max((0, way * data_line['amount']))
+        return data_line
+
+    def _complete_chunk(self, data_lines):
+        entry_thirds = self._load_names(data_lines)
+        for data_line in data_lines:
+            yield self._complete(data_line, entry_thirds)
+
+    def __iter__(self):
+        queryset = self._get_queryset()
+        if self.after_key is not None:
+            queryset = queryset.filter(self._get_after_filter())
+        data_lines = []
+        for data_line in queryset.values(*(self.FIELDS + ('third_key',))).order_by(*self.ORDER).iterator(chunk_size=self.chunk_size):
+            data_lines.append(data_line)
+            if len(data_lines) >= self.chunk_size:
+                yield from self._complete_chunk(data_lines)
+                data_lines = []
+        yield from self._complete_chunk(data_lines)
+
+
+class ReportCache(object):
+
+    def __init__(self, max_size=50):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        version = get_ledger_version()
+        with self.lock:
+            item = self.items.get(key)
+            if (item is not None) and (item[0] == version):
+                self.items.move_to_end(key)
+                self.hits += 1
+                value = deepcopy(item[1])
             else:
-                amount = sign_value * credit_debit_way(data_line) * data_line['data_sum']
-                if (amount < 0):
-                    amount = None
-            if amount is not None:
-                total += amount
-    return total
+                if item is not None:
+                    del self.items[key]
+                self.misses += 1
+                value = None
+        getLogger("diacamma.accounting").debug("report cache %s: %s (hits=%d / misses=%d)", "hit" if value is not None else "miss", key[0], self.hits, self.misses)
+        return value, version
+
+    def set(self, key, version, value):
+        with self.lock:
+            self.items[key] = (version, deepcopy(value))
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.items), 'max_size': self.max_size}
+
+
+REPORT_CACHE = ReportCache()
+
+
+def get_totalaccount_for_query(query, sign_value=None, with_third=False):
+    return EntryLineTotals(query, with_third).get_values(sign_value)
+
+
+def get_account_total(query, account_codethird, sign_value=None):
+    return EntryLineTotals(query, '#' in account_codethird).get_total(account_codethird, sign_value)
+
+
+def get_budget_total(query, account_codethird, sign_value=None):
+    return BudgetTotals(query).get_total(account_codethird, sign_value)
 
 
-def add_account_without_amount(dict_account, query1, query2, query_budget_list, sign_value):
+def add_account_without_amount(dict_account, query1, totals2, budget_totals_list, sign_value):
     extra_account = ~Q(code__in=[account_codethird.split('#')[0] for account_codethird in dict_account.keys()])
     for item in query1.children:
         if isinstance(item, tuple) and (item[0].startswith('account__') or (item[0] == 'entry__year')):
             extra_account &= Q(**{'__'.join(item[0].split('__')[1:]): item[1]})
     total2 = 0
-    if query_budget_list is not None:
-        total3_initial = [0 for _item in query_budget_list]
+    if budget_totals_list is not None:
+        total3_initial = [0 for _item in budget_totals_list]
     else:
         total3_initial = [0]
     total3 = total3_initial[:]
@@ -151,19 +549,19 @@ def add_account_without_amount(dict_account, query1, query2, query_budget_list,
             continue
         value2 = 0
         total_b = []
-        if query2 is not None:
-            value2 = get_account_total(query2, account.code, sign_value)
-        if query_budget_list is not None:
-            for query_budget_item in query_budget_list:
-                total_b.append(get_budget_total(query_budget_item, account.code, sign_value))
+        if totals2 is not None:
+            value2 = totals2.get_total(account.code, sign_value)
+        if budget_totals_list is not None:
+            for budget_totals in budget_totals_list:
+                total_b.append(budget_totals.get_total(account.code, sign_value))
 
         if (value2 != 0) or ((total_b != []) and (total_b != total3_initial)):
             dict_account[account.code] = [str(account), None, None] + total3_initial
             if abs(value2) > 0.001:
                 dict_account[account.code][2] = value2
             total2 += value2
-            if query_budget_list is not None:
-                for budget_item_idx in range(len(query_budget_list)):
+            if budget_totals_list is not None:
+                for budget_item_idx in range(len(budget_totals_list)):
                     if abs(total_b[budget_item_idx]) > 0.001:
                         dict_account[account.code][budget_item_idx + 3] = total_b[budget_item_idx]
                         total3[budget_item_idx] += total_b[budget_item_idx]
@@ -185,25 +583,28 @@ def convert_query_to_account(query1, query2=None, query_budget=None, sign_value=
             query_budget_list = query_budget
         else:
             query_budget_list = [query_budget]
+        budget_totals_list = [BudgetTotals(query_budget_item) for query_budget_item in query_budget_list]
     else:
         query_budget_list = None
+        budget_totals_list = None
+    totals2 = EntryLineTotals(query2, with_third) if query2 is not None else None
     dict_account = {}
     total2 = 0
     total3 = 0 if not isinstance(query_budget, list) else [0 for _item in query_budget_list]
-    values1, total1 = get_totalaccount_for_query(query1, sign_value, with_third)
+    values1, total1 = EntryLineTotals(query1, with_third).get_values(sign_value)
     for account_code in values1.keys():
         check_account(account_code, values1[account_code][1])
         dict_account[account_code][1] = values1[account_code][0]
-        if query2 is not None:
-            value2 = get_account_total(query2, account_code, sign_value)
+        if totals2 is not None:
+            value2 = totals2.get_total(account_code, sign_value)
             if abs(value2) > 0.001:
                 dict_account[account_code][2] = value2
             total2 += value2
-        if query_budget_list is not None:
+        if budget_totals_list is not None:
             total_b = []
             id_dict = 3
-            for query_budget_item in query_budget_list:
-                valueb = get_budget_total(query_budget_item, account_code)
+            for budget_totals in budget_totals_list:
+                valueb = budget_totals.get_total(account_code)
                 if abs(valueb) > 0.001:
                     dict_account[account_code][id_dict] = valueb
                 total_b.append(valueb)
@@ -213,7 +614,7 @@ def convert_query_to_account(query1, query2=None, query_budget=None, sign_value=
             else:
                 total3 += total_b[0]
     if (query2 is not None) or (query_budget is not None):
-        total_2, total_3 = add_account_without_amount(dict_account, query1, query2, query_budget_list, sign_value)
+        total_2, total_3 = add_account_without_amount(dict_account, query1, totals2, budget_totals_list, sign_value)
         total2 += total_2
         if isinstance(query_budget, list):
             total3 = [total3[budget_item_idx] + total_3[budget_item_idx] for budget_item_idx in range(len(query_budget_list))]
@@ -221,12 +622,10 @@ def convert_query_to_account(query1, query2=None, query_budget=None, sign_value=
             total3 += total_3[0]
     if (query2 is not None) and (old_accountcode is not None):
         old_accountcode.extend(dict_account.keys())
-        values_2, total_2 = get_totalaccount_for_query(query2 & ~Q(account__code__in=[account_codethird.split('#')[0] for account_codethird in old_accountcode]), sign_value, with_third)
-        sub_total2 = 0.0
+        values_2, total_2 = totals2.get_values(sign_value, exclude_codes=set([account_codethird.split('#')[0] for account_codethird in old_accountcode]))
         for account_code in values_2.keys():
             check_account(account_code, values_2[account_code][1])
             dict_account[account_code][2] = values_2[account_code][0]
-            sub_total2 += values_2[account_code][0]
         total2 += total_2
     res = []
     account_codes = sorted(dict_account.keys())
@@ -39,7 +39,6 @@ from lucterios.framework.xfergraphic import XferContainerAcknowledge
 from lucterios.framework.xfercomponents import XferCompLabelForm, XferCompEdit, XferCompButton, XferCompSelect, XferCompImage, XferCompDate, XferCompGrid
 from lucterios.framework.tools import FORMTYPE_NOMODAL, ActionsManage, MenuManage, FORMTYPE_REFRESH, CLOSE_NO, WrapAction, FORMTYPE_MODAL, SELECT_SINGLE, SELECT_MULTI, SELECT_NONE, CLOSE_YES
 from lucterios.framework.error import LucteriosException, IMPORTANT
-from lucterios.framework.models import LucteriosQuerySet
 from lucterios.CORE.xferprint import XferPrintListing
 from lucterios.CORE.editors import XferSavedCriteriaSearchEditor
 from lucterios.CORE.parameters import Params
@@ -74,10 +73,11 @@ class ThirdList(XferListEditor):
             else:
                 sort_thirdbis = "-"
             self.params['GRID_ORDER%third+'] = sort_thirdbis
-        items = sorted(items, key=lambda t: str(t).lower(), reverse=sort_thirdbis.startswith('-'))
-        if self.getparam('show_filter', 0) == 2:
-            items = [item for item in items if abs(item.get_total()) > 0.0001]
-        return LucteriosQuerySet(model=Third, initial=items)
+        items = Third.order_by_name(items, reverse=sort_thirdbis.startswith('-'))
+        show_filter = self.getparam('show_filter', 0)
+        if show_filter in (1, 2):
+            items = Third.annotate_total(items, only_unbalanced=(show_filter == 2))
+        return items
 
     def fillresponse_header(self):
         contact_filter = self.getparam('filter', '')
@@ -116,13 +116,13 @@ class ThirdList(XferListEditor):
             q_individual = Q(completename__icontains=contact_filter)
             self.filter &= (q_legalentity | q_individual)
         if thirdtype == 1:
-            self.filter &= Q(accountthird__code__regex=current_system_account().get_customer_mask())
+            self.filter &= Q(accountthird__flag_customer=True)
         elif thirdtype == 2:
-            self.filter &= Q(accountthird__code__regex=current_system_account().get_provider_mask())
+            self.filter &= Q(accountthird__flag_provider=True)
         elif thirdtype == 3:
-            self.filter &= Q(accountthird__code__regex=current_system_account().get_societary_mask())
+            self.filter &= Q(accountthird__flag_societary=True)
         elif thirdtype == 4:
-            self.filter &= Q(accountthird__code__regex=current_system_account().get_employed_mask())
+            self.filter &= Q(accountthird__flag_employed=True)
         if show_filter == 3:
             self.filter &= Q(entrylineaccount__link__isnull=True) & Q(num_entryline__gt=0)
 
@@ -270,10 +270,8 @@ class ThirdListing(XferPrintListing):
     caption = _("Listing third")
 
     def filter_callback(self, items):
-        items = sorted(items, key=lambda t: str(t))
-        if (self.getparam('CRITERIA') is None) and (self.getparam('show_filter', 0) == 2):
-            items = [item for item in items if abs(item.get_total()) > 0.0001]
-        return LucteriosQuerySet(model=Third, initial=items)
+        items = Third.order_by_name(items)
+        return Third.annotate_total(items, only_unbalanced=(self.getparam('CRITERIA') is None) and (self.getparam('show_filter', 0) == 2))
 
     def get_filter(self):
         if self.getparam('CRITERIA') is None:
@@ -287,13 +285,13 @@ class ThirdListing(XferPrintListing):
                     contact__individual__lastname__icontains=contact_filter))
                 new_filter &= (q_legalentity | q_individual)
             if thirdtype == 1:
-                new_filter &= Q(accountthird__code__regex=current_system_account().get_customer_mask())
+                new_filter &= Q(accountthird__flag_customer=True)
             elif thirdtype == 2:
-                new_filter &= Q(accountthird__code__regex=current_system_account().get_provider_mask())
+                new_filter &= Q(accountthird__flag_provider=True)
             elif thirdtype == 3:
-                new_filter &= Q(accountthird__code__regex=current_system_account().get_societary_mask())
+                new_filter &= Q(accountthird__flag_societary=True)
             elif thirdtype == 4:
-                new_filter &= Q(accountthird__code__regex=current_system_account().get_employed_mask())
+                new_filter &= Q(accountthird__flag_employed=True)
             if show_filter == 3:
                 new_filter &= Q(entrylineaccount__link__isnull=True)
         else:
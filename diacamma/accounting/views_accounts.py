@@ -91,6 +91,17 @@ class ChartsAccountList(XferListEditor):
         chartsaccount = self.get_components('chartsaccount')
         chartsaccount.colspan = 3
         add_fiscalyear_result(self, 0, 10, 2, self.item.year, "result")
+        if self.item.year.close_progress is not None:
+            lbl = XferCompLabelForm("close_info")
+            lbl.set_value_as_headername(_("Closing of this fiscal year in progress: %s") % self.item.year.close_progress)
+            lbl.set_location(0, 13, 2)
+            self.add_component(lbl)
+        elif (self.item.year.status != FiscalYear.STATUS_FINISHED) and (self.item.year.close_error is not None):
+            lbl = XferCompLabelForm("close_info")
+            lbl.set_color('red')
+            lbl.set_value_as_headername(_("Failure of fiscal year closing: %s") % self.item.year.close_error)
+            lbl.set_location(0, 13, 2)
+            self.add_component(lbl)
         if self.item.year == FiscalYear.get_current():
             accompt_returned = []
             cost_returned = []
@@ -299,6 +310,8 @@ class FiscalYearClose(XferContainerAcknowledge):
 
     def fillresponse(self, year=0):
         current_year = FiscalYear.objects.get(id=year)
+        if current_year.close_progress is not None:
+            raise LucteriosException(IMPORTANT, _("Closing of this fiscal year in progress: %s") % current_year.close_progress)
         if self.getparam("CONFIRME") is None:
             nb_entry_noclose = current_year.check_to_close()
             text_confirm = str(_('close-fiscal-year-confirme'))
@@ -327,5 +340,8 @@ class FiscalYearClose(XferContainerAcknowledge):
             EntryAccount.clear_ghost()
             signal_and_lock.Signal.call_signal("finalize_year", self)
             current_year.set_context(self)
-            current_year.closed()
-            signal_and_lock.Signal.call_signal("finalize_year_after", self)
+            if current_year.is_big_for_closing():
+                current_year.closed_in_background(self)
+                self.message(_('Closing of fiscal year is running in background.'))
+            else:
+                current_year.closed(self)
@@ -203,6 +203,39 @@ class FiscalYearExport(XferContainerCustom):
         self.add_component(down)
 
 
+@ActionsManage.affect_grid(_("FEC export"), short_icon="mdi:mdi-file-delimited-outline", unique=SELECT_SINGLE)
+@MenuManage.describ('accounting.change_fiscalyear')
+class FiscalYearExportFEC(XferContainerCustom):
+    short_icon = "mdi:mdi-file-delimited-outline"
+    model = FiscalYear
+    field_id = 'fiscalyear'
+    caption = _("FEC export")
+    readonly = True
+    methods_allowed = ('GET', )
+
+    def fillresponse(self):
+        if self.item.id is None:
+            self.item = FiscalYear.get_current()
+        file_name = self.item.get_fec_filename()
+        destination_file = self.item.get_fec_export()
+        img = XferCompImage('img')
+        img.set_value(self.short_icon, '#')
+        img.set_location(0, 0, 1, 6)
+        self.add_component(img)
+        lbl = XferCompLabelForm('title')
+        lbl.set_value_as_title(_('Export fiscal year in FEC format'))
+        lbl.set_location(1, 0)
+        self.add_component(lbl)
+        down = XferCompDownLoad('filename')
+        down.compress = False
+        down.http_file = True
+        down.maxsize = 0
+        down.set_value(file_name)
+        down.set_download(destination_file)
+        down.set_location(1, 1)
+        self.add_component(down)
+
+
 @ActionsManage.affect_grid(_("Check"), short_icon='mdi:mdi-finance', unique=SELECT_SINGLE)
 @MenuManage.describ('accounting.add_fiscalyear')
 class FiscalYearCheckReport(XferContainerAcknowledge):
@@ -302,6 +335,9 @@ class JournalDefault(XferContainerAcknowledge):
 
 @signal_and_lock.Signal.decorate('param_change')
 def paramchange_accounting(params):
+    if 'accounting-system' in params:
+        ChartsAccount.reclassify()
+        AccountThird.reclassify()
     if 'accounting-sizecode' in params:
         for account in AccountThird.objects.all():
             if account.code != correct_accounting_code(account.code):
@@ -23,13 +23,14 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import unicode_literals
 from datetime import date
+from hashlib import md5
 
 from django.utils.translation import gettext_lazy as _
 from django.utils import formats
 from django.db.models import Q, F
 from django.db.models.expressions import Case, When, ExpressionWrapper
 from django.db.models.fields import DecimalField
-from django.db.models.aggregates import Count
+from django.core.cache import cache
 
 from lucterios.framework.xferadvance import XferShowEditor, XferDelete, XferSave, TITLE_LISTING, TITLE_DELETE, TITLE_OK, TITLE_CANCEL, TITLE_CLOSE, TITLE_MODIFY, \
     TITLE_EDIT, TITLE_ADD, TITLE_SEARCH
@@ -48,6 +49,7 @@ from lucterios.CORE.parameters import Params
 from lucterios.CORE.views import ObjectImport
 
 from diacamma.accounting.models import EntryLineAccount, EntryAccount, FiscalYear, Journal, AccountLink, current_system_account, CostAccounting, ModelEntry
+from diacamma.accounting.tools import get_ledger_version
 
 
 def add_fiscalyear_result(xfer, col, row, colspan, year, comp_name):
@@ -66,6 +68,74 @@ def add_fiscalyear_result(xfer, col, row, colspan, year, comp_name):
     xfer.item = old_item
 
 
+class EntryLineKeysetPaging(object):
+    '''Page accounting lines by (date value, entry) keyset instead of large offsets
+
+    The boundary of each page is kept when the page is read: a sequential browsing seeks each page from its own boundary.
+    A jump to a page not reached yet seeks from the nearest known lower boundary and skips the lines between,
+    so its cost grows with the distance from the last page visited.'''
+
+    CACHE_TIMEOUT = 30 * 60
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.model = queryset.model
+        self.cache_key = 'diacamma_accounting_entryline_keyset_' + md5(("%s-%s" % (queryset.query, get_ledger_version())).encode()).hexdigest()
+        self.keyset = cache.get(self.cache_key)
+        if self.keyset is None:
+            self.keyset = {'count': None, 'boundaries': {}}
+
+    def count(self):
+        if self.keyset['count'] is None:
+            self.keyset['count'] = self.queryset.count()
+            cache.set(self.cache_key, self.keyset, self.CACHE_TIMEOUT)
+        return self.keyset['count']
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self.queryset)
+
+    def order_by(self, *field_names):
+        return self.queryset.order_by(*field_names)
+
+    def _get_lower_boundary(self, record_min):
+        positions = [position for position in self.keyset['boundaries'].keys() if position <= record_min]
+        return max(positions) if len(positions) > 0 else 0
+
+    def _get_page(self, record_min, record_max):
+        size = record_max - record_min
+        position = self._get_lower_boundary(record_min)
+        if position == 0:
+            return list(self.queryset[record_min:record_max]), (None, None, 0) if record_min == 0 else None
+        date_value, entry_id, skip = self.keyset['boundaries'][position]
+        items = self.queryset.filter(Q(entry__date_value__gt=date_value) | Q(entry__date_value=date_value, entry_id__gte=entry_id))
+        skip += record_min - position
+        return list(items[skip:skip + size]), (date_value, entry_id, skip) if position == record_min else None
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self.queryset[key]
+        record_min = key.start if key.start is not None else 0
+        if key.stop is None:
+            return list(self.queryset[record_min:])
+        items, boundary = self._get_page(record_min, key.stop)
+        if (len(items) > 0) and (len(items) == (key.stop - record_min)):
+            last_key = (items[-1].entry.date_value, items[-1].entry_id)
+            nb_tail = 0
+            for item in reversed(items):
+                if (item.entry.date_value, item.entry_id) != last_key:
+                    break
+                nb_tail += 1
+            if nb_tail < len(items):
+                self.keyset['boundaries'][key.stop] = (last_key[0], last_key[1], nb_tail)
+            elif (boundary is not None) and (boundary[:2] in ((None, None), last_key)):
+                self.keyset['boundaries'][key.stop] = (last_key[0], last_key[1], boundary[2] + nb_tail)
+            cache.set(self.cache_key, self.keyset, self.CACHE_TIMEOUT)
+        return items
+
+
 @MenuManage.describ('accounting.change_entryaccount', FORMTYPE_NOMODAL, 'bookkeeping', _('Edition of accounting entry for current fiscal year'),)
 class EntryAccountList(XferListEditor):
     short_icon = "mdi:mdi-checkbook"
@@ -78,16 +148,15 @@ class EntryAccountList(XferListEditor):
         self.select_filter = 1
 
     def get_items_from_filter(self):
-        items = XferListEditor.get_items_from_filter(self)
+        items = EntryLineAccount.objects.filter(self.filter)
         items = items.select_related('account', 'entry', 'third', 'third__contact', 'third__contact__individual', 'third__contact__legalentity', 'costaccounting', 'link', 'multilink')
-        items = items.annotate(num_link=Count('entry__entrylineaccount__link'))
         items = items.annotate(cdway=Case(When(account__type_of_account__in=(0, 4), then=-1), default=1, output_field=DecimalField()))
         items = items.annotate(credit_num=ExpressionWrapper(F('amount') * F('cdway'), output_field=DecimalField()), debit_num=ExpressionWrapper(-1 * F('amount') * F('cdway'), output_field=DecimalField()))
         if self.select_filter == 3:
-            items = items.filter(Q(num_link__gt=0)).distinct()
+            items = items.filter(entry__has_link=True)
         elif self.select_filter == 4:
-            items = items.filter(Q(num_link=0)).distinct()
-        return items.order_by(*EntryLineAccount._meta.ordering)
+            items = items.filter(entry__has_link=False)
+        return EntryLineKeysetPaging(items.order_by(*EntryLineAccount._meta.ordering, 'id'))
 
     def _filter_by_year(self):
         select_year = self.getparam('year')
@@ -158,7 +227,7 @@ class EntryAccountList(XferListEditor):
         edt.set_action(self.request, self.__class__.get_action(), close=CLOSE_NO, modal=FORMTYPE_REFRESH)
         self.add_component(edt)
         if self.filtercode != "":
-            self.filter &= Q(entry__entrylineaccount__account__code__startswith=self.filtercode)
+            self.filter &= Q(entry_id__in=EntryLineAccount.objects.filter(account__code__startswith=self.filtercode).values('entry_id'))
 
     def fillresponse_header(self):
         title = self.get_components('title')
@@ -272,17 +341,16 @@ class EntryAccountListing(XferPrintListing):
             if select_journal != 0:
                 new_filter &= Q(entry__journal__id=select_journal)
             if filtercode != "":
-                new_filter &= Q(entry__entrylineaccount__account__code__startswith=filtercode)
+                new_filter &= Q(entry_id__in=EntryLineAccount.objects.filter(account__code__startswith=filtercode).values('entry_id'))
         else:
             new_filter = XferPrintListing.get_filter(self)
         return new_filter
 
     def filter_callback(self, items):
-        items = items.annotate(num_link=Count('entry__entrylineaccount__link'))
         if self.select_filter == 3:
-            items = items.filter(Q(num_link__gt=0)).distinct()
+            items = items.filter(entry__has_link=True)
         elif self.select_filter == 4:
-            items = items.filter(Q(num_link=0)).distinct()
+            items = items.filter(entry__has_link=False)
         return items.order_by(*EntryLineAccount._meta.ordering)
 
     def fillresponse(self):
@@ -317,6 +385,11 @@ class EntryAccountImport(ObjectImport):
     def _fillcontent_import_result(self):
         self.import_driver.default_values = {'entry.year': self.select_year, 'entry.journal': self.select_journal}
         ObjectImport._fillcontent_import_result(self)
+        self.items_imported = EntryLineAccount.get_entries_imported()
+        if len(self.items_imported) == 1:
+            self.get_components('result').set_value_as_header(_("1 item are been imported"))
+        elif len(self.items_imported) > 1:
+            self.get_components('result').set_value_as_header(_("%d items are been imported") % len(self.items_imported))
 
     def change_gui(self):
         rowid = self.get_max_row()
@@ -382,8 +455,7 @@ class EntryAccountClose(XferContainerAcknowledge):
 
     def fillresponse(self):
         if (len(self.items) > 0) and self.confirme(_("Do you want to close this entry?")):
-            for item in self.items:
-                item.closed()
+            EntryAccount.closed_entries(list(self.items))
         if (len(self.items) == 1) and (self.getparam('REOPEN') == 'YES'):
             if 'entryline' in self.params.keys():
                 del self.params['entryline']
@@ -421,6 +493,23 @@ class EntryAccountLink(XferContainerAcknowledge):
             AccountLink.create_link(self.items)
 
 
+@ActionsManage.affect_grid(_("Auto-link"), short_icon='mdi:mdi-link-variant-plus', unique=SELECT_NONE, condition=lambda xfer, gridname='': hasattr(xfer.item, 'year') and (xfer.item.year.status in [0, 1]))
+@MenuManage.describ('accounting.add_entryaccount')
+class EntryAccountAutoLink(XferContainerAcknowledge):
+    short_icon = "mdi:mdi-checkbook"
+    model = FiscalYear
+    field_id = 'year'
+    caption = _("Automatic lettering")
+
+    def fillresponse(self):
+        if self.item.status == FiscalYear.STATUS_FINISHED:
+            raise LucteriosException(IMPORTANT, _("Fiscal year finished!"))
+        if self.confirme(_('Do you want to letter automatically the open third lines of this fiscal year?')):
+            if not self.item.auto_link(self.getparam('filtercode', '')):
+                raise LucteriosException(IMPORTANT, _('Automatic lettering is already running in background.'))
+            self.message(_('Automatic lettering is running in background.'))
+
+
 @ActionsManage.affect_grid(_("Cost"), short_icon='mdi:mdi-pencil-outline', unique=SELECT_MULTI, condition=lambda xfer, gridname='': len(CostAccounting.objects.filter(status=0)) > 0)
 @MenuManage.describ('accounting.add_entryaccount')
 class EntryAccountCostAccounting(XferContainerAcknowledge):
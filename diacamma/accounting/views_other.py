@@ -14,7 +14,7 @@ from lucterios.framework.xferadvance import XferAddEditor
 from lucterios.framework.xfergraphic import XferContainerAcknowledge, XFER_DBOX_WARNING
 from lucterios.framework.error import LucteriosException, IMPORTANT
 
-from diacamma.accounting.models import CostAccounting, ModelLineEntry, ModelEntry, FiscalYear
+from diacamma.accounting.models import CostAccounting, ModelLineEntry, ModelEntry, FiscalYear, EntryLineDayBalance
 from diacamma.accounting.views_reports import CostAccountingIncomeStatement
 
 
@@ -93,10 +93,7 @@ class CostAccountingReportByDate(XferContainerAcknowledge):
             dlg.add_action(self.return_action(TITLE_OK, short_icon='mdi:mdi-check'))
             dlg.add_action(WrapAction(TITLE_CANCEL, short_icon='mdi:mdi-cancel'))
         else:
-            list_cost = []
-            for cost_item in CostAccounting.objects.filter(Q(entrylineaccount__entry__date_value__gte=begin_date) & Q(entrylineaccount__entry__date_value__lte=end_date)).distinct():
-                list_cost.append(str(cost_item.id))
-            list_cost = set(list_cost)
+            list_cost = set([str(cost_id) for cost_id in EntryLineDayBalance.objects.filter(day__gte=begin_date, day__lte=end_date, costaccounting__isnull=False).values_list('costaccounting_id', flat=True).distinct()])
             if len(list_cost) == 0:
                 raise LucteriosException(IMPORTANT, _("No cost accounting finds for this range !"))
             self.redirect_action(CostAccountingIncomeStatement.get_action(), modal=FORMTYPE_NOMODAL, close=CLOSE_YES, params={'begin_date': begin_date, 'end_date': end_date, 'datereadonly': True, 'costaccounting': ";".join(list_cost)})
@@ -29,22 +29,25 @@ from logging import getLogger
 
 from django.utils.translation import gettext_lazy as _
 from django.db.models import Q
-from django.db.models.aggregates import Sum
 from django.utils import formats
+from django.utils.translation import get_language
 
 from lucterios.framework.tools import MenuManage, FORMTYPE_NOMODAL, CLOSE_NO, FORMTYPE_REFRESH, WrapAction, convert_date, ActionsManage, SELECT_MULTI, \
     FORMTYPE_MODAL, SELECT_SINGLE
 from lucterios.framework.xfergraphic import XferContainerCustom, XferContainerAcknowledge
-from lucterios.framework.xfercomponents import XferCompImage, XferCompSelect, XferCompLabelForm, XferCompGrid, XferCompEdit, XferCompCheck, XferCompDate
+from lucterios.framework.xfercomponents import XferCompImage, XferCompSelect, XferCompLabelForm, XferCompGrid, XferCompEdit, XferCompCheck, XferCompDate, XferCompButton, \
+    XferCompFloat, XferCompDownLoad
 from lucterios.framework.xferadvance import TITLE_PRINT, TITLE_CLOSE, TITLE_EDIT
 from lucterios.framework.xferbasic import NULL_VALUE
+from lucterios.framework.error import LucteriosException, IMPORTANT
 from lucterios.contacts.models import LegalEntity
 from lucterios.CORE.parameters import Params
 from lucterios.CORE.xferprint import XferPrintAction
 
-from diacamma.accounting.models import FiscalYear, EntryLineAccount, ChartsAccount, CostAccounting, Third, EntryAccount
-from diacamma.accounting.tools import correct_accounting_code, current_system_account, format_with_devise
-from diacamma.accounting.tools_reports import get_spaces, convert_query_to_account, add_cell_in_grid, fill_grid, add_item_in_grid
+from diacamma.accounting.models import FiscalYear, ChartsAccount, CostAccounting, Third, EntryAccount, EntryLineDayBalance, EntryLineAccount, Journal
+from diacamma.accounting.tools import correct_accounting_code, current_system_account, format_with_devise, currency_round
+from diacamma.accounting.tools_reports import get_spaces, convert_query_to_account, add_cell_in_grid, fill_grid, add_item_in_grid, LedgerLines, REPORT_CACHE, ComparativeTotals, \
+    AgingBalance
 from diacamma.accounting.views_entries import add_fiscalyear_result
 
 MenuManage.add_sub("bookkeeping_report", "financial", short_icon='mdi:mdi-bank-check', caption=_("Reports"), desc=_("Report of Bookkeeping"), pos=30)
@@ -58,6 +61,7 @@ class FiscalYearReport(XferContainerCustom):
     force_date_filter = False
     saving_pdfreport = False
     methods_allowed = ('GET', )
+    cached_attributes = ('result', 'total_summary_left', 'total_summary_right')
 
     def __init__(self, **kwargs):
         XferContainerCustom.__init__(self, **kwargs)
@@ -79,10 +83,27 @@ class FiscalYearReport(XferContainerCustom):
 
     def fillresponse(self):
         self.fill_header()
-        self.calcul_table()
+        self.calcul_table_with_cache()
         self.fill_body()
         self.fill_buttons()
 
+    def get_cache_key(self):
+        params = tuple(sorted([(param_name, str(param_value)) for param_name, param_value in self.params.items()]))
+        return (self.__class__.__name__, self.item.id, str(self.filter), str(self.lastfilter), get_language(), params)
+
+    def calcul_table_with_cache(self):
+        cache_key = self.get_cache_key()
+        cached_value, version = REPORT_CACHE.get(cache_key)
+        if cached_value is None:
+            self.calcul_table()
+            cached_value = {attr_name: getattr(self, attr_name) for attr_name in self.cached_attributes}
+            cached_value['grid'] = (self.grid.records, self.grid.record_ids, self.grid.nb_lines)
+            REPORT_CACHE.set(cache_key, version, cached_value)
+        else:
+            self.grid.records, self.grid.record_ids, self.grid.nb_lines = cached_value.pop('grid')
+            for attr_name, attr_value in cached_value.items():
+                setattr(self, attr_name, attr_value)
+
     def define_gridheader(self):
         pass
 
@@ -391,7 +412,7 @@ class FiscalYearIncomeStatement(FiscalYearReport):
 
     def show_annexe(self, line_idx, budgetfilter, excludefilter):
         add_cell_in_grid(self.grid, self.line_offset + line_idx + 1, 'left', '')
-        other_filter = Q(account__code__regex=current_system_account().get_annexe_mask()) & ~excludefilter
+        other_filter = Q(account__flag_annexe=True) & ~excludefilter
         budget_other = Q(code__regex=current_system_account().get_annexe_mask())
         data_line_left, anx_total1_left, anx_total2_left, anx_totalb_left, _account_codes_left = convert_query_to_account(self.filter & other_filter,
                                                                                                                           self.lastfilter & other_filter if self.lastfilter is not None else None,
@@ -443,18 +464,95 @@ class FiscalYearIncomeStatement(FiscalYearReport):
         self.show_annexe(line_idx, Q(year=self.item), filter_exclude)
 
 
+@MenuManage.describ('accounting.change_fiscalyear', FORMTYPE_NOMODAL, 'bookkeeping_report', _('Show comparative income statement of fiscal years or months'))
+class FiscalYearComparativeIncomeStatement(FiscalYearReport):
+    caption = _("Comparative income statement")
+    cached_attributes = ('result', )
+
+    def __init__(self, **kwargs):
+        FiscalYearReport.__init__(self, **kwargs)
+        self.by_month = False
+        self.year_ids = []
+        self.periods = []
+
+    def fill_filterheader(self):
+        self.by_month = int(self.getparam('period', 0)) == 1
+        sel = XferCompSelect('period')
+        sel.set_select({0: _('by fiscal year'), 1: _('by month')})
+        sel.set_value(1 if self.by_month else 0)
+        sel.set_location(1, 6)
+        sel.description = _('comparison')
+        sel.set_action(self.request, self.__class__.get_action(), close=CLOSE_NO, modal=FORMTYPE_REFRESH)
+        self.add_component(sel)
+        if self.by_month:
+            self.year_ids = [self.item.id]
+            month_begin = date(self.item.begin.year, self.item.begin.month, 1)
+            while month_begin <= self.item.end:
+                self.periods.append((month_begin, formats.date_format(month_begin, "YEAR_MONTH_FORMAT")))
+                month_begin = date(month_begin.year + month_begin.month // 12, month_begin.month % 12 + 1, 1)
+        else:
+            nb_years = int(self.getparam('nb_years', 5.0))
+            edt = XferCompFloat('nb_years', 2, 20, 0)
+            edt.set_value(nb_years)
+            edt.set_location(3, 6)
+            edt.description = _('number of fiscal years')
+            edt.set_action(self.request, self.__class__.get_action(), close=CLOSE_NO, modal=FORMTYPE_REFRESH)
+            self.add_component(edt)
+            year = self.item
+            while (year is not None) and (len(self.periods) < nb_years):
+                self.year_ids.insert(0, year.id)
+                self.periods.insert(0, (year.id, year.get_identify()))
+                year = year.last_fiscalyear
+            self.filter = Q(entry__year_id__in=self.year_ids)
+
+    def define_gridheader(self):
+        self.grid = XferCompGrid('report_%d' % self.item.id)
+        self.grid.add_header('designation', _('name'))
+        for period_idx, (_period, period_title) in enumerate(self.periods):
+            self.grid.add_header('period_%d' % period_idx, period_title, self.hfield, 0, self.format_str)
+
+    def _add_line(self, line_idx, designation, amounts, formttext='%s'):
+        add_cell_in_grid(self.grid, self.line_offset + line_idx, 'designation', designation)
+        for period_idx, amount in enumerate(amounts):
+            add_cell_in_grid(self.grid, self.line_offset + line_idx, 'period_%d' % period_idx, amount, formttext)
+        return line_idx + 1
+
+    def calcul_table(self):
+        result_entries = EntryAccount.objects.filter(journal_id=Journal.DEFAULT_OTHER, entrylineaccount__account__code__in=current_system_account().result_accounting_codes).values('id')
+        comparative_totals = ComparativeTotals(self.filter & ~Q(entry_id__in=result_entries), self.year_ids, self.by_month)
+        periods = [period for period, _period_title in self.periods]
+        results = [0.0 for _period in periods]
+        line_idx = 0
+        for type_of_account, title, factor in ((3, _('Revenue'), 1), (4, _('Expense'), -1)):
+            line_idx = self._add_line(line_idx, "{[b]}%s{[/b]}" % title, [])
+            data_lines, totals = comparative_totals.get_values(type_of_account, periods)
+            for account_title, amounts in data_lines:
+                line_idx = self._add_line(line_idx, account_title, amounts)
+            line_idx = self._add_line(line_idx, get_spaces(10) + "{[u]}{[b]}%s{[/b]}{[/u]}" % _('total'), [currency_round(total) for total in totals], "{[u]}{[b]}%s{[/b]}{[/u]}")
+            line_idx = self._add_line(line_idx, '', [])
+            results = [result + factor * total for result, total in zip(results, totals)]
+        self.result = tuple([currency_round(result) for result in results])
+        self._add_line(line_idx, get_spaces(5) + "{[b]}%s{[/b]}" % _('result'), self.result, "{[b]}%s{[/b]}")
+
+
 @MenuManage.describ('accounting.change_fiscalyear', FORMTYPE_NOMODAL, 'bookkeeping_report', _('Show ledger for current fiscal year'))
 class FiscalYearLedger(FiscalYearReport):
     caption = _("Ledger")
     add_filtering = True
     force_date_filter = True
+    page_size = 5000
+    cached_attributes = ('next_key',)
 
     def __init__(self, **kwargs):
         FiscalYearReport.__init__(self, **kwargs)
         self.last_account = None
+        self.last_way = 0
         self.last_third_id = None
         self.last_total = [0.0, 0.0]
+        self.last_third_total = [0.0, 0.0]
         self.line_idx = 1
+        self.next_key = None
+        self.resume_page = False
 
     def fill_filterCode(self):
         row = self.get_max_row() + 1
@@ -494,7 +592,7 @@ class FiscalYearLedger(FiscalYearReport):
         current_total = self.last_third_total if third else self.last_total
         if (self.last_account is not None and not third) or (self.last_third_id is not None and third):
             add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'designation_ref_with_third', get_spaces(40 if third else 30) + "{[i]}%s{[/i]}" % (_('sub-total') if third else _('total')))
-            if self.last_account.credit_debit_way() == -1:
+            if self.last_way == -1:
                 add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'debit', current_total[0], "{[i]}%s{[/i]}")
                 add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'credit', current_total[1], "{[i]}%s{[/i]}")
             else:
@@ -503,8 +601,8 @@ class FiscalYearLedger(FiscalYearReport):
             self.line_idx += 1
             last_total = current_total[0] - current_total[1]
             add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'designation_ref_with_third', get_spaces(40 if third else 30) + "{[u]}{[i]}%s{[/i]}{[/u]}" % (_('sub-balance') if third else _('balance')))
-            add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'debit', max((0, -1 * self.last_account.credit_debit_way() * last_total)), "{[u]}{[i]}%s{[/i]}{[/u]}")
-            add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'credit', max((0, self.last_account.credit_debit_way() * last_total)), "{[u]}{[i]}%s{[/i]}{[/u]}")
+            add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'debit', max((0, -1 * self.last_way * last_total)), "{[u]}{[i]}%s{[/i]}{[/u]}")
+            add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'credit', max((0, self.last_way * last_total)), "{[u]}{[i]}%s{[/i]}{[/u]}")
             self.line_idx += 1
             add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'designation_ref_with_third', '{[br/]}')
             if not third:
@@ -512,40 +610,98 @@ class FiscalYearLedger(FiscalYearReport):
                 self.last_total = [0.0, 0.0]
             self.last_third_total = [0.0, 0.0]
 
+    @property
+    def after_paramname(self):
+        return 'after_%s' % self.grid.name
+
+    def get_ledger_lines(self):
+        if self.getparam('PRINTING', False):
+            after_key = None
+            page_size = 0
+        else:
+            after_key = self.getparam(self.after_paramname, '')
+            page_size = self.getparam('page_size', self.page_size)
+        ledger_lines = LedgerLines(self.filter, after_key)
+        if ledger_lines.after_key is not None:
+            carried = ledger_lines.get_carried_totals()
+            self.last_account = carried['account__code']
+            self.last_way = carried['way']
+            self.last_third_id = carried['third_id']
+            self.last_total = carried['total']
+            self.last_third_total = carried['third_total']
+            self.resume_page = True
+        nb_lines = 0
+        last_line = None
+        for data_line in ledger_lines:
+            if (page_size > 0) and (nb_lines >= page_size):
+                self.next_key = LedgerLines.encode_key(last_line)
+                break
+            yield data_line
+            last_line = data_line
+            nb_lines += 1
+
+    def _add_account_header(self, data_line):
+        add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'designation_ref_with_third', get_spaces(15) + "{[u]}{[b]}[%s] %s{[/b]}{[/u]}" % (data_line['account__code'], data_line['account__name']))
+        self.line_idx += 1
+
+    def _add_third_header(self, data_line):
+        add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'designation_ref_with_third', get_spaces(8) + "{[b]}%s{[/b]}" % data_line['entry_account'])
+        self.line_idx += 1
+
     def calcul_table(self):
         self.line_idx = 1
         self.last_account = None
+        self.last_way = 0
         self.last_third_id = None
         self.last_total = [0.0, 0.0]
         self.last_third_total = [0.0, 0.0]
-        for line in EntryLineAccount.objects.filter(self.filter).select_related('account', 'entry').distinct().order_by('account__code', 'third', 'entry__date_value'):
-            if self.last_account != line.account:
+        self.next_key = None
+        self.resume_page = False
+        for data_line in self.get_ledger_lines():
+            if self.resume_page and (self.last_account == data_line['account__code']) and (self.last_third_id == data_line['third_id']):
+                self._add_account_header(data_line)
+                if self.last_third_id is not None:
+                    self._add_third_header(data_line)
+            self.resume_page = False
+            if self.last_account != data_line['account__code']:
                 self._add_total_account(True)
                 self._add_total_account(False)
-                self.last_account = line.account
+                self.last_account = data_line['account__code']
+                self.last_way = data_line['way']
+                self._add_account_header(data_line)
                 self.last_third_id = None
-                add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'designation_ref_with_third', get_spaces(15) + "{[u]}{[b]}%s{[/b]}{[/u]}" % str(self.last_account))
-                self.line_idx += 1
-                self.last_third_id = None
-            if self.last_third_id != line.third_id:
+            if self.last_third_id != data_line['third_id']:
                 self._add_total_account(True)
-                add_cell_in_grid(self.grid, self.line_offset + self.line_idx, 'designation_ref_with_third', get_spaces(8) + "{[b]}%s{[/b]}" % str(line.entry_account))
-                self.line_idx += 1
-                self.last_third_id = line.third_id
+                self._add_third_header(data_line)
+                self.last_third_id = data_line['third_id']
             for header in self.grid.headers:
-                value = getattr(line, header.name, None)
-                if value is None:
-                    value = line.evaluate('#' + header.name)
-                add_cell_in_grid(self.grid, self.line_offset + self.line_idx, header.name, value, line_ident=line.entry.id)
-            if line.amount > 0:
-                self.last_total[0] += line.amount
-                self.last_third_total[0] += line.amount
+                add_cell_in_grid(self.grid, self.line_offset + self.line_idx, header.name, data_line[header.name], line_ident=data_line['entry_id'])
+            if data_line['amount'] > 0:
+                self.last_total[0] += data_line['amount']
+                self.last_third_total[0] += data_line['amount']
             else:
-                self.last_total[1] -= line.amount
-                self.last_third_total[1] -= line.amount
+                self.last_total[1] -= data_line['amount']
+                self.last_third_total[1] -= data_line['amount']
             self.line_idx += 1
-        self._add_total_account(True)
-        self._add_total_account(False)
+        if self.next_key is None:
+            self._add_total_account(True)
+            self._add_total_account(False)
+
+    def fill_body(self):
+        FiscalYearReport.fill_body(self)
+        row = self.get_max_row() + 1
+        if self.getparam(self.after_paramname, '') != '':
+            btn = XferCompButton('first_%s' % self.grid.name)
+            btn.set_location(0, row, 2)
+            btn.set_action(self.request, self.__class__.get_action(_('first page'), short_icon='mdi:mdi-page-first'),
+                           modal=FORMTYPE_REFRESH, close=CLOSE_NO, params={self.after_paramname: ''})
+            self.add_component(btn)
+        if self.next_key is not None:
+            btn = XferCompButton('next_%s' % self.grid.name)
+            btn.set_location(2, row, 2)
+            btn.set_action(self.request, self.__class__.get_action(_('next page'), short_icon='mdi:mdi-page-next'),
+                           modal=FORMTYPE_REFRESH, close=CLOSE_NO, params={self.after_paramname: self.next_key})
+            self.add_component(btn)
 
 
 @MenuManage.describ('accounting.change_fiscalyear')
@@ -599,31 +755,52 @@ class FiscalYearTrialBalance(FiscalYearReport):
         self.grid.add_header('solde_debit', _('debit'), self.hfield, 0, self.format_str)
         self.grid.add_header('solde_credit', _('credit'), self.hfield, 0, self.format_str)
 
+    def _get_daybalance_filter(self):
+        # daily balances only know year, dates and account: any other criterion of the filter needs the entry lines
+        if not isinstance(self.item, FiscalYear):
+            return None
+        day_filter = Q(year=self.item)
+        line_filter = Q(entry__year=self.item) & Q(entry__date_value__gte=self.item.begin) & Q(entry__date_value__lte=self.item.end)
+        if self.filtercode != '':
+            day_filter &= Q(account__code__startswith=self.filtercode)
+            line_filter &= Q(account__code__startswith=self.filtercode)
+        if self.filter != line_filter:
+            return None
+        return day_filter
+
     def _get_balance_values(self):
         balance_values = {}
+        fields = ['account', 'account__code', 'account__name', 'account__type_of_account']
         if self.with_third:
-            fields = ['account', 'third']
+            fields.append('third')
+        day_filter = self._get_daybalance_filter()
+        if day_filter is not None:
+            data_lines = EntryLineDayBalance.get_movements(day_filter, self.item.begin, self.item.end, fields)
         else:
-            fields = ['account']
-        data_line_positifs = list(EntryLineAccount.objects.filter(self.filter & Q(amount__gt=0)).order_by(*fields).values(*fields).annotate(data_sum=Sum('amount')))
-        data_line_negatifs = list(EntryLineAccount.objects.filter(self.filter & Q(amount__lt=0)).order_by(*fields).values(*fields).annotate(data_sum=Sum('amount')))
-        for data_line in data_line_positifs + data_line_negatifs:
-            if abs(data_line['data_sum']) > 0.0001:
-                account = ChartsAccount.objects.get(id=data_line['account'])
-                account_code = correct_accounting_code(account.code)
-                if ('third' in data_line.keys()) and (data_line['third'] is not None):
-                    account_code = "%s#%s" % (account_code, data_line['third'])
-                if account_code not in balance_values.keys():
-                    if ('third' in data_line.keys()) and (data_line['third'] is not None):
-                        third = Third.objects.get(id=data_line['third'])
-                        account_title = "[%s %s]" % (account.code, str(third))
+            data_lines = list(EntryLineDayBalance.get_line_sums(EntryLineAccount.objects.filter(self.filter), fields))
+        data_lines.sort(key=lambda data_line: (data_line['account'], data_line['third'] if data_line.get('third') is not None else -1))
+        for data_line in data_lines:
+            data_line['positif_sum'] = data_line['debit_sum']
+            data_line['negatif_sum'] = data_line['credit_sum']
+        third_ids = set([data_line['third'] for data_line in data_lines if data_line.get('third') is not None])
+        third_names = {third.id: Third.get_cache_text(third) for third in Third.objects.filter(id__in=third_ids).select_related('contact', 'contact__legalentity', 'contact__individual')}
+        for data_line in data_lines:
+            way = ChartsAccount(type_of_account=data_line['account__type_of_account']).credit_debit_way()
+            for data_sum in (data_line['positif_sum'], data_line['negatif_sum']):
+                if (data_sum is not None) and (abs(data_sum) > 0.0001):
+                    account_code = correct_accounting_code(data_line['account__code'])
+                    if data_line.get('third') is not None:
+                        account_code = "%s#%s" % (account_code, data_line['third'])
+                    if account_code not in balance_values.keys():
+                        if data_line.get('third') is not None:
+                            account_title = "[%s %s]" % (data_line['account__code'], third_names[data_line['third']])
+                        else:
+                            account_title = "[%s] %s" % (correct_accounting_code(data_line['account__code']), data_line['account__name'])
+                        balance_values[account_code] = [account_title, 0, 0]
+                    if (way * data_sum) > 0.0001:
+                        balance_values[account_code][2] += way * data_sum
                     else:
-                        account_title = account.get_name()
-                    balance_values[account_code] = [account_title, 0, 0]
-                if (account.credit_debit_way() * data_line['data_sum']) > 0.0001:
-                    balance_values[account_code][2] += account.credit_debit_way() * data_line['data_sum']
-                else:
-                    balance_values[account_code][1] += -1 * account.credit_debit_way() * data_line['data_sum']
+                        balance_values[account_code][1] += -1 * way * data_sum
         return balance_values
 
     def calcul_table(self):
@@ -656,6 +833,127 @@ class FiscalYearTrialBalance(FiscalYearReport):
         add_cell_in_grid(self.grid, self.line_offset + line_idx, 'solde_credit', balance_total[4], "{[u]}{[b]}%s{[/b]}{[/u]}")
 
 
+@MenuManage.describ('accounting.change_fiscalyear', FORMTYPE_NOMODAL, 'bookkeeping_report', _('Show aged balance of thirds for current fiscal year'))
+class FiscalYearAgedBalance(FiscalYearReport):
+    caption = _("Aged balance")
+    add_filtering = True
+    force_date_filter = True
+    cached_attributes = ()
+
+    def fill_header(self):
+        if self.getparam("end") is None:
+            year = FiscalYear.get_current(self.getparam("year"))
+            if year.begin <= date.today() <= year.end:
+                self.params['end'] = date.today().isoformat()
+        FiscalYearReport.fill_header(self)
+
+    def define_gridheader(self):
+        grid_name = 'report_%d' % self.item.id
+        self.grid = XferCompGrid(grid_name)
+        self.grid.add_header('designation', _('name'))
+        self.grid.add_header('total', _('total'), self.hfield, 0, self.format_str)
+        for bucket_idx, (min_age, max_age) in enumerate(AgingBalance.BUCKETS):
+            if max_age is not None:
+                bucket_title = _('%(min)d-%(max)d days') % {'min': min_age, 'max': max_age}
+            else:
+                bucket_title = _('more than %d days') % (min_age - 1)
+            self.grid.add_header('bucket_%d' % bucket_idx, bucket_title, self.hfield, 0, self.format_str)
+        self.grid.add_action(self.request, FiscalYearAgedBalanceLines.get_action(_('Lines'), short_icon='mdi:mdi-text-box-search-outline'), modal=FORMTYPE_MODAL, close=CLOSE_NO, unique=SELECT_SINGLE,
+                             params={'gridname': grid_name, 'end': self.item.end.isoformat()})
+
+    def calcul_table(self):
+        bucket_names = ['bucket_%d' % bucket_idx for bucket_idx in range(len(AgingBalance.BUCKETS))]
+        totals = {fieldname: 0.0 for fieldname in ['total'] + bucket_names}
+        for balance in AgingBalance(self.item, self.item.end, self.filtercode).get_balances():
+            record_id = "%s#%d" % (balance['account__code'], balance['third_id'])
+            self.grid.set_value(record_id, 'designation', "[%s %s]" % (balance['code'], balance['third']))
+            for fieldname in totals.keys():
+                self.grid.set_value(record_id, fieldname, balance[fieldname])
+                totals[fieldname] += balance[fieldname]
+        self.grid.set_value('total', 'designation', get_spaces(10) + "{[u]}{[b]}%s{[/b]}{[/u]}" % _('total'))
+        for fieldname, total in totals.items():
+            self.grid.set_value('total', fieldname, {'value': currency_round(total), 'format': "{[u]}{[b]}{0}{[/b]}{[/u]}"})
+
+    def fill_buttons(self):
+        self.add_action(FiscalYearAgedBalanceExport.get_action(_('CSV export'), short_icon='mdi:mdi-file-delimited-outline'), close=CLOSE_NO,
+                        params={'end': self.item.end.isoformat(), 'filtercode': self.filtercode})
+        FiscalYearReport.fill_buttons(self)
+
+
+@MenuManage.describ('accounting.change_fiscalyear')
+class FiscalYearAgedBalanceLines(XferContainerCustom):
+    short_icon = 'mdi:mdi-text-box-search-outline'
+    model = FiscalYear
+    field_id = 'year'
+    caption = _("Aged lines")
+    methods_allowed = ('GET', )
+
+    def fillresponse(self, gridname=''):
+        self.item = FiscalYear.get_current(self.getparam("year"))
+        record_id = self.getparam(gridname, '')
+        if '#' not in record_id:
+            raise LucteriosException(IMPORTANT, _('Select a third account!'))
+        account_code, third_id = record_id.split('#')
+        aging = AgingBalance(self.item, convert_date(self.getparam("end"), self.item.end), self.getparam('filtercode', ''))
+        img = XferCompImage('img')
+        img.set_value(self.short_icon, '#')
+        img.set_location(0, 0)
+        self.add_component(img)
+        lbl = XferCompLabelForm('title')
+        lbl.set_value_as_title("[%s %s]" % (correct_accounting_code(account_code), Third.objects.get(id=int(third_id))))
+        lbl.set_location(1, 0)
+        self.add_component(lbl)
+        hfield = format_with_devise(5).split(';')
+        grid = XferCompGrid('lines')
+        grid.add_header('entry.num', _('numeros'))
+        grid.add_header('entry.date_value', _('date value'))
+        grid.add_header('designation', _('name'))
+        grid.add_header('age', _('age (days)'), htype='N0')
+        grid.add_header('amount', _('amount'), hfield[0], 0, ";".join(hfield[1:]))
+        for line in aging.get_lines(account_code, int(third_id)):
+            record_id = "%d-%d" % (line['id'], line['entry_id'])
+            grid.set_value(record_id, 'entry.num', line['entry__num'])
+            grid.set_value(record_id, 'entry.date_value', line['entry__date_value'])
+            grid.set_value(record_id, 'designation', line['entry__designation'] if not line['reference'] else "%s{[br/]}%s" % (line['entry__designation'], line['reference']))
+            grid.set_value(record_id, 'age', line['age'])
+            grid.set_value(record_id, 'amount', line['amount'])
+        grid.add_action(self.request, FiscalYearLedgerShow.get_action(TITLE_EDIT, short_icon='mdi:mdi-text-box-outline'), modal=FORMTYPE_MODAL, close=CLOSE_NO, unique=SELECT_SINGLE, params={'gridname': 'lines'})
+        grid.set_location(0, 1, 2)
+        self.add_component(grid)
+        self.add_action(WrapAction(TITLE_CLOSE, short_icon='mdi:mdi-close'))
+
+
+@MenuManage.describ('accounting.change_fiscalyear')
+class FiscalYearAgedBalanceExport(XferContainerCustom):
+    short_icon = "mdi:mdi-file-delimited-outline"
+    model = FiscalYear
+    field_id = 'year'
+    caption = _("Aged balance export")
+    readonly = True
+    methods_allowed = ('GET', )
+
+    def fillresponse(self):
+        self.item = FiscalYear.get_current(self.getparam("year"))
+        aging = AgingBalance(self.item, convert_date(self.getparam("end"), self.item.end), self.getparam('filtercode', ''))
+        destination_file = aging.export_csv("aged_balance_%d.csv" % self.item.id)
+        img = XferCompImage('img')
+        img.set_value(self.short_icon, '#')
+        img.set_location(0, 0, 1, 6)
+        self.add_component(img)
+        lbl = XferCompLabelForm('title')
+        lbl.set_value_as_title(_('Export aged balance in CSV format'))
+        lbl.set_location(1, 0)
+        self.add_component(lbl)
+        down = XferCompDownLoad('filename')
+        down.compress = False
+        down.http_file = True
+        down.maxsize = 0
+        down.set_value('aged_balance_%s.csv' % aging.reference_date.strftime('%Y%m%d'))
+        down.set_download(destination_file)
+        down.set_location(1, 1)
+        self.add_component(down)
+
+
 @MenuManage.describ('accounting.change_fiscalyear')
 class FiscalYearReportPrint(XferPrintAction):
     caption = _("Print report fiscal year")
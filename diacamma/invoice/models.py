@@ -761,7 +761,7 @@ class Provider(LucteriosModel):
 
     @property
     def third_query(self):
-        thirdfilter = Q(accountthird__code__regex=current_system_account().get_provider_mask())
+        thirdfilter = Q(accountthird__flag_provider=True)
         return Third.objects.filter(thirdfilter).distinct()
 
     def __str__(self):
@@ -2321,7 +2321,7 @@ class StorageSheet(LucteriosModel):
 
     @property
     def provider_query(self):
-        thirdfilter = Q(accountthird__code__regex=current_system_account().get_provider_mask())
+        thirdfilter = Q(accountthird__flag_provider=True)
         return Third.objects.filter(thirdfilter).distinct()
 
     def can_delete(self):
@@ -64,7 +64,7 @@ from diacamma.accounting.models import FiscalYear, Third, EntryLineAccount, Entr
     is_with_VAT, add_vat_info
 from diacamma.accounting.views import get_main_third
 from diacamma.accounting.views_entries import EntryAccountOpenFromLine
-from diacamma.accounting.tools import current_system_account, format_with_devise, get_amount_from_format_devise
+from diacamma.accounting.tools import format_with_devise, get_amount_from_format_devise
 
 MenuManage.add_sub("invoice", None, short_icon='mdi:mdi-invoice-outline', caption=_("Invoice"), desc=_("Manage of billing"), pos=45)
 
@@ -1345,7 +1345,7 @@ class BillAccountChecking(XferContainerCustom):
                                         bill_type__in=(Bill.BILLTYPE_BILL, Bill.BILLTYPE_ASSET, Bill.BILLTYPE_RECEIPT)):
             account_amount = None
             if bill.entry is not None:
-                account_amount = bill.entry.entrylineaccount_set.filter(account__code__regex=current_system_account().get_customer_mask()).aggregate(Sum('amount'))['amount__sum']
+                account_amount = bill.entry.entrylineaccount_set.filter(account__flag_customer=True).aggregate(Sum('amount'))['amount__sum']
                 if (bill.bill_type == Bill.BILLTYPE_ASSET):
                     account_amount = -1 * account_amount
             if ((account_amount is None) and (abs(bill.total) > 1e-4)) or ((account_amount is not None) and (abs(account_amount - bill.total) > 1e-4)):
@@ -1375,7 +1375,7 @@ class BillAccountChecking(XferContainerCustom):
         grid.add_header("account", _("account amount"), htype=format_with_devise(7))
         for payoff in payoff_nodeposit:
             payoffid = payoff['id']
-            account_amount = EntryAccount.objects.get(id=payoffid).entrylineaccount_set.filter(account__code__regex=current_system_account().get_customer_mask()).aggregate(Sum('amount'))['amount__sum']
+            account_amount = EntryAccount.objects.get(id=payoffid).entrylineaccount_set.filter(account__flag_customer=True).aggregate(Sum('amount'))['amount__sum']
             if payoff['is_revenu']:
                 account_amount = -1 * account_amount
             if ((account_amount is None) and (abs(payoff['amount']) > 1e-4)) or ((account_amount is not None) and (abs(account_amount - float(payoff['amount'])) > 1e-4)):
@@ -1400,7 +1400,7 @@ class BillAccountChecking(XferContainerCustom):
         grid = XferCompGrid("entryline")
         entry_lines = EntryLineAccount.objects.filter(entry__journal__gt=1,
                                                       entry__year=self.item.fiscal_year,
-                                                      account__code__regex=current_system_account().get_customer_mask()).annotate(billcount=Count('entry__bill')).annotate(payoffcount=Count('entry__payoff'))
+                                                      account__flag_customer=True).annotate(billcount=Count('entry__bill')).annotate(payoffcount=Count('entry__payoff'))
         grid.set_model(entry_lines.filter(billcount=0, payoffcount=0), None)
         grid.add_action(self.request, EntryAccountOpenFromLine.get_action(_('Entry'), short_icon='mdi:mdi-checkbook'), close=CLOSE_NO, unique=SELECT_SINGLE)
         grid.set_location(0, 1, 3)
@@ -1564,7 +1564,7 @@ def show_contact_invoice(contact, xfer):
     if WrapAction.is_permission(xfer.request, 'invoice.change_bill'):
         third = get_main_third(contact)
         if third is not None:
-            accounts = third.accountthird_set.filter(Q(code__regex=current_system_account().get_customer_mask()))
+            accounts = third.accountthird_set.filter(Q(flag_customer=True))
             if len(accounts) > 0:
                 xfer.params['third'] = third.id
                 xfer.with_individual = True
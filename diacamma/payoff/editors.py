@@ -37,7 +37,6 @@ from lucterios.contacts.models import LegalEntity
 
 from diacamma.payoff.models import Supporting, Payoff, BankAccount
 from diacamma.accounting.models import FiscalYear, is_with_VAT
-from diacamma.accounting.tools import current_system_account
 from datetime import datetime
 
 
@@ -153,7 +152,7 @@ class BankAccountEditor(LucteriosEditor):
         return sel_code
 
     def edit(self, xfer):
-        accound_list = [(item.code, str(item)) for item in FiscalYear.get_current().chartsaccount_set.all().filter(code__regex=current_system_account().get_cash_mask()).order_by('code')]
+        accound_list = [(item.code, str(item)) for item in FiscalYear.get_current().chartsaccount_set.all().filter(flag_cash=True).order_by('code')]
         self._change_account(xfer, "account_code", accound_list[:])
         accound_list.insert(0, ('', None))
         sel_comp = self._change_account(xfer, "temporary_account_code", accound_list)
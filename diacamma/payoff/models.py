@@ -53,7 +53,7 @@ from lucterios.documents.models import DocumentContainer
 from diacamma.accounting.models import EntryAccount, FiscalYear, Third, Journal, ChartsAccount, EntryLineAccount, AccountLink, \
     CostAccounting, is_with_VAT
 from diacamma.accounting.tools import currency_round, correct_accounting_code, format_with_devise, \
-    get_amount_from_format_devise, current_system_account
+    get_amount_from_format_devise
 from diacamma.payoff.payment_type import PAYMENTTYPE_LIST, PaymentType, PaymentTypeTransfer
 
 
@@ -339,12 +339,13 @@ class Supporting(LucteriosModel):
                     if added:
                         for payoff_item in supporting_payed.payoff_set.filter(supporting_payed.payoff_query):
                             _add_entryline_by_third(payoff_item.entry)
-            for entrylines in entryline_by_third.values():
-                try:
-                    AccountLink.create_link(set(entrylines))
+            link_groups = list(entryline_by_third.values())
+            for entrylines, link_error in zip(link_groups, AccountLink.create_links(link_groups)):
+                if link_error is None:
                     nb_link_created += 1
-                except LucteriosException:
-                    pass
+                else:
+                    for entryline in EntryLineAccount.objects.filter(id__in=[entryline.id for entryline in entrylines], link__isnull=False):
+                        entryline.unlink()
         return nb_link_created
 
     def get_linked_supportings(self):
@@ -577,7 +578,7 @@ class Payoff(LucteriosModel):
                 EntryLineAccount.objects.create(account=fee_account, amount=-1 * is_revenu * float(self.bank_fee), entry=entry, costaccounting=cost_accounting)
                 amount_to_bank -= float(self.bank_fee)
                 if (is_with_VAT()) and (self.bank_account.vat_rate > 0.001):
-                    vat_account = ChartsAccount.objects.filter(year=entry.year, code__regex=current_system_account().get_vat_collected_mask()).last()
+                    vat_account = ChartsAccount.objects.filter(year=entry.year, flag_vat_collected=True).last()
                     if vat_account is None:
                         raise LucteriosException(IMPORTANT, _('collected VAT account not found !'))
                     vat_amount = float(self.bank_fee) * float(self.bank_account.vat_rate) / 100
@@ -39,7 +39,6 @@ from lucterios.framework.xfergraphic import XferContainerAcknowledge, XferContai
 from lucterios.framework.xfercomponents import XferCompLabelForm, \
     XferCompEdit, XferCompImage, XferCompMemo, XferCompSelect
 from lucterios.framework.error import LucteriosException, MINOR, IMPORTANT
-from lucterios.framework.models import LucteriosQuerySet
 from lucterios.CORE.models import PrintModel
 from lucterios.CORE.xferprint import XferPrintReporting
 from lucterios.framework.xferprinting import XferContainerPrint
@@ -134,10 +133,11 @@ class SupportingThird(XferListEditor):
             else:
                 sort_thirdbis = "-"
             self.params['GRID_ORDER%third+'] = sort_thirdbis
-        items = sorted(items, key=lambda t: str(t).lower(), reverse=sort_thirdbis.startswith('-'))
-        if self.getparam('show_filter', 0) == 2:
-            items = [item for item in items if abs(item.get_total()) > 0.0001]
-        return LucteriosQuerySet(model=Third, initial=items)
+        items = Third.order_by_name(items, reverse=sort_thirdbis.startswith('-'))
+        show_filter = self.getparam('show_filter', 0)
+        if show_filter in (1, 2):
+            items = Third.annotate_total(items, only_unbalanced=(show_filter == 2))
+        return items
 
     def fillresponse_header(self):
         if 'status_filter' in self.params:
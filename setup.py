@@ -60,6 +60,7 @@ setup(
     package_data={
         "diacamma.accounting.migrations": ['*'],
         "diacamma.accounting.system": ['*', 'locale/*/*/*', 'ubl_xsd/*/*'],
+        "diacamma.accounting.management": ['*', 'commands/*'],
         "diacamma.accounting": ['build', 'images/*', 'locale/*/*/*', 'help/*'],
         "diacamma.invoice.migrations": ['*'],
         "diacamma.invoice": ['build', 'images/*', 'locale/*/*/*', 'help/*'],